@@ -4,18 +4,28 @@
 """ Daemon for detecting motion.
     """
 
+from concurrent import futures
 import datetime
+import multiprocessing
+import multiprocessing.connection
 import os
+import queue
+import sys
+import threading
 import time
+import traceback
 import platform
-from fractions import Fraction
 
-import picamera
-import picamera.array
+import numpy
 
 from utils import settings
+from utils.camera import VECTOR_TYPE, CameraError, CameraSession, vector_shape
+from utils.detector import Detector, bitmap, configured
 from utils.daemons import DaemonBase, init
-from utils.database import DatabaseConnection
+from utils.database import EventWriter
+from utils.retention import Retention
+from utils.uploader import StreamingUpload
+from utils.uploads import UploadIndex
 
 __author__ = "wavezone"
 __copyright__ = "Copyright 2015, MRG-Infó Bt."
@@ -26,32 +36,28 @@ __version__ = "1.0.1"
 __maintainer__ = "Groma István"
 __email__ = "wavezone@mrginfo.com"
 
-SECONDS2MICRO = 1000000  # Constant for converting Shutter Speed in Seconds to Microseconds
-
 
 class MotionCapture:
     """ Detect motion on PiCam and capture short video.
         """
 
-    threshold = 10  # How Much pixel changes
-    sensitivity = 100  # How many pixels change
-    nightISO = 800
-    nightShutSpeed = 6 * SECONDS2MICRO  # seconds times conversion to microseconds constant
-    testWidth = 100
-    testHeight = 75
-    frequency = 5  # passive time between two detections
+    testWidth = settings.config.test_width
+    testHeight = settings.config.test_height
+    timeout = 30  # seconds to wait for a frame before giving up on the camera
     short_duration = 15  # capture short video duration is seconds
     long_duration = 60  # capture long video duration in seconds
 
-    def __init__(self, image_dir: str, is_day: bool = True):
+    def __init__(self, image_dir: str, session: CameraSession, detector: Detector = None,
+                 retention: Retention = None, client=None, index: UploadIndex = None):
+        self.detector = detector if detector is not None else configured()
+        self.retention = retention
+        self.client = client  # DropboxClient uploading while recording, None to leave it to the upload daemon
+        self.index = index  # keeps the upload daemon off the clips uploaded while recording
+        self.uploads = {}  # file name: StreamingUpload of the clips recorded but not yet stored
         self.last_video = 0
         self.state = ''
-        self.image_width = 1920
-        self.image_height = 1080
-        self.imageVFlip = False  # Flip image Vertically
-        self.imageHFlip = False  # Flip image Horizontally
         self.image_dir = image_dir
-        self.is_day = is_day
+        self.session = session
 
     def __get_file_name(self):
         if not os.path.exists(self.image_dir):
@@ -59,103 +65,81 @@ class MotionCapture:
         now = datetime.datetime.now()
         return os.path.join(self.image_dir, "{}.h264".format(now.strftime("%Y%m%d-%H%M%S")))
 
+    def __abandon(self, filename: str, output):
+        """ Give up the upload of a failed recording, the upload daemon takes over what was written.
+            """
+        if output is not filename:
+            output.abort()
+        if self.client is not None and self.index is not None:
+            if os.path.exists(filename):
+                self.index.release(filename)
+            else:
+                self.index.forget(filename)
+
     def __capture(self, duration: int):
+        filename = self.__get_file_name()
+        output = filename
         try:
-            filename = self.__get_file_name()
-            with picamera.PiCamera() as camera:
-                time.sleep(2)
-                camera.resolution = (self.image_width, self.image_height)
-                # noinspection SpellCheckingInspection
-                camera.vflip = self.imageVFlip
-                # noinspection SpellCheckingInspection
-                camera.hflip = self.imageHFlip
-                if self.is_day:
-                    camera.exposure_mode = 'auto'
-                    camera.awb_mode = 'auto'
-                else:
-                    # Night time low light settings have long exposure times
-                    # Settings for Low Light Conditions
-                    # Set a frame rate of 1/6 fps, then set shutter
-                    # speed to 6s and ISO to approx 800 per nightISO variable
-                    camera.framerate = Fraction(1, 6)
-                    camera.shutter_speed = self.nightShutSpeed
-                    camera.exposure_mode = 'off'
-                    camera.iso = self.nightISO
-                    # Give the camera a good long time to measure AWB
-                    # (you may wish to use fixed AWB instead)
-                    time.sleep(10)
-                camera.start_recording(filename)
-                camera.wait_recording(duration)
-                camera.stop_recording()
+            if self.retention is not None:
+                self.retention.enforce(duration * settings.config.bitrate // 8)
+            if self.client is not None:
+                if self.index is not None:
+                    self.index.live(filename)
+                output = StreamingUpload(
+                    self.client, filename, '/' + os.path.basename(filename), settings.config.live_chunk_size)
+            self.session.record(output, duration)
+            if output is not filename:
+                self.uploads[filename] = output
             return filename
-        except picamera.exc.PiCameraMMALError:
+        except CameraError:
+            self.__abandon(filename, output)
             return None
+        except BaseException:
+            self.__abandon(filename, output)
+            raise
+        finally:
+            if output is not filename:
+                output.close()
+            if self.retention is not None:
+                self.retention.add(filename)
 
-    def __smart_capture(self):
-        elapsed = time.clock() - self.last_video
+    def capture(self):
+        """ Record a short video, or a long one if there was a short one recently, nothing after a long one.
+
+            :return: File name, None if nothing was recorded.
+            """
+        elapsed = time.monotonic() - self.last_video
         if self.state == 'long' and elapsed < 30 * 60:
             return None
         elif self.state == 'short' and elapsed < 5 * 60:
             filename = self.__capture(self.long_duration)
-            self.last_video = time.clock()
+            self.last_video = time.monotonic()
             self.state = 'long'
             return filename
         else:
             filename = self.__capture(self.short_duration)
-            self.last_video = time.clock()
+            self.last_video = time.monotonic()
             self.state = 'short'
             return filename
 
-    def __take_motion(self):
-        try:
-            with picamera.PiCamera() as camera:
-                time.sleep(2)
-                camera.resolution = (self.testWidth, self.testHeight)
-                with picamera.array.PiRGBArray(camera) as stream:
-                    if self.is_day:
-                        camera.exposure_mode = 'auto'
-                        camera.awb_mode = 'auto'
-                    else:
-                        # Take Low Light image
-                        # Set a framerate of 1/6 fps, then set shutter
-                        # speed to 6s and ISO to 800
-                        camera.framerate = Fraction(1, 6)
-                        camera.shutter_speed = self.nightShutSpeed
-                        camera.exposure_mode = 'off'
-                        camera.iso = self.nightISO
-                        # Give the camera a good long time to measure AWB
-                        # (you may wish to use fixed AWB instead)
-                        time.sleep(10)
-                    camera.capture(stream, format='rgb')
-                    return stream.array
-        except picamera.exc.PiCameraMMALError:
-            return None
-
     def __iter__(self):
         return self
 
     def __next__(self):
         try:
-            data1 = self.__take_motion()
+            self.detector.reset()
             while True:
-                data2 = self.__take_motion()
-                if (data1 is not None) and (data2 is not None):
-                    diff_count = 0
-                    for w in range(0, self.testWidth):
-                        for h in range(0, self.testHeight):
-                            # Conversion to int is required to avoid unsigned short overflow.
-                            diff = abs(int(data1[h][w][1]) - int(data2[h][w][1]))
-                            if diff > self.threshold:
-                                diff_count += 1
-                        if diff_count > self.sensitivity:
-                            break
-                    if diff_count > self.sensitivity:
-                        video_file = self.__smart_capture()
-                        if video_file:
-                            print("Created video file {}.".format(video_file))
-                            return video_file, diff_count
-                data1 = data2
-                time.sleep(self.frequency)
+                frame = self.session.frame(self.timeout)
+                if frame is None:
+                    raise StopIteration()
+                motion = self.detector.feed(frame)
+                if motion is not None and motion.detected:
+                    video_file = self.capture()
+                    if video_file:
+                        print("Created video file {}.".format(video_file))
+                        return video_file, motion.diff_cnt, motion.cells
+                    # Frames queued up during the capture are stale.
+                    self.detector.reset()
         except KeyboardInterrupt:
             raise StopIteration()
 
@@ -169,35 +153,249 @@ class MotionDaemon(DaemonBase):
             """
         super().__init__()
         self.directory = directory
+        self.session = None
+
+    @staticmethod
+    def _store(writer: EventWriter, file: str, diff: int, cells):
+        """ Register event.
+            """
+        insert = """
+        INSERT INTO events(
+            file,
+            location,
+            size,
+            diff_cnt,
+            cells,
+            time)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        # The time is bound now, the statement may be executed a few seconds later.
+        writer.put(insert, (
+            file,
+            platform.node(),
+            os.path.getsize(file),
+            diff,
+            bitmap(cells) if cells is not None else None,
+            datetime.datetime.now()), file)
+
+    @staticmethod
+    def _client():
+        """ Dropbox client uploading the clips while they are recorded, None if not enabled.
+            """
+        if not settings.config.live_upload or not settings.config.access_token:
+            return None
+        from dropbox.client import DropboxClient
+        return DropboxClient(settings.config.access_token)
+
+    @staticmethod
+    def _uploaded(capture: MotionCapture, file: str, writer: EventWriter, index: UploadIndex, pending: list):
+        """ Register the upload of a clip uploaded while it was recorded, once it is committed.
+
+            Called after the event was stored, so the update always follows the insert.
+
+            :param pending: Uploads not yet committed, the committed ones are removed.
+            """
+        pending[:] = [upload for upload in pending if not upload.future.done()]
+        upload = capture.uploads.pop(file, None)
+        if upload is None:
+            return
+
+        def finished(future):
+            try:
+                (url, _) = future.result()
+            except Exception as error:
+                index.release(file)
+                print("Uploading {} while recording failed, the upload daemon takes over: {}".format(
+                    os.path.basename(file), error), file=sys.stderr)
+                return
+            update = """
+            UPDATE events
+               SET url = %s,
+                   uploaded = %s
+             WHERE file = %s
+            """
+            writer.put(update, (url, datetime.datetime.now(), file), file)
+            index.done(file, url)
+            print("{} was uploaded to Dropbox while recording.".format(os.path.basename(file)))
+
+        upload.future.add_done_callback(finished)
+        pending.append(upload)
+
+    @staticmethod
+    def _abandon(pending: list):
+        """ Wait for the uploads still being sent, the ones not finishing in time are given up.
+
+            An upload already being committed can not be given up, it reaches Dropbox anyway, so it is waited for
+            to register it.
+
+            :param pending: Uploads, a given up clip is put back into the queue by its callback.
+            """
+        futures.wait([upload.future for upload in pending], EventWriter.shutdown_timeout)
+        for upload in pending:
+            # The callback of a finished upload runs in its thread after the future is done.
+            if upload.future.done() or not upload.abort():
+                upload.thread.join(EventWriter.shutdown_timeout)
+
+    @staticmethod
+    def _session_options() -> dict:
+        return dict(
+            resolution=(1920, 1080),
+            test_resolution=(MotionCapture.testWidth, MotionCapture.testHeight),
+            framerate=settings.config.framerate,
+            buffer_seconds=settings.config.buffer_seconds,
+            bitrate=settings.config.bitrate,
+            vectors=settings.config.detector == 'vectors')
+
+    @staticmethod
+    def _camera_process(ring, commands, sender, stop):
+        """ Copy the frames into the ring and record the durations requested by the recorder process.
+            """
+        from utils.pipeline import PipeFile
+
+        def record():
+            while not stop.is_set():
+                try:
+                    (recording, duration) = commands.get(timeout=1)
+                except queue.Empty:
+                    continue
+                try:
+                    session.record(PipeFile(sender, recording), duration)
+                except CameraError:
+                    print(traceback.format_exc(), file=sys.stderr)
+
+        try:
+            with CameraSession(**MotionDaemon._session_options()) as session:
+                # Recording blocks, so it runs in its own thread and the frames keep flowing.
+                threading.Thread(target=record, daemon=True).start()
+                while not stop.is_set():
+                    frame = session.frame(MotionCapture.timeout)
+                    if frame is None:
+                        raise CameraError("No frame in {} seconds".format(MotionCapture.timeout))
+                    ring.put(frame)
+        except KeyboardInterrupt:
+            pass
+
+    @staticmethod
+    def _detector_process(ring, motions, stop):
+        """ Feed the frames of the ring to the detector and pass the motions to the recorder process.
+            """
+        detector = configured()
+        seq = 0
+        try:
+            while not stop.is_set():
+                (seq, frame) = ring.get(seq, 1)
+                if frame is None:
+                    continue
+                motion = detector.feed(frame)
+                if motion is not None and motion.detected:
+                    motions.put((motion.diff_cnt, motion.cells))
+        except KeyboardInterrupt:
+            pass
+
+    @staticmethod
+    def _recorder_process(directory, commands, receiver, motions, stop):
+        """ Decide what to record, write the video file and register the event.
+            """
+        from utils.pipeline import RemoteSession
+        writer = EventWriter('recorder')
+        client = MotionDaemon._client()
+        index = UploadIndex() if client is not None else None
+        pending = []
+        capture = MotionCapture(
+            directory, RemoteSession(commands, receiver), Detector(), Retention(directory, writer), client, index)
+        try:
+            while not stop.is_set():
+                try:
+                    (diff, cells) = motions.get(timeout=1)
+                except queue.Empty:
+                    continue
+                # Motions detected while the previous video was recorded are merged into the newest one.
+                while True:
+                    try:
+                        (diff, cells) = motions.get_nowait()
+                    except queue.Empty:
+                        break
+                file = capture.capture()
+                if file:
+                    print("Created video file {}.".format(file))
+                    MotionDaemon._store(writer, file, diff, cells)
+                    MotionDaemon._uploaded(capture, file, writer, index, pending)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            MotionDaemon._abandon(pending)
+            if index is not None:
+                index.close()
+            writer.close()
+
+    def _pipeline(self):
+        """ Run capture, detection and recording in separate processes until one of them exits.
+            """
+        # Imported only here, multiprocessing.shared_memory needs Python 3.8 or newer.
+        from utils.pipeline import FrameRing
+        options = self._session_options()
+        if options['vectors']:
+            ring = FrameRing(vector_shape(options['resolution']), VECTOR_TYPE)
+        else:
+            ring = FrameRing(options['test_resolution'][::-1], numpy.uint8)
+        commands = multiprocessing.Queue()
+        motions = multiprocessing.Queue()
+        (receiver, sender) = multiprocessing.Pipe(duplex=False)
+        stop = multiprocessing.Event()
+        processes = [
+            multiprocessing.Process(
+                target=self._camera_process, args=(ring, commands, sender, stop), name='camera', daemon=True),
+            multiprocessing.Process(
+                target=self._detector_process, args=(ring, motions, stop), name='detector', daemon=True),
+            multiprocessing.Process(
+                target=self._recorder_process, args=(self.directory, commands, receiver, motions, stop),
+                name='recorder', daemon=True)]
+        try:
+            for process in processes:
+                process.start()
+            multiprocessing.connection.wait([process.sentinel for process in processes])
+            raise CameraError("The {} process exited".format(
+                ', '.join(process.name for process in processes if not process.is_alive())))
+        finally:
+            stop.set()
+            for process in processes:
+                if process.pid is not None:
+                    process.join(MotionCapture.timeout + EventWriter.shutdown_timeout)
+                    if process.is_alive():
+                        process.terminate()
+            ring.close()
 
     def run(self):
         """ Capture logic.
             """
         print("Detecting curious motion.")
+        writer = EventWriter()
+        retention = Retention(self.directory, writer)
+        client = self._client()
+        index = UploadIndex() if client is not None else None
+        pending = []
         try:
             while True:
-                motion = MotionCapture(self.directory)
-                for (file, diff) in motion:
-                    size = os.path.getsize(file)
-                    insert = """
-                    INSERT INTO events(
-                        file,
-                        location,
-                        size,
-                        diff_cnt,
-                        time)
-                    VALUES (
-                        '{}',
-                        '{}',
-                        {},
-                        {},
-                        current_timestamp)
-                    """.format(file, platform.node(), size, diff)
-                    with DatabaseConnection() as db:
-                        db.dml(insert)
+                try:
+                    if settings.config.processes:
+                        self._pipeline()
+                        continue
+                    with CameraSession(**self._session_options()) as self.session:
+                        motion = MotionCapture(
+                            self.directory, self.session, retention=retention, client=client, index=index)
+                        for (file, diff, cells) in motion:
+                            self._store(writer, file, diff, cells)
+                            self._uploaded(motion, file, writer, index, pending)
+                except CameraError:
+                    print(traceback.format_exc(), file=sys.stderr)
+                    time.sleep(5)
         except (KeyboardInterrupt, SystemExit):
             pass
         finally:
+            MotionDaemon._abandon(pending)
+            if index is not None:
+                index.close()
+            writer.close()
             print("No longer detecting motion.")
 
 
@@ -3,11 +3,17 @@
 """ Routes and views for the bottle application.
     """
 
-from bottle import route, view
-from urllib3 import PoolManager, Timeout, exceptions
+from urllib.parse import urlencode
+
+from bottle import request, route, view
 from hurry.filesize import size
 
+from utils import settings
+from utils.cache import QueryCache
 from utils.database import DatabaseConnection
+from utils.events import Filter, decode_cursor, encode_cursor, locations, page, version
+from utils.journal import Journal
+from utils.prober import Prober
 
 __author__ = "wavezone"
 __copyright__ = "Copyright 2015, MRG-Infó Bt."
@@ -23,49 +29,67 @@ STREAMS = [
     {'name': "Szuterén", 'url': 'http://wavepi.gotdns.org:8080'},
     {'name': "Teázó", 'url': 'http://nikipi.gotdns.org:8080'}]
 
-
-def _check_url(url: str) -> bool:
-    timeout = Timeout(connect=1.0, read=1.0)
-    with PoolManager(timeout=timeout) as http:
-        response = None
-        try:
-            response = http.request('GET', url)
-            return response.status == 200
-        except exceptions.MaxRetryError:
-            return False
-        finally:
-            if response is not None:
-                response.release_conn()
+cache = QueryCache(settings.config.cache_size, settings.config.cache_ttl)
+# Shared by the requests like the connection pool, only opened when the events are read locally.
+journal = Journal() if settings.config.local_events else None
+prober = Prober([stream['url'] for stream in STREAMS], settings.config.probe_interval, settings.config.probe_timeout)
 
 
 def _streams():
-    return [stream for stream in STREAMS if _check_url(stream['url'])]
+    status = prober.status()
+    return [stream for stream in STREAMS if status.get(stream['url'], {}).get('up')]
+
+
+def _home(database, condition: Filter, cursor: tuple, after: str) -> dict:
+    (data, following) = page(database, condition, cursor)
+    events = [
+        {'time': time, 'camera': location, 'size': size(file_size), 'url': url}
+        for (file, location, time, file_size, url)
+        in data
+    ]
+    return {
+        'events': events,
+        'cameras': locations(database),
+        'filter': condition.query(),
+        'first': urlencode(condition.query()) if after else None,
+        'next': urlencode(dict(condition.query(), after=encode_cursor(*following))) if following else None
+    }
+
+
+def _cached(database, condition: Filter, cursor: tuple, after: str) -> dict:
+    return cache.get(
+        ('home', condition.key(), cursor),
+        lambda: version(database),
+        lambda: _home(database, condition, cursor, after))
 
 
 @route('/')
 @route('/home')
 @view('index')
 def home():
-    """ Events.
+    """ Events, newest first, one page at a time.
         """
+    query = request.query.decode()
+    condition = Filter.parse(query)
+    cursor = decode_cursor(query.get('after'))
+    if journal is not None:
+        return _cached(journal, condition, cursor, query.get('after'))
     with DatabaseConnection() as database:
-        data = database.query("""
-        SELECT file,
-               location,
-               time,
-               size,
-               url
-          FROM events
-        """)
-        if data is None:
-            return {'events': []}
-        else:
-            events = [
-                {'time': time, 'camera': location, 'size': size(file_size), 'url': url}
-                for (file, location, time, file_size, url)
-                in data
-            ]
-            return {'events': events}
+        return _cached(database, condition, cursor, query.get('after'))
+
+
+@route('/streams.json')
+def streams_stats():
+    """ Latest health check of the streams.
+        """
+    return prober.status()
+
+
+@route('/cache.json')
+def cache_stats():
+    """ Statistics of the events cache.
+        """
+    return cache.stats()
 
 
 @route('/view')
@@ -4,17 +4,24 @@
 """ A Simple mjpg stream http server for the Raspberry Pi camera.
     """
 
+import asyncio
 import sys
 import datetime
 import io
+import json
 import re
+import threading
 import time
 import traceback
 import picamera
 
+from email.utils import formatdate, parsedate_to_datetime
 from socketserver import ThreadingMixIn
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
 from picamera.exc import PiCameraError
+from utils import settings
+from utils.broadcast import Client, FrameHub
 from utils.daemons import DaemonBase, init
 
 __author__ = "wavezone"
@@ -26,55 +33,245 @@ __version__ = "1.0.1"
 __maintainer__ = "Groma István"
 __email__ = "wavezone@mrginfo.com"
 
+# noinspection SpellCheckingInspection
+BOUNDARY = 'jpgboundary'
 
-class CamHandler(BaseHTTPRequestHandler):
-    """ Camera HTTP stream.
+# Stream outputs selected by the name of the requested file, e.g. /thumb.mjpg, the first one is the default.
+CHANNELS = [
+    ('cam', (1280, 720)),
+    ('thumb', (320, 240))]
+
+# noinspection SpellCheckingInspection
+HTML = '''<!DOCTYPE html>
+<html lang="en-US">
+    <meta charset="UTF-8">
+    <title>PiCam</title>
+    <style type="text/css">
+html {width:100%; height:100%; background:#E9967A}
+img {position:absolute; top:50%; left:50%; width:1024px; height:768px; margin-top:-384px; margin-left:-512px}
+    </style>
+    <body>
+        <img src="/cam.mjpg" />
+    </body>
+</html>'''
+
+
+class JpegOutput:
+    """ Collects the output of a video port MJPEG encoder into whole frames.
         """
 
-    def _jpeg(self):
+    def __init__(self, hub: FrameHub, channel: str):
+        self.hub = hub
+        self.channel = channel
+        self.buffer = io.BytesIO()
+
+    def write(self, buf) -> int:
+        """ Called by the encoder, publishes the frame at its end of image marker.
+            """
+        if buf[:2] == b'\xff\xd8':
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        self.buffer.write(buf)
+        if buf[-2:] == b'\xff\xd9':
+            self.hub.publish(self.buffer.getvalue(), self.channel)
+        return len(buf)
+
+    def flush(self):
+        """ Nothing to flush, incomplete frames are dropped.
+            """
+
+
+def _capture(hub: FrameHub):
+    """ Encode every channel once with the hardware MJPEG encoder on its own splitter port.
+
+        The sensor runs at the rate of the most demanding client, adjusted every second with framerate_delta,
+        which unlike framerate can change while recording.
+        """
+    with picamera.PiCamera() as camera:
+        camera.resolution = CHANNELS[0][1]
+        camera.framerate = hub.max_fps
+        camera.framerate_delta = hub.framerate() - hub.max_fps
+        now = datetime.datetime.now()
+        camera.annotate_text = now.strftime("%Y-%m-%d %H:%M:%S")
+        time.sleep(2)  # Camera warm-up time
+        ports = range(1, len(CHANNELS) + 1)
+        for (port, (channel, resolution)) in zip(ports, CHANNELS):
+            camera.start_recording(
+                JpegOutput(hub, channel),
+                format='mjpeg',
+                splitter_port=port,
+                resize=None if resolution == camera.resolution else resolution)
+        try:
+            while hub.active():
+                camera.wait_recording(1)
+                delta = hub.framerate() - hub.max_fps
+                if delta != camera.framerate_delta:
+                    camera.framerate_delta = delta
+                now = datetime.datetime.now()
+                camera.annotate_text = now.strftime("%Y-%m-%d %H:%M:%S")
+        finally:
+            for port in ports:
+                camera.stop_recording(splitter_port=port)
+
+
+full_lock = threading.Lock()
+
+
+def _full() -> bytes:
+    """ Capture full sensor resolution JPEG.
+
+        Requests are queued on a lock, so only one capture runs at a time. The stream pauses meanwhile.
+        """
+    with full_lock, hub.exclusive():
         stream = io.BytesIO()
         with picamera.PiCamera() as camera:
             camera.resolution = (2592, 1944)
             camera.brightness = 70
             camera.capture(stream, 'jpeg')
+        return stream.getvalue()
+
+
+def _part(frame: bytes) -> bytes:
+    """ One part of the multipart MJPEG response.
+        """
+    return '--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(
+        BOUNDARY, len(frame)).encode('ascii') + frame + b'\r\n'
+
+
+hub = FrameHub(_capture, settings.config.stream_fps)
+
+
+def _fps(path: str) -> float:
+    """ Frame rate requested in the query string, e.g. /cam.mjpg?fps=5.
+
+        :param path: Request path.
+        :return: None if not given or invalid.
+        """
+    try:
+        fps = float(parse_qs(urlsplit(path).query)['fps'][0])
+    except (KeyError, ValueError):
+        return None
+    if fps <= 0:
+        return None
+    return min(fps, hub.max_fps)
+
+
+def _channel(path: str) -> str:
+    """ Stream output requested, e.g. thumb for /thumb.mjpg.
+
+        :param path: Request path.
+        """
+    name = urlsplit(str(path)).path.rsplit('/', 1)[-1].split('.', 1)[0]
+    channels = [channel for (channel, _) in CHANNELS]
+    return name if name in channels else channels[0]
+
+
+def _snapshot(path: str, if_none_match: str = None, if_modified_since: str = None) -> tuple:
+    """ Latest stream frame not older than the configured age, honouring conditional requests.
+
+        :param path: Request path.
+        :param if_none_match: If-None-Match request header.
+        :param if_modified_since: If-Modified-Since request header.
+        :return: HTTP status, headers and body.
+        """
+    max_age = settings.config.snapshot_age
+    channel = _channel(path)
+    (seq, frame, timestamp) = hub.fresh(max_age, timeout=10, channel=channel)
+    if frame is None:
+        return 503, [('Content-Length', 0)], b''
+    etag = '"{}-{}-{}"'.format(channel, hub.started, seq)
+    headers = [
+        ('ETag', etag),
+        ('Last-Modified', formatdate(timestamp, usegmt=True)),
+        ('Cache-Control', 'max-age={:g}'.format(max_age))]
+    if if_none_match is not None:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    elif if_modified_since is not None:
+        try:
+            not_modified = int(timestamp) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    if not_modified:
+        return 304, headers, b''
+    return 200, headers + [('Content-Type', 'image/jpeg'), ('Content-Length', len(frame))], frame
+
+
+def _stats() -> bytes:
+    """ Statistics of the stream clients as JSON.
+        """
+    return json.dumps({'clients': hub.stats()}).encode('utf-8')
+
+
+def _route(path: str) -> str:
+    """ Resource type requested.
+
+        :param path: Request path.
+        :return: One of 'full', 'jpeg', 'mjpg', 'html', 'stats' and 'ok'.
+        """
+    if path is not None:
+        path = re.sub('[^.a-zA-Z0-9]', "", urlsplit(str(path)).path)
+    else:
+        path = ''
+    # noinspection SpellCheckingInspection
+    if path in ('full.jpg', 'full.jpeg'):
+        return 'full'
+    elif path.endswith('.jpg')\
+            or path.endswith('.jpeg'):
+        return 'jpeg'
+    elif path.endswith('.mjpg')\
+            or path.endswith('.mjpeg'):
+        return 'mjpg'
+    elif path.endswith('.htm')\
+            or path.endswith('.html'):
+        return 'html'
+    elif path.endswith('.json'):
+        return 'stats'
+    else:
+        return 'ok'
+
+
+class CamHandler(BaseHTTPRequestHandler):
+    """ Camera HTTP stream.
+        """
+
+    timeout = 10  # seconds to wait for a frame
+
+    def _full(self):
+        stream = _full()
         self.send_response(200)
         self.send_header('Content-type', 'image/jpeg')
-        self.send_header('Content-length', len(stream.getvalue()))
+        self.send_header('Content-length', len(stream))
+        self.end_headers()
+        self.wfile.write(stream)
+
+    def _jpeg(self):
+        (status, headers, body) = _snapshot(
+            self.path,
+            self.headers.get('If-None-Match'),
+            self.headers.get('If-Modified-Since'))
+        self.send_response(status)
+        for (name, value) in headers:
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(stream.getvalue())
+        self.wfile.write(body)
 
     def _mjpg(self):
         self.send_response(200)
-        self.send_header('Pragma:', 'no-cache')
-        self.send_header('Cache-Control:', 'no-cache')
-        self.send_header('Content-Encoding:', 'identify')
-        # noinspection SpellCheckingInspection
-        self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=--jpgboundary')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-type', 'multipart/x-mixed-replace; boundary={}'.format(BOUNDARY))
         self.end_headers()
-        data = io.BytesIO()
-        with picamera.PiCamera() as camera:
-            camera.resolution = (1280, 720)
-            camera.framerate = 30
-            now = datetime.datetime.now()
-            camera.annotate_text = now.strftime("%Y-%m-%d %H:%M:%S")
-            time.sleep(2)  # Camera warm-up time
+        with Client(hub, _fps(self.path), self.address_string(), _channel(self.path)) as client:
             try:
-                for _ in camera.capture_continuous(data, 'jpeg'):
-                    stream = data.getvalue()
-                    self.send_header('Content-type', 'image/jpeg')
-                    self.send_header('Content-length', len(stream))
-                    self.end_headers()
-                    self.wfile.write(stream)
-                    # noinspection SpellCheckingInspection
-                    self.wfile.write(b'--jpgboundary')
-                    self.send_response(200)
+                while True:
+                    stream = client.get(self.timeout)
+                    if stream is None:
+                        return
+                    self.wfile.write(_part(stream))
                     if self.wfile.closed:
                         return
-                    data.seek(0)
-                    data.truncate()
-                    now = datetime.datetime.now()
-                    camera.annotate_text = now.strftime("%Y-%m-%d %H:%M:%S")
-                    time.sleep(.2)
             except IOError as e:
                 # noinspection SpellCheckingInspection
                 if hasattr(e, 'errno') and e.errno == 32:
@@ -82,25 +279,23 @@ class CamHandler(BaseHTTPRequestHandler):
                     return
                 else:
                     raise e
+            finally:
+                print("Stream client {name} got {sent} frames, dropped {dropped}, {effective_fps} fps.".format(
+                    **client.stats()))
 
     def _html(self):
-        # noinspection SpellCheckingInspection
-        html = '''<!DOCTYPE html>
-<html lang="en-US">
-    <meta charset="UTF-8">
-    <title>PiCam</title>
-    <style type="text/css">
-html {width:100%; height:100%; background:#E9967A}
-img {position:absolute; top:50%; left:50%; width:1024px; height:768px; margin-top:-384px; margin-left:-512px}
-    </style>
-    <body>
-        <img src="/cam.mjpg" />
-    </body>
-</html>'''
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
         self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        self.wfile.write(HTML.encode('utf-8'))
+
+    def _stats(self):
+        body = _stats()
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
 
     def _ok(self):
         self.send_response(200)
@@ -112,20 +307,17 @@ img {position:absolute; top:50%; left:50%; width:1024px; height:768px; margin-to
 
     def do_GET(self):
         try:
-            if self.path is not None:
-                path = re.sub('[^.a-zA-Z0-9]', "", str(self.path))
-            else:
-                path = ''
-            # noinspection SpellCheckingInspection
-            if path.endswith('.jpg')\
-                    or path.endswith('.jpeg'):
+            route = _route(self.path)
+            if route == 'full':
+                self._full()
+            elif route == 'jpeg':
                 self._jpeg()
-            elif path.endswith('.mjpg')\
-                    or path.endswith('.mjpeg'):
+            elif route == 'mjpg':
                 self._mjpg()
-            elif path.endswith('.htm')\
-                    or path.endswith('.html'):
+            elif route == 'html':
                 self._html()
+            elif route == 'stats':
+                self._stats()
             else:
                 self._ok()
         except (IOError, PiCameraError):
@@ -139,16 +331,164 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
 
 
+class AsyncHTTPServer:
+    """ Handle requests as coroutines of one event loop.
+
+        Writes never block: a slow client only delays its own coroutine, which always continues with the latest
+        frame once the socket has drained.
+        """
+
+    timeout = 10  # seconds to wait for the request or for a frame
+    write_buffer = 256 * 1024  # bytes buffered per client before waiting for the socket
+    reasons = {200: 'OK', 304: 'Not Modified', 503: 'Service Unavailable'}
+
+    def __init__(self, address: tuple):
+        self.address = address
+        self.server = None
+        self.clients = set()
+        self.frame_ready = None
+        self.loop = None
+
+    def _notify(self):
+        """ Wake up every streaming client, called in the event loop.
+            """
+        self.frame_ready.set()
+        self.frame_ready = asyncio.Event()
+
+    def _listener(self):
+        """ Called by the producer thread.
+            """
+        self.loop.call_soon_threadsafe(self._notify)
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: str, headers: list, body: bytes = b''):
+        lines = ['HTTP/1.0 {}'.format(status)] + ['{}: {}'.format(name, value) for (name, value) in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _full(self, writer: asyncio.StreamWriter):
+        stream = await self.loop.run_in_executor(None, _full)
+        await self._respond(writer, '200 OK', [
+            ('Content-Type', 'image/jpeg'),
+            ('Content-Length', len(stream))], stream)
+
+    async def _jpeg(self, writer: asyncio.StreamWriter, path: str, headers: dict):
+        (status, headers, body) = await self.loop.run_in_executor(
+            None, _snapshot, path, headers.get('if-none-match'), headers.get('if-modified-since'))
+        await self._respond(writer, '{} {}'.format(status, self.reasons[status]), headers, body)
+
+    async def _mjpg(self, writer: asyncio.StreamWriter, path: str):
+        await self._respond(writer, '200 OK', [
+            ('Pragma', 'no-cache'),
+            ('Cache-Control', 'no-cache'),
+            ('Content-Type', 'multipart/x-mixed-replace; boundary={}'.format(BOUNDARY))])
+        peer = writer.get_extra_info('peername')
+        with Client(hub, _fps(path), peer[0] if peer else '', _channel(path)) as client:
+            try:
+                while True:
+                    delay = client.delay()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    frame_ready = self.frame_ready
+                    stream = client.take()
+                    if stream is not None:
+                        writer.write(_part(stream))
+                        await writer.drain()
+                    else:
+                        await asyncio.wait_for(frame_ready.wait(), self.timeout)
+            finally:
+                print("Stream client {name} got {sent} frames, dropped {dropped}, {effective_fps} fps.".format(
+                    **client.stats()))
+
+    async def _html(self, writer: asyncio.StreamWriter):
+        body = HTML.encode('utf-8')
+        await self._respond(writer, '200 OK', [
+            ('Content-Type', 'text/html'),
+            ('Content-Length', len(body))], body)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.clients.add(task)
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.timeout)
+            headers = {}
+            while True:
+                line = (await asyncio.wait_for(reader.readline(), self.timeout)).decode('latin-1').strip()
+                if not line:
+                    break
+                (name, _, value) = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2:
+                await self._respond(writer, '400 Bad Request', [('Content-Length', 0)])
+                return
+            if parts[0] != 'GET':
+                await self._respond(writer, '501 Unsupported method', [('Content-Length', 0)])
+                return
+            route = _route(parts[1])
+            try:
+                if route == 'full':
+                    await self._full(writer)
+                elif route == 'jpeg':
+                    await self._jpeg(writer, parts[1], headers)
+                elif route == 'mjpg':
+                    await self._mjpg(writer, parts[1])
+                elif route == 'html':
+                    await self._html(writer)
+                elif route == 'stats':
+                    body = _stats()
+                    await self._respond(writer, '200 OK', [
+                        ('Content-Type', 'application/json'),
+                        ('Content-Length', len(body))], body)
+                else:
+                    await self._respond(writer, '200 OK', [('Content-Length', 2)], b'OK')
+            except PiCameraError:
+                await self._respond(writer, '404 Not Found', [('Content-Length', 0)])
+        except (asyncio.TimeoutError, asyncio.CancelledError, IOError):
+            pass
+        finally:
+            self.clients.discard(task)
+            writer.close()
+
+    async def serve(self):
+        """ Serve until cancelled.
+            """
+        self.loop = asyncio.get_event_loop()
+        self.frame_ready = asyncio.Event()
+        hub.add_listener(self._listener)
+        try:
+            self.server = await asyncio.start_server(self._handle, *self.address)
+            for socket in self.server.sockets:
+                print("Serving on {}".format(socket.getsockname()))
+            await asyncio.Event().wait()
+        finally:
+            hub.remove_listener(self._listener)
+
+    async def close(self):
+        """ Stop listening and disconnect the clients.
+            """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for task in list(self.clients):
+            task.cancel()
+        if self.clients:
+            await asyncio.wait(list(self.clients), timeout=self.timeout)
+
+
 class CameraDaemon(DaemonBase):
     """ Camera daemon.
         """
 
+    address = ('', 8080)
+
     # noinspection PyBroadException
-    def run(self):
-        """ HTTP streaming logic.
+    def _threaded(self):
+        """ One thread per client.
             """
         while True:
-            server = ThreadedHTTPServer(('', 8080), CamHandler)
+            server = ThreadedHTTPServer(self.address, CamHandler)
             with server.socket as socket:
                 try:
                     print("Serving on {}".format(socket.getsockname()))
@@ -162,6 +502,34 @@ class CameraDaemon(DaemonBase):
                     server.shutdown()
             time.sleep(1)
 
+    # noinspection PyBroadException
+    def _asyncio(self):
+        """ One event loop for every client.
+            """
+        while True:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            server = AsyncHTTPServer(self.address)
+            try:
+                loop.run_until_complete(server.serve())
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except:
+                print(traceback.format_exc(), file=sys.stderr)
+            finally:
+                print("No longer serving.")
+                loop.run_until_complete(server.close())
+                loop.close()
+            time.sleep(1)
+
+    def run(self):
+        """ HTTP streaming logic.
+            """
+        if settings.config.server == 'threaded':
+            self._threaded()
+        else:
+            self._asyncio()
+
 
 if __name__ == '__main__':
     my_daemon = CameraDaemon()
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# Dummy file to make this a package.
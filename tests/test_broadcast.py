@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the frame hub.
+    """
+
+import threading
+import time
+import unittest
+
+from utils.broadcast import Client, FrameHub
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+
+class FramerateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = FrameHub(lambda hub: None, fps=5)
+
+    def test_default_without_clients(self):
+        self.assertEqual(5, self.hub.framerate())
+
+    def test_follows_fastest_client(self):
+        with Client(self.hub, 12):
+            with Client(self.hub, 2):
+                self.assertEqual(12, self.hub.framerate())
+            with Client(self.hub, 100):
+                self.assertEqual(FrameHub.max_fps, self.hub.framerate())
+        self.assertEqual(5, self.hub.framerate())
+
+
+class MailboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = FrameHub(lambda hub: None, fps=5)
+
+    def test_slow_client_gets_latest_frame(self):
+        with Client(self.hub, 50) as client:
+            for number in range(100):
+                self.hub.publish(b'frame %d' % number)
+            self.assertEqual(b'frame 99', client.get(1))
+            self.assertEqual(99, client.dropped)
+            # Nothing piled up behind the latest frame.
+            self.assertIsNone(client.get(0.1))
+            self.hub.publish(b'frame 100')
+            self.assertEqual(b'frame 100', client.get(1))
+        self.assertEqual(2, client.sent)
+
+    def test_fast_producer_does_not_wait_for_client(self):
+        stop = threading.Event()
+
+        def produce():
+            number = 0
+            while not stop.is_set():
+                self.hub.publish(number)
+                number += 1
+                time.sleep(0.001)
+
+        with Client(self.hub, 10) as client:
+            producer = threading.Thread(target=produce)
+            producer.start()
+            try:
+                frames = [client.get(1) for _ in range(5)]
+            finally:
+                stop.set()
+                producer.join()
+        # Every frame is newer than the previous one and many were skipped between them.
+        self.assertEqual(sorted(frames), frames)
+        self.assertGreater(frames[-1] - frames[0], len(frames))
+        self.assertGreater(client.dropped, 0)
+        self.assertEqual(5, client.sent)
+
+    def test_channels_are_separate(self):
+        with Client(self.hub, 50, channel='thumb') as thumb, Client(self.hub, 50) as cam:
+            self.hub.publish(b'thumb', 'thumb')
+            self.hub.publish(b'cam')
+            self.assertEqual(b'thumb', thumb.get(1))
+            self.assertEqual(b'cam', cam.get(1))
+            self.assertIsNone(thumb.get(0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the query cache.
+    """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from utils.cache import QueryCache
+from utils.events import version
+from utils.journal import Journal
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+
+class Query:
+    """ Counts how many times it runs, the result is the key and the number of the run.
+        """
+
+    def __init__(self):
+        self.runs = 0
+        self.version = 1
+
+    def loader(self, key):
+        def load():
+            self.runs += 1
+            return key, self.runs
+        return load
+
+    def get(self, cache: QueryCache, key):
+        return cache.get(key, lambda: self.version, self.loader(key))
+
+
+class QueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query = Query()
+
+    def test_hit(self):
+        cache = QueryCache(4, 60)
+        self.assertEqual(('a', 1), self.query.get(cache, 'a'))
+        self.assertEqual(('a', 1), self.query.get(cache, 'a'))
+        self.assertEqual(1, self.query.runs)
+        stats = cache.stats()
+        self.assertEqual((1, 1, 2, 0.5), (stats['hits'], stats['misses'], stats['version_checks'], stats['hit_ratio']))
+
+    def test_least_recently_used_evicted(self):
+        cache = QueryCache(2, 60)
+        self.query.get(cache, 'a')
+        self.query.get(cache, 'b')
+        # Using a makes b the least recently used one.
+        self.query.get(cache, 'a')
+        self.query.get(cache, 'c')
+        self.assertEqual(['a', 'c'], list(cache.entries))
+        self.assertEqual(3, self.query.runs)
+        self.assertEqual(('a', 1), self.query.get(cache, 'a'))
+        self.assertEqual(('b', 4), self.query.get(cache, 'b'))
+        self.assertEqual(2, cache.stats()['evictions'])
+        self.assertEqual(2, cache.stats()['entries'])
+
+    def test_expired(self):
+        cache = QueryCache(4, 0.1)
+        self.query.get(cache, 'a')
+        self.assertEqual(('a', 1), self.query.get(cache, 'a'))
+        time.sleep(0.15)
+        self.assertEqual(('a', 2), self.query.get(cache, 'a'))
+        self.assertEqual(1, cache.stats()['stale'])
+
+    def test_new_version_invalidates(self):
+        cache = QueryCache(4, 60)
+        self.query.get(cache, 'a')
+        self.query.get(cache, 'b')
+        self.query.version = 2
+        self.assertEqual(('a', 3), self.query.get(cache, 'a'))
+        self.assertEqual(('a', 3), self.query.get(cache, 'a'))
+        self.assertEqual(('b', 4), self.query.get(cache, 'b'))
+        self.assertEqual(2, cache.stats()['stale'])
+        # Going back to an earlier version is a change too.
+        self.query.version = 1
+        self.assertEqual(('a', 5), self.query.get(cache, 'a'))
+
+    def test_clear(self):
+        cache = QueryCache(4, 60)
+        self.query.get(cache, 'a')
+        cache.clear()
+        self.assertEqual(('a', 2), self.query.get(cache, 'a'))
+        self.assertEqual(0, cache.stats()['stale'])
+
+    def test_events_version_stamp(self):
+        directory = tempfile.mkdtemp()
+        journal = Journal(os.path.join(directory, 'journal.db'))
+        try:
+            cache = QueryCache(4, 60)
+
+            def count():
+                return cache.get('count', lambda: version(journal), self.query.loader('count'))
+
+            journal.append('test', "INSERT INTO events(file, location, time) VALUES (%s, %s, %s)",
+                           ('a.h264', 'pi', '2016-05-01 12:00:00'))
+            self.assertEqual(('count', 1), count())
+            self.assertEqual(('count', 1), count())
+            # A new event and an upload both change the stamp.
+            journal.append('test', "INSERT INTO events(file, location, time) VALUES (%s, %s, %s)",
+                           ('b.h264', 'pi', '2016-05-01 12:05:00'))
+            self.assertEqual(('count', 2), count())
+            journal.append('test', "UPDATE events SET url = %s, uploaded = %s WHERE file = %s",
+                           ('https://db.tt/a', '2016-05-01 12:10:00', 'a.h264'))
+            self.assertEqual(('count', 3), count())
+            self.assertEqual(('count', 3), count())
+        finally:
+            journal.close()
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the camera session with the fake camera.
+    """
+
+import unittest
+
+import numpy
+
+from utils.camera import CameraSession, CircularOutput, FakeCamera, _is_header
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+HEADER = b'\x00\x00\x00\x01\x27' + bytes(27)
+FRAME = b'\x00\x00\x00\x01\x25' + bytes(1019)
+
+
+class Recording:
+    """ Output file keeping the written chunks, close() does not lose them.
+        """
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, buf) -> int:
+        self.chunks.append(bytes(buf))
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def data(self) -> bytes:
+        return b''.join(self.chunks)
+
+
+class CircularOutputTest(unittest.TestCase):
+
+    def test_buffer_starts_with_header(self):
+        output = CircularOutput(10000)
+        output.write(FRAME)
+        output.write(HEADER)
+        output.write(FRAME)
+        self.assertEqual([HEADER, FRAME], list(output.chunks))
+
+    def test_buffer_trimmed_to_whole_groups(self):
+        output = CircularOutput(3 * len(FRAME))
+        for _ in range(3):
+            output.write(HEADER)
+            output.write(FRAME)
+        self.assertLessEqual(output.nbytes, output.size)
+        self.assertTrue(_is_header(output.chunks[0]))
+
+    def test_start_flushes_buffer_before_live_part(self):
+        output = CircularOutput(10000)
+        output.write(HEADER)
+        output.write(FRAME)
+        recording = Recording()
+        output.start(recording)
+        live = b'\x00\x00\x00\x01\x21' + bytes(10)
+        output.write(live)
+        output.stop()
+        self.assertEqual([HEADER, FRAME, live], recording.chunks)
+        self.assertTrue(recording.closed)
+        self.assertEqual(0, output.nbytes)
+
+    def test_start_between_key_frames_waits_for_header(self):
+        output = CircularOutput(len(HEADER) + len(FRAME))
+        output.write(HEADER)
+        output.write(FRAME)
+        output.write(FRAME)
+        self.assertEqual(0, output.nbytes)
+        recording = Recording()
+        output.start(recording)
+        output.write(FRAME)
+        output.write(HEADER)
+        output.write(FRAME)
+        output.stop()
+        self.assertEqual([HEADER, FRAME], recording.chunks)
+
+
+class CameraSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        luma = numpy.arange(75 * 100, dtype=numpy.uint32).reshape((75, 100)).astype(numpy.uint8)
+        self.luma = luma
+        self.session = CameraSession(
+            test_resolution=(100, 75), framerate=20, buffer_seconds=1, bitrate=400000,
+            camera_factory=lambda: FakeCamera(frames=[luma]))
+        self.session.open()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_frames_come_from_luma_pool(self):
+        frames = [self.session.frame(5) for _ in range(6)]
+        pool = self.session.output.pool
+        for frame in frames:
+            self.assertIsNotNone(frame)
+            self.assertEqual((75, 100), frame.shape)
+            self.assertTrue(any(frame is buffer for buffer in pool))
+            numpy.testing.assert_array_equal(self.luma, frame)
+        # The previous and the current frame are never overwritten by the next frames.
+        (previous, current) = frames[-2:]
+        self.assertIsNot(previous, current)
+
+    def test_record_flushes_buffer_first(self):
+        # Wait for a full group of pictures in the buffer.
+        for _ in range(25):
+            self.session.frame(5)
+        buffered = self.session.recorder.nbytes
+        self.assertGreater(buffered, 0)
+        recording = Recording()
+        self.session.record(recording, 0.5)
+        data = recording.data()
+        self.assertTrue(recording.closed)
+        self.assertTrue(_is_header(data))
+        self.assertGreater(len(data), buffered)
+
+
+class KeyFrameTest(unittest.TestCase):
+
+    def test_record_with_empty_buffer_starts_with_header(self):
+        # The buffer is smaller than a group of pictures, so it is empty most of the time.
+        session = CameraSession(
+            framerate=10, buffer_seconds=1, bitrate=8000, camera_factory=FakeCamera)
+        session.open()
+        try:
+            session.frame(5)
+            recording = Recording()
+            session.record(recording, 0.5)
+            data = recording.data()
+            self.assertTrue(_is_header(data))
+            # The intra frame was requested, the clip does not wait for the next group of pictures.
+            self.assertGreater(len(data), 2 * len(FRAME))
+        finally:
+            session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the journal and of the write-behind queue with a stand-in database.
+    """
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pymysql.err import OperationalError
+
+from utils import database
+from utils.database import ConnectionPool, EventWriter
+from utils.journal import Journal
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+INSERT = "INSERT INTO events(file, location, time) VALUES (%s, %s, %s)"
+UPDATE = "UPDATE events SET url = %s WHERE file = %s"
+
+
+class Database:
+    """ Stand-in for MySQL keeping the executed statements, unreachable while down.
+        """
+
+    def __init__(self):
+        self.executed = []
+        self.down = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement: str, params):
+        self.executed.append((statement, tuple(params)))
+
+    def executemany(self, statement: str, rows: list):
+        for params in rows:
+            self.execute(statement, params)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class Pool:
+    """ Stand-in for ConnectionPool handing out the database.
+        """
+
+    def __init__(self, database: Database):
+        self.database = database
+
+    def acquire(self, timeout: float = None):
+        if self.database.down:
+            raise OperationalError(2003, "Can't connect to MySQL server")
+        return self.database
+
+    def release(self, connection, broken: bool = False):
+        pass
+
+
+class Connection:
+    """ Stand-in for a PyMySQL connection, its server may go away.
+        """
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.pings = 0
+
+    def ping(self, reconnect: bool = True):
+        self.pings += 1
+        if not self.alive:
+            raise OperationalError(2006, "MySQL server has gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class Server:
+    """ Stand-in for pymysql.connect(), refusing connections while down.
+        """
+
+    def __init__(self):
+        self.connections = []
+        self.attempts = 0
+        self.down = False
+
+    def __call__(self, **kwargs) -> Connection:
+        self.attempts += 1
+        if self.down:
+            raise OperationalError(2003, "Can't connect to MySQL server")
+        self.connections.append(Connection())
+        return self.connections[-1]
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        patcher = mock.patch.object(database.pymysql, 'connect', self.server, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reconnect_backoff(self):
+        pool = ConnectionPool(0, 2)
+        pool.backoff = 0.2
+        self.server.down = True
+        self.assertRaises(OperationalError, pool.acquire)
+        # No new attempt until the backoff delay has passed.
+        self.assertRaises(OperationalError, pool.acquire)
+        self.assertEqual(1, self.server.attempts)
+        time.sleep(0.25)
+        self.assertRaises(OperationalError, pool.acquire)
+        self.assertEqual(2, self.server.attempts)
+        # The delay doubled.
+        time.sleep(0.25)
+        self.assertRaises(OperationalError, pool.acquire)
+        self.assertEqual(2, self.server.attempts)
+        time.sleep(0.2)
+        self.server.down = False
+        connection = pool.acquire()
+        self.assertIs(self.server.connections[0], connection)
+        self.assertEqual({'size': 1, 'idle': 0, 'created': 1, 'reused': 0, 'failures': 0}, pool.stats())
+        pool.release(connection)
+        pool.close()
+
+    def test_idle_expiry(self):
+        pool = ConnectionPool(1, 3, idle_timeout=0.05)
+        connections = [pool.acquire() for _ in range(3)]
+        for connection in connections:
+            pool.release(connection)
+        time.sleep(0.1)
+        # The most recently used one is borrowed, the older idle ones are closed.
+        self.assertIs(connections[-1], pool.acquire())
+        self.assertEqual([True, True, False], [connection.closed for connection in connections])
+        self.assertEqual(1, pool.stats()['size'])
+        pool.release(connections[-1])
+        # The last min_size idle connections are kept however long they are idle.
+        time.sleep(0.1)
+        self.assertIs(connections[-1], pool.acquire())
+        self.assertFalse(connections[-1].closed)
+
+    def test_ping_health_check(self):
+        pool = ConnectionPool(1, 2)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIs(first, pool.acquire())
+        self.assertEqual(1, first.pings)
+        pool.release(first)
+        # The server closed the idle connection meanwhile.
+        first.alive = False
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+        self.assertEqual({'size': 1, 'idle': 0, 'created': 2, 'reused': 1, 'failures': 0}, pool.stats())
+
+    def test_broken_connection_dropped_on_release(self):
+        pool = ConnectionPool(1, 1)
+        first = pool.acquire()
+        pool.release(first, broken=True)
+        self.assertTrue(first.closed)
+        self.assertEqual(0, pool.stats()['size'])
+        # The slot is free again, a new connection is opened without waiting.
+        second = pool.acquire(timeout=0.1)
+        self.assertIsNot(first, second)
+        self.assertEqual(2, self.server.attempts)
+
+    def test_borrowers_wait_for_release(self):
+        pool = ConnectionPool(1, 1)
+        first = pool.acquire()
+        self.assertRaises(OperationalError, pool.acquire, 0.05)
+        threading.Timer(0.05, pool.release, (first,)).start()
+        self.assertIs(first, pool.acquire(1))
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.directory, 'journal.db'))
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_statement_waits_for_earlier_one_of_other_source(self):
+        self.journal.append('motion', INSERT, ('a.h264', 'pi', '2016-01-01 00:00:00'), 'a.h264')
+        self.journal.append('upload', UPDATE, ('url-b', 'b.h264'), 'b.h264')
+        self.journal.append('upload', UPDATE, ('url-a', 'a.h264'), 'a.h264')
+        self.journal.append('upload', UPDATE, ('url-c', 'c.h264'), 'c.h264')
+        # Only the statements of the same key are held back.
+        self.assertEqual(
+            [['url-b', 'b.h264'], ['url-c', 'c.h264']],
+            [params for (_, _, params) in self.journal.pending('upload', 10)])
+        self.journal.done([row_id for (row_id, _, _) in self.journal.pending('motion', 10)])
+        self.assertEqual(
+            [['url-b', 'b.h264'], ['url-a', 'a.h264'], ['url-c', 'c.h264']],
+            [params for (_, _, params) in self.journal.pending('upload', 10)])
+
+    def test_orphaned_source_holds_back_its_keys_only(self):
+        # The recorder of the pipeline wrote an event, then the pipeline was switched off for good.
+        self.journal.append('recorder', INSERT, ('a.h264', 'pi', '2016-01-01 00:00:00'), 'a.h264')
+        self.journal.append('upload', UPDATE, ('url-a', 'a.h264'), 'a.h264')
+        for name in 'bcd':
+            self.journal.append('upload', UPDATE, ('url-' + name, name + '.h264'), name + '.h264')
+        self.journal.append('upload', UPDATE, ('url-a2', 'a.h264'), 'a.h264')
+        # The held back statements do not count against the limit either.
+        self.assertEqual(
+            [['url-b', 'b.h264'], ['url-c', 'c.h264']],
+            [params for (_, _, params) in self.journal.pending('upload', 2)])
+        self.journal.done([row_id for (row_id, _, _) in self.journal.pending('upload', 10)])
+        self.assertEqual(2, self.journal.count('upload'))
+        self.assertEqual([], self.journal.pending('upload', 10))
+        # The statements of the key keep their order once the recorder replays again.
+        self.journal.done([row_id for (row_id, _, _) in self.journal.pending('recorder', 10)])
+        self.assertEqual(
+            [['url-a', 'a.h264'], ['url-a2', 'a.h264']],
+            [params for (_, _, params) in self.journal.pending('upload', 10)])
+
+    def test_statements_without_key_are_not_held_back(self):
+        self.journal.append('motion', INSERT, ('a.h264', 'pi', '2016-01-01 00:00:00'))
+        self.journal.append('upload', UPDATE, ('url-a', 'a.h264'))
+        self.assertEqual(1, len(self.journal.pending('upload', 10)))
+
+
+class EventWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.directory, 'journal.db'))
+        self.database = Database()
+        self.writers = []
+
+    def tearDown(self):
+        self.database.down = False
+        for writer in self.writers:
+            writer.close()
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def _writer(self, source: str) -> EventWriter:
+        writer = EventWriter(source, Pool(self.database), self.journal, batch_size=100, interval=60)
+        writer.retry = 0.05
+        self.writers.append(writer)
+        return writer
+
+    def test_idle_writer_flushes_after_interval(self):
+        writer = EventWriter('motion', Pool(self.database), self.journal, batch_size=100, interval=0.2)
+        self.writers.append(writer)
+        # The writer has been idle for a while when the first statement comes.
+        time.sleep(0.1)
+        writer.put(INSERT, ('a.h264', 'pi', '2016-01-01 00:00:00'), 'a.h264')
+        deadline = time.monotonic() + 3
+        while writer.stats()['written'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual({'pending': 0, 'written': 1, 'rejected': 0, 'batches': 1}, writer.stats())
+        self.assertEqual([INSERT], [statement for (statement, _) in self.database.executed])
+        # The next statement is not written before its interval.
+        writer.put(UPDATE, ('url-a', 'a.h264'), 'a.h264')
+        time.sleep(0.1)
+        self.assertEqual(1, writer.stats()['pending'])
+        time.sleep(0.5)
+        self.assertEqual(2, writer.stats()['written'])
+
+    def test_orphaned_statement_does_not_stop_the_writer(self):
+        self.journal.append('recorder', INSERT, ('a.h264', 'pi', '2016-01-01 00:00:00'), 'a.h264')
+        upload = self._writer('upload')
+        upload.shutdown_timeout = 0.2
+        upload.put(UPDATE, ('url-a', 'a.h264'), 'a.h264')
+        upload.put(UPDATE, ('url-b', 'b.h264'), 'b.h264')
+        self.assertFalse(upload.flush(0.3))
+        self.assertEqual([(UPDATE, ('url-b', 'b.h264'))], self.database.executed)
+        self.assertEqual(1, upload.stats()['pending'])
+
+    def test_update_replayed_after_insert_of_other_source(self):
+        motion = self._writer('motion')
+        upload = self._writer('upload')
+        self.database.down = True
+        motion.put(INSERT, ('a.h264', 'pi', '2016-01-01 00:00:00'), 'a.h264')
+        self.assertFalse(motion.flush(0.2))
+        # MySQL is back, but the insert of the motion daemon is still in the journal.
+        self.database.down = False
+        upload.put(UPDATE, ('url-a', 'a.h264'), 'a.h264')
+        self.assertFalse(upload.flush(0.2))
+        self.assertEqual([], self.database.executed)
+        self.assertTrue(motion.flush(5))
+        self.assertTrue(upload.flush(5))
+        self.assertEqual([INSERT, UPDATE], [statement for (statement, _) in self.database.executed])
+
+
+if __name__ == '__main__':
+    unittest.main()
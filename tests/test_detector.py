@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the motion detectors.
+    """
+
+from configparser import ConfigParser
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from motion import MotionDaemon
+from utils import settings
+from utils.camera import VECTOR_TYPE, vector_shape
+from utils.detector import BackgroundDetector, GridDetector, LoopDetector, NumpyDetector, VectorDetector, bitmap, \
+    configured, image_mask, polygon_mask, read_pgm, replay
+from utils.journal import Journal
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+RESOLUTION = (320, 240)
+
+
+def _frames(count: int = 6) -> list:
+    """ Noisy RGB frames, a bright block shows up in the third and the fourth one.
+        """
+    generator = numpy.random.RandomState(0)
+    base = generator.randint(0, 256, (48, 64, 3))
+    frames = []
+    for number in range(count):
+        frame = base + generator.randint(-6, 7, base.shape)
+        if number in (2, 3):
+            frame[10:30, 20:40] = 255
+        frames.append(numpy.clip(frame, 0, 255).astype(numpy.uint8))
+    return frames
+
+
+def _vectors(x: int = 0, y: int = 0) -> numpy.ndarray:
+    """ Still vectors with a 4x4 block moving by x and y.
+        """
+    vectors = numpy.zeros(vector_shape(RESOLUTION), dtype=VECTOR_TYPE)
+    vectors['x'][4:8, 6:10] = x
+    vectors['y'][4:8, 6:10] = y
+    return vectors
+
+
+class NumpyDetectorTest(unittest.TestCase):
+
+    def _motions(self, detector) -> list:
+        return [detector.feed(frame) for frame in _frames()][1:]
+
+    def test_same_decisions_as_loop(self):
+        # About a hundred pixels change by noise alone.
+        loop = self._motions(LoopDetector(sensitivity=200))
+        vectorized = self._motions(NumpyDetector(sensitivity=200))
+        self.assertEqual([False, True, False, True, False], [motion.detected for motion in vectorized])
+        self.assertEqual([motion.detected for motion in loop], [motion.detected for motion in vectorized])
+
+    def test_same_counts_as_loop(self):
+        # The loop stops counting early once it found motion, a sensitivity it never reaches makes it count all.
+        loop = self._motions(LoopDetector(sensitivity=sys.maxsize))
+        vectorized = self._motions(NumpyDetector(sensitivity=sys.maxsize))
+        self.assertEqual([motion.diff_cnt for motion in loop], [motion.diff_cnt for motion in vectorized])
+        self.assertTrue(all(motion.diff_cnt > 0 for motion in vectorized))
+
+    def test_no_motion_below_threshold(self):
+        frames = _frames()
+        for detector in (LoopDetector(threshold=30), NumpyDetector(threshold=30)):
+            detector.feed(frames[0])
+            motion = detector.feed(numpy.clip(frames[0].astype(numpy.int16) + 30, 0, 255).astype(numpy.uint8))
+            self.assertEqual((False, 0), (motion.detected, motion.diff_cnt))
+
+
+class Writer:
+    """ Stand-in for EventWriter applying the statements to a journal.
+        """
+
+    def __init__(self, journal: Journal):
+        self.journal = journal
+
+    def put(self, statement: str, params, key: str = None):
+        self.journal.append('test', statement, params, key)
+
+
+class GridDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.still = numpy.zeros((40, 80), dtype=numpy.uint8)
+
+    def _moved(self, top: int, left: int, size: int = 10) -> numpy.ndarray:
+        frame = self.still.copy()
+        frame[top:top + size, left:left + size] = 200
+        return frame
+
+    def test_active_cells(self):
+        detector = GridDetector(grid=(4, 8), cell_threshold=0.5)
+        detector.feed(self.still)
+        # A whole cell and a quarter of another one change.
+        frame = self._moved(10, 20)
+        frame[0:5, 0:5] = 200
+        motion = detector.feed(frame)
+        expected = numpy.zeros((4, 8), dtype=numpy.bool_)
+        expected[1, 2] = True
+        numpy.testing.assert_array_equal(expected, motion.cells)
+        self.assertTrue(motion.detected)
+        self.assertEqual(125, motion.diff_cnt)
+
+    def test_per_cell_thresholds(self):
+        thresholds = numpy.full((4, 8), 0.5)
+        thresholds[0, 0] = 0.2
+        thresholds[1, 2] = 1.0
+        detector = GridDetector(grid=(4, 8), cell_threshold=thresholds)
+        detector.feed(self.still)
+        frame = self._moved(10, 20)
+        frame[0:5, 0:5] = 200
+        motion = detector.feed(frame)
+        self.assertEqual([(0, 0)], list(zip(*numpy.nonzero(motion.cells))))
+
+    def test_masked_cells_are_ignored(self):
+        mask = numpy.ones((4, 8), dtype=numpy.bool_)
+        mask[1, 2] = False
+        detector = GridDetector(grid=(4, 8), cell_threshold=0.5, mask=mask)
+        detector.feed(self.still)
+        motion = detector.feed(self._moved(10, 20))
+        self.assertFalse(motion.detected)
+        self.assertEqual(0, motion.diff_cnt)
+
+    def test_min_cells(self):
+        detector = GridDetector(grid=(4, 8), cell_threshold=0.5, min_cells=2)
+        detector.feed(self.still)
+        self.assertFalse(detector.feed(self._moved(10, 20)).detected)
+        self.assertTrue(detector.feed(self._moved(10, 20, 20)).detected)
+
+
+class BackgroundDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = numpy.random.RandomState(0)
+        self.scene = self.generator.randint(40, 200, (48, 64)).astype(numpy.float32)
+
+    def _frame(self, brightness: float = 0, blob: bool = False) -> numpy.ndarray:
+        frame = self.scene + brightness + self.generator.normal(0, 1.5, self.scene.shape)
+        if blob:
+            frame[10:30, 20:40] = 255
+        return numpy.clip(frame, 0, 255).astype(numpy.uint8)
+
+    def test_illumination_drift_is_absorbed(self):
+        detector = BackgroundDetector(sensitivity=50, learning_rate=0.1)
+        detector.feed(self._frame())
+        # The scene gets brighter by 40 levels over 80 frames, e.g. at sunrise.
+        motions = [detector.feed(self._frame(number / 2)) for number in range(1, 81)]
+        self.assertFalse(any(motion.detected for motion in motions))
+        self.assertTrue(detector.feed(self._frame(40, blob=True)).detected)
+
+    def test_drift_without_compensation_is_learned(self):
+        detector = BackgroundDetector(sensitivity=50, learning_rate=0.2, compensate=False)
+        detector.feed(self._frame())
+        motions = [detector.feed(self._frame(number / 4)) for number in range(1, 81)]
+        self.assertFalse(any(motion.detected for motion in motions))
+
+    def test_sudden_blob_is_detected(self):
+        detector = BackgroundDetector(sensitivity=50)
+        detector.feed(self._frame())
+        for _ in range(10):
+            self.assertFalse(detector.feed(self._frame()).detected)
+        motion = detector.feed(self._frame(blob=True))
+        self.assertTrue(motion.detected)
+        self.assertGreater(motion.diff_cnt, 300)
+
+    def test_reset_relearns_background(self):
+        detector = BackgroundDetector(sensitivity=50, learning_rate=0.01)
+        detector.feed(self._frame())
+        self.assertTrue(detector.feed(self._frame(blob=True)).detected)
+        # The blob stays, with a slow learning rate it is still motion a few frames later.
+        self.assertTrue(detector.feed(self._frame(blob=True)).detected)
+        detector.reset()
+        self.assertIsNone(detector.feed(self._frame(blob=True)))
+        self.assertFalse(detector.feed(self._frame(blob=True)).detected)
+        self.assertTrue(detector.feed(self._frame()).detected)
+
+
+class MaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_polygon_inside_and_outside(self):
+        # The left half and a triangle in the bottom right corner.
+        polygons = [[(0, 0), (0.5, 0), (0.5, 1), (0, 1)], [(1, 0.6), (1, 1), (0.6, 1)]]
+        mask = polygon_mask(polygons, (4, 4))
+        numpy.testing.assert_array_equal(numpy.array([
+            [True, True, False, False],
+            [True, True, False, False],
+            [True, True, False, False],
+            [True, True, False, True]]), mask)
+
+    def test_concave_polygon(self):
+        # An U shape, the cells of the gap are outside.
+        polygon = [(0, 0), (0.25, 0), (0.25, 0.75), (0.75, 0.75), (0.75, 0), (1, 0), (1, 1), (0, 1)]
+        mask = polygon_mask([polygon], (4, 4))
+        self.assertFalse(mask[0:3, 1:3].any())
+        self.assertTrue(mask[:, 0].all() and mask[:, 3].all() and mask[3].all())
+
+    def test_pgm_with_comment(self):
+        filename = os.path.join(self.directory, 'mask.pgm')
+        image = numpy.zeros((20, 40), dtype=numpy.uint8)
+        image[:, 20:] = 255
+        with open(filename, 'wb') as file:
+            file.write(b'P5\n# CREATOR: GIMP PNM Filter Version 1.1\n40 20\n# the maximum\n255\n' + image.tobytes())
+        numpy.testing.assert_array_equal(image, read_pgm(filename))
+        mask = image_mask(read_pgm(filename), (2, 4))
+        numpy.testing.assert_array_equal(numpy.array([[False, False, True, True]] * 2), mask)
+
+    def test_16_bit_pgm(self):
+        filename = os.path.join(self.directory, 'mask.pgm')
+        image = (numpy.arange(6).reshape(2, 3) * 1000).astype('>u2')
+        with open(filename, 'wb') as file:
+            file.write(b'P5 3 2 65535\n' + image.tobytes())
+        numpy.testing.assert_array_equal(image, read_pgm(filename))
+
+    def test_not_pgm(self):
+        filename = os.path.join(self.directory, 'mask.pgm')
+        with open(filename, 'wb') as file:
+            file.write(b'P2\n3 2\n255\n0 0 0 0 0 0\n')
+        with self.assertRaises(ValueError):
+            read_pgm(filename)
+
+    def test_bitmap_round_trip(self):
+        cells = numpy.zeros((3, 5), dtype=numpy.bool_)
+        cells[0, 0] = cells[1, 3] = cells[2, 4] = True
+        self.assertEqual('8082', bitmap(cells))
+        clip = os.path.join(self.directory, 'clip.h264')
+        with open(clip, 'wb') as file:
+            file.write(bytes(100))
+        journal = Journal(os.path.join(self.directory, 'journal.db'))
+        try:
+            MotionDaemon._store(Writer(journal), clip, 3, cells)
+            (stored,) = journal.query("SELECT cells FROM events WHERE file = %s", (clip,))[0]
+        finally:
+            journal.close()
+        unpacked = numpy.unpackbits(numpy.frombuffer(bytes.fromhex(stored), dtype=numpy.uint8))
+        numpy.testing.assert_array_equal(cells, unpacked[:cells.size].reshape(cells.shape).astype(numpy.bool_))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        (handle, self.filename) = tempfile.mkstemp(suffix='.data')
+        self.frames = [_vectors(), _vectors(20, 0), _vectors(-128, -128), _vectors(127, 127), _vectors()]
+        with os.fdopen(handle, 'wb') as file:
+            for frame in self.frames:
+                # The layout picamera writes to motion_output, one array per frame.
+                file.write(frame.tobytes())
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_replay_reads_every_frame(self):
+        replayed = list(replay(self.filename, RESOLUTION))
+        self.assertEqual(len(self.frames), len(replayed))
+        for (frame, expected) in zip(replayed, self.frames):
+            numpy.testing.assert_array_equal(expected, frame)
+
+    def test_detection_on_replayed_vectors(self):
+        detector = VectorDetector(sensitivity=5, magnitude=10, cluster=4)
+        motions = [detector.feed(frame) for frame in replay(self.filename, RESOLUTION)]
+        self.assertEqual([False, True, True, True, False], [motion.detected for motion in motions])
+        self.assertEqual([0, 16, 16, 16, 0], [motion.diff_cnt for motion in motions])
+
+    def test_setting_in_any_case(self):
+        config = ConfigParser()
+        config.read_dict({'Motion': {'Detector': 'Vectors'}})
+        with mock.patch.object(settings.Settings, 'config', config):
+            self.assertIsInstance(configured(), VectorDetector)
+            # The session delivers the motion vectors the detector expects.
+            self.assertTrue(MotionDaemon._session_options()['vectors'])
+
+    def test_saturated_vectors_are_moving(self):
+        # 128 squared twice does not fit into 16 bits.
+        motion = VectorDetector(sensitivity=0, magnitude=127, cluster=1).feed(_vectors(-128, -128))
+        self.assertEqual(16, motion.diff_cnt)
+
+
+if __name__ == '__main__':
+    unittest.main()
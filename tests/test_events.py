@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the paginated listing of the events on the local journal.
+    """
+
+from base64 import urlsafe_b64encode
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import bottle
+
+import routes
+from utils.events import Filter, decode_cursor, encode_cursor, locations, page
+from utils.journal import Journal
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+INSERT = "INSERT INTO events(file, location, size, time) VALUES (%s, %s, %s, %s)"
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        value = encode_cursor(datetime.datetime(2016, 5, 1, 12, 30), '/home/pi/picam/Ünnep 1.h264')
+        self.assertEqual(('2016-05-01 12:30:00', '/home/pi/picam/Ünnep 1.h264'), decode_cursor(value))
+
+    def test_malformed(self):
+        for value in (None, '', 'garbage!', '%%%', urlsafe_b64encode(b'not json').decode(),
+                      urlsafe_b64encode(b'["2016-05-01"]').decode(), urlsafe_b64encode(b'5').decode(),
+                      urlsafe_b64encode(b'\xff\xfe').decode()):
+            self.assertIsNone(decode_cursor(value), value)
+
+
+class PageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.directory, 'journal.db'))
+        self.events = []
+        start = datetime.datetime(2016, 5, 1, 12)
+        for number in range(12):
+            # Three events at every time stamp, only the file tells them apart.
+            event_time = start + datetime.timedelta(days=number // 6, minutes=number // 3)
+            for camera in ('cellar', 'garden', 'tearoom'):
+                file = '/picam/{}-{:02d}.h264'.format(camera, number)
+                self.journal.append('test', INSERT, (file, camera, 1000, event_time))
+                self.events.append((str(event_time), file))
+        self.events.sort(reverse=True)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def _all(self, condition: Filter, limit: int) -> list:
+        pages = []
+        cursor = None
+        while True:
+            (rows, cursor) = page(self.journal, condition, cursor, limit)
+            pages.append([(row_time, file) for (file, _, row_time, _, _) in rows])
+            if cursor is None:
+                return pages
+            # The cursor is passed through the URL.
+            cursor = decode_cursor(encode_cursor(*cursor))
+
+    def test_ties_are_split_by_file(self):
+        # Pages of two split the groups of three events of the same time.
+        pages = self._all(Filter(), 2)
+        self.assertEqual(18, len(pages))
+        self.assertTrue(all(len(rows) == 2 for rows in pages))
+        self.assertEqual(self.events, [event for rows in pages for event in rows])
+
+    def test_last_page_full(self):
+        pages = self._all(Filter(), 12)
+        self.assertEqual([12, 12, 12], [len(rows) for rows in pages])
+
+    def test_filtered(self):
+        pages = self._all(Filter('garden', until=datetime.date(2016, 5, 1)), 4)
+        expected = [(row_time, file) for (row_time, file) in self.events
+                    if 'garden' in file and row_time < '2016-05-02']
+        self.assertEqual(6, len(expected))
+        self.assertEqual(expected, [event for rows in pages for event in rows])
+        self.assertEqual(['cellar', 'garden', 'tearoom'], locations(self.journal))
+
+    def test_malformed_after_shows_first_page(self):
+        routes.cache.clear()
+        bottle.request.bind({'QUERY_STRING': 'location=garden&after=garbage!'})
+        with mock.patch.object(routes, 'journal', self.journal):
+            result = routes.home.__wrapped__()
+        self.assertEqual(12, len(result['events']))
+        self.assertEqual({'location': 'garden'}, result['filter'])
+        self.assertEqual('location=garden', result['first'])
+        self.assertIsNone(result['next'])
+
+    def test_next_link(self):
+        routes.cache.clear()
+        with mock.patch.object(routes, 'journal', self.journal), mock.patch('routes.page') as limited:
+            limited.side_effect = lambda database, condition, cursor: page(database, condition, cursor, 10)
+            bottle.request.bind({'QUERY_STRING': ''})
+            first = routes.home.__wrapped__()
+            bottle.request.bind({'QUERY_STRING': first['next']})
+            second = routes.home.__wrapped__()
+        self.assertIsNone(first['first'])
+        self.assertEqual(10, len(first['events']))
+        self.assertEqual(10, len(second['events']))
+        self.assertEqual([row_time for (row_time, _) in self.events[10:20]],
+                         [event['time'] for event in second['events']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the recording across processes.
+    """
+
+import io
+import multiprocessing
+import queue
+import threading
+import unittest
+
+from utils.camera import CameraError
+from utils.pipeline import PipeFile, RemoteSession
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+
+class Recording(io.BytesIO):
+    """ Output file keeping its content after close().
+        """
+
+    def close(self):
+        self.content = self.getvalue()
+        super().close()
+
+
+class RemoteSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = queue.Queue()
+        (self.receiver, self.sender) = multiprocessing.Pipe(duplex=False)
+        self.session = RemoteSession(self.commands, self.receiver)
+        self.session.timeout = 0.2
+
+    def test_record(self):
+        def camera():
+            (recording, _) = self.commands.get()
+            file = PipeFile(self.sender, recording)
+            file.write(b'first')
+            file.write(b'')
+            file.write(b'second')
+            file.close()
+
+        threading.Thread(target=camera).start()
+        recording = Recording()
+        self.session.record(recording, 0)
+        self.assertEqual(b'firstsecond', recording.content)
+
+    def test_tail_of_timed_out_recording_is_dropped(self):
+        with self.assertRaises(CameraError):
+            self.session.record(Recording(), 0)
+        # The camera process finishes the abandoned recording late, then the next one.
+        (late, _) = self.commands.get_nowait()
+        file = PipeFile(self.sender, late)
+        file.write(b'stale')
+        file.close()
+
+        def camera():
+            (recording, _) = self.commands.get()
+            file = PipeFile(self.sender, recording)
+            file.write(b'fresh')
+            file.close()
+
+        threading.Thread(target=camera).start()
+        recording = Recording()
+        self.session.record(recording, 0)
+        self.assertEqual(b'fresh', recording.content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the stream health checks against local servers.
+    """
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import socket
+import threading
+import time
+import unittest
+
+from utils.prober import Prober
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ Answers OK, after delay seconds.
+        """
+
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', 2)
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+
+class SlowHandler(Handler):
+    delay = 2
+
+
+def _serve(handler) -> HTTPServer:
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _closed_port() -> int:
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+class ProberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [_serve(Handler), _serve(SlowHandler)]
+        (self.up, self.slow) = ['http://127.0.0.1:{}/'.format(server.server_port) for server in self.servers]
+        self.dead = 'http://127.0.0.1:{}/'.format(_closed_port())
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_up_slow_and_dead(self):
+        prober = Prober([self.up, self.slow, self.dead], timeout=0.5)
+        try:
+            started = time.monotonic()
+            prober.probe()
+            # The checks run concurrently, the slow one does not hold up the others.
+            self.assertLess(time.monotonic() - started, 1.5)
+            self.assertTrue(prober.up(self.up))
+            self.assertEqual(200, prober.status()[self.up]['status'])
+            self.assertFalse(prober.up(self.slow))
+            self.assertFalse(prober.up(self.dead))
+            self.assertFalse(prober.up('http://127.0.0.1:1/unknown'))
+        finally:
+            prober.stop()
+
+    def test_first_status_does_not_wait_forever(self):
+        prober = Prober([self.slow], timeout=0.2)
+        # The first round can not finish, e.g. it is stuck resolving a name.
+        prober.start = lambda: None
+        started = time.monotonic()
+        self.assertEqual({}, prober.status())
+        self.assertLess(time.monotonic() - started, 1)
+        prober.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
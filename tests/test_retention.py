@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the retention of the clips.
+    """
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.journal import Journal
+from utils.retention import Retention
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+INSERT = "INSERT INTO events(file, location, time) VALUES (%s, %s, %s)"
+UPLOADED = "UPDATE events SET url = %s, uploaded = %s WHERE file = %s"
+
+
+class Writer:
+    """ Stand-in for EventWriter applying the statements to its journal only.
+        """
+
+    def __init__(self, journal: Journal):
+        self.journal = journal
+        self.statements = []
+
+    def put(self, statement: str, params, key: str = None):
+        self.statements.append((statement, tuple(params), key))
+        self.journal.append('test', statement, params, key)
+
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.directory, 'journal.db'))
+        self.writer = Writer(self.journal)
+        # Ten clips of 100 bytes a minute apart, the fifth and the eighth are uploaded.
+        self.clips = []
+        for number in range(10):
+            clip = self._clip('{:02d}.h264'.format(number), 100, 1462100000 + 60 * number)
+            self.journal.append('test', INSERT, (clip, 'pi', '2016-05-01 12:{:02d}:00'.format(number)))
+            if number in (4, 7):
+                self.journal.append('test', UPLOADED, ('https://db.tt/' + str(number), '2016-05-01', clip))
+            self.clips.append(clip)
+        self._clip('notes.txt', 5000, 1462000000)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def _clip(self, name: str, size: int, modified: float) -> str:
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as file:
+            file.write(bytes(size))
+        os.utime(filename, (modified, modified))
+        return filename
+
+    def _kept(self) -> list:
+        return [clip for clip in self.clips if os.path.exists(clip)]
+
+    def test_within_quota(self):
+        retention = Retention(self.directory, self.writer, quota=1000, min_free=0)
+        self.assertEqual(0, retention.enforce())
+        self.assertEqual(self.clips, self._kept())
+        self.assertEqual([], self.writer.statements)
+
+    def test_uploaded_clips_go_first(self):
+        retention = Retention(self.directory, self.writer, quota=800, min_free=0)
+        self.assertEqual(200, retention.enforce())
+        self.assertEqual([clip for (number, clip) in enumerate(self.clips) if number not in (4, 7)], self._kept())
+        # Then the oldest ones never uploaded.
+        retention.quota = 600
+        self.assertEqual(200, retention.enforce())
+        self.assertEqual(self.clips[2:4] + self.clips[5:7] + self.clips[8:], self._kept())
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'notes.txt')))
+
+    def test_reserve(self):
+        retention = Retention(self.directory, self.writer, quota=1000, min_free=0)
+        # Room for a clip of 250 bytes takes deleting three.
+        self.assertEqual(300, retention.enforce(250))
+        self.assertEqual({'files': 7, 'bytes': 700, 'evicted': 3, 'freed': 300},
+                         {key: value for (key, value) in retention.stats().items() if key != 'free'})
+        self.assertEqual(0, retention.enforce(300))
+
+    def test_free_space_floor(self):
+        retention = Retention(self.directory, self.writer, quota=0, min_free=10000)
+        with mock.patch.object(Retention, 'free', return_value=9750):
+            self.assertEqual(300, retention.enforce())
+        self.assertEqual(self.clips[4], self.writer.statements[0][2])
+        self.assertEqual(7, len(self._kept()))
+
+    def test_added_clips_count(self):
+        retention = Retention(self.directory, self.writer, quota=1200, min_free=0)
+        clip = self._clip('10.h264', 300, 1462100600)
+        retention.add(clip)
+        retention.add(os.path.join(self.directory, 'gone.h264'))
+        self.assertEqual(1300, retention.stats()['bytes'])
+        self.assertEqual(100, retention.enforce())
+
+    def test_evicted_update_written(self):
+        retention = Retention(self.directory, self.writer, quota=900, min_free=0)
+        retention.enforce()
+        ((statement, params, key),) = self.writer.statements
+        self.assertTrue(statement.startswith("UPDATE events SET evicted = %s"))
+        self.assertEqual(self.clips[4], key)
+        self.assertEqual(self.clips[4], params[-1])
+        rows = self.journal.query("SELECT file FROM events WHERE evicted IS NOT NULL")
+        self.assertEqual([(self.clips[4],)], rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the order of the uploads and of the rate limit.
+    """
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from utils.journal import Journal
+from utils.scheduler import Scheduler, TokenBucket
+from utils.uploads import UploadIndex
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+INSERT = "INSERT INTO events(file, location, diff_cnt, time) VALUES (%s, %s, %s, %s)"
+
+
+class RankTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.directory, 'journal.db'))
+        self.index = UploadIndex(os.path.join(self.directory, 'uploads.db'))
+        self.scheduler = Scheduler(self.journal, bitrate=8000)  # short clips up to 30000 bytes
+
+    def tearDown(self):
+        self.index.close()
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def _add(self, name: str, size: int, diff: int = None):
+        file = os.path.join(self.directory, name)
+        if diff is not None:
+            self.journal.append('test', INSERT, (file, 'test', diff, '2016-01-01 00:00:00'))
+        self.index.add(file, size)
+        return file
+
+    def test_short_clips_first_by_changed_pixels(self):
+        files = [
+            self._add('long_busy.h264', 90000, 5000),
+            self._add('short_quiet.h264', 10000, 10),
+            self._add('short_unknown.h264', 20000),
+            self._add('short_busy.h264', 20000, 800),
+            self._add('long_quiet.h264', 60000, 20),
+            self._add('short_quiet_later.h264', 10000, 10)
+        ]
+        order = [os.path.basename(file) for file in self.index.claim(rank=self.scheduler.rank)]
+        self.assertEqual(['short_busy.h264', 'short_quiet.h264', 'short_quiet_later.h264', 'short_unknown.h264',
+                          'long_busy.h264', 'long_quiet.h264'], order)
+        self.assertEqual(len(files), len(self.scheduler.added))
+
+    def test_claim_one_at_a_time(self):
+        self._add('long.h264', 90000, 5000)
+        self._add('short.h264', 10000, 10)
+        self.assertEqual(['short.h264'], [os.path.basename(file) for file in self.index.claim(1, self.scheduler.rank)])
+        late = self._add('late.h264', 10000, 100)
+        self.assertEqual([late], self.index.claim(1, self.scheduler.rank))
+        self.assertEqual(['long.h264'], [os.path.basename(file) for file in self.index.claim(1, self.scheduler.rank)])
+        self.assertEqual([], self.index.claim(1, self.scheduler.rank))
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        bucket = TokenBucket()
+        started = time.monotonic()
+        for _ in range(1000):
+            self.assertTrue(bucket.take(1 << 20))
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_paused(self):
+        bucket = TokenBucket(0)
+        started = time.monotonic()
+        self.assertFalse(bucket.take(1, 0.2))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_pacing(self):
+        bucket = TokenBucket(100000, 10000)
+        started = time.monotonic()
+        for _ in range(30):
+            self.assertTrue(bucket.take(10000))
+        # The bucket starts empty, 300000 bytes take 3 seconds.
+        self.assertAlmostEqual(3.0, time.monotonic() - started, delta=0.3)
+
+    def test_shared_by_threads(self):
+        bucket = TokenBucket(100000, 10000)
+
+        def send():
+            for _ in range(10):
+                bucket.take(10000)
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=send) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertAlmostEqual(3.0, time.monotonic() - started, delta=0.3)
+
+    def test_rate_change_wakes_up(self):
+        bucket = TokenBucket(0)
+        threading.Timer(0.2, bucket.set_rate, (None,)).start()
+        started = time.monotonic()
+        self.assertTrue(bucket.take(1 << 20, 5))
+        self.assertLess(time.monotonic() - started, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the snapshots of the stream server.
+    """
+
+from http.client import HTTPConnection
+import threading
+import time
+import unittest
+from unittest import mock
+
+try:
+    import stream
+except ImportError:
+    # picamera is only available on the Raspberry Pi.
+    stream = None
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+FRAME = b'\xff\xd8stream frame\xff\xd9'
+FULL = b'\xff\xd8full resolution\xff\xd9'
+
+
+def _producer(hub):
+    """ Publishes one frame of each channel, then idles like a camera without new frames.
+        """
+    for (channel, _) in stream.CHANNELS:
+        hub.publish(FRAME + channel.encode('ascii'), channel)
+    while hub.active():
+        time.sleep(0.01)
+
+
+class Camera:
+    """ Stand-in for PiCamera taking full resolution pictures.
+        """
+
+    paused = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def capture(self, output, image_format: str):
+        # The stream is paused during the capture.
+        self.paused.append(stream.hub.paused)
+        output.write(FULL)
+
+
+@unittest.skipIf(stream is None, "picamera is not installed")
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in (mock.patch.object(stream.hub, 'producer', _producer),
+                        mock.patch.object(stream.hub, 'idle_timeout', 0.1),
+                        mock.patch.object(stream.picamera, 'PiCamera', Camera, create=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server = stream.ThreadedHTTPServer(('127.0.0.1', 0), stream.CamHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.connection = HTTPConnection(*self.server.server_address, timeout=10)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        # Let the producer exit before the next test replaces it.
+        while stream.hub.thread is not None:
+            time.sleep(0.01)
+
+    def _get(self, path: str, headers: dict = None) -> tuple:
+        self.connection.request('GET', path, headers=headers or {})
+        response = self.connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+
+    def test_latest_frame(self):
+        (status, headers, body) = self._get('/cam.jpg')
+        self.assertEqual(200, status)
+        self.assertEqual('image/jpeg', headers['Content-Type'])
+        self.assertEqual(FRAME + b'cam', body)
+        (status, _, body) = self._get('/thumb.jpg')
+        self.assertEqual(FRAME + b'thumb', body)
+
+    def test_not_modified_by_etag(self):
+        (_, headers, _) = self._get('/cam.jpg')
+        etag = headers['ETag']
+        (status, headers, body) = self._get('/cam.jpg', {'If-None-Match': 'W/"other", ' + etag})
+        self.assertEqual(304, status)
+        self.assertEqual(etag, headers['ETag'])
+        self.assertEqual(b'', body)
+        (status, _, body) = self._get('/cam.jpg', {'If-None-Match': '"other"'})
+        self.assertEqual(200, status)
+        self.assertEqual(FRAME + b'cam', body)
+        # The thumbnail is a different frame.
+        (status, _, _) = self._get('/thumb.jpg', {'If-None-Match': etag})
+        self.assertEqual(200, status)
+
+    def test_not_modified_since(self):
+        (_, headers, _) = self._get('/cam.jpg')
+        (status, _, body) = self._get('/cam.jpg', {'If-Modified-Since': headers['Last-Modified']})
+        self.assertEqual(304, status)
+        self.assertEqual(b'', body)
+        (status, _, _) = self._get('/cam.jpg', {'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'})
+        self.assertEqual(200, status)
+        (status, _, _) = self._get('/cam.jpg', {'If-Modified-Since': 'yesterday'})
+        self.assertEqual(200, status)
+
+    def test_full_resolution(self):
+        Camera.paused.clear()
+        (status, headers, body) = self._get('/full.jpg')
+        self.assertEqual(200, status)
+        self.assertEqual('image/jpeg', headers['Content-type'])
+        self.assertEqual(FULL, body)
+        self.assertEqual([1], Camera.paused)
+        self.assertEqual(0, stream.hub.paused)
+        # The stream goes on afterwards.
+        (status, _, body) = self._get('/cam.jpg')
+        self.assertEqual(FRAME + b'cam', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the chunked uploads against the local stand-in of Dropbox.
+    """
+
+import filecmp
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.uploader import ChunkedUpload, LocalStorage, Uploader
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+CHUNK = 64 * 1024
+
+
+class FlakyStorage(LocalStorage):
+    """ LocalStorage becoming unreachable after a number of chunks.
+        """
+
+    def __init__(self, directory: str, **options):
+        super().__init__(directory, **options)
+        self.chunks_left = None
+        self.sent = 0
+
+    def upload_chunk(self, file_obj, length=None, offset=0, upload_id=None) -> tuple:
+        if self.chunks_left is not None:
+            if self.chunks_left <= 0:
+                raise OSError("Network is unreachable")
+            self.chunks_left -= 1
+        self.sent += len(file_obj)
+        return super().upload_chunk(file_obj, length, offset, upload_id)
+
+
+class UploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.filename = os.path.join(self.local, 'clip.h264')
+        with open(self.filename, 'wb') as file:
+            file.write(os.urandom(10 * CHUNK + 123))
+        patcher = mock.patch.object(ChunkedUpload, 'backoff', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def test_lost_responses_are_resumed(self):
+        storage = LocalStorage(self.remote, failure_rate=0.3)
+        upload = ChunkedUpload(storage, self.filename, '/clip.h264', CHUNK)
+        upload.attempts = 100
+        metadata = upload.run()
+        self.assertEqual(os.path.getsize(self.filename), metadata['bytes'])
+        self.assertTrue(filecmp.cmp(self.filename, storage._path('/clip.h264'), shallow=False))
+
+    def test_given_up_upload_resumes_from_offset(self):
+        storage = FlakyStorage(self.remote)
+        storage.chunks_left = 4
+        uploader = Uploader(storage, 1, CHUNK)
+        try:
+            with mock.patch('sys.stderr'):
+                self.assertEqual([], list(uploader.upload([(self.filename, '/clip.h264')])))
+            session = uploader.sessions[self.filename]
+            self.assertEqual(4 * CHUNK, session.offset)
+            self.assertFalse(os.path.exists(storage._path('/clip.h264')))
+            # The next cycle continues the same upload session.
+            storage.chunks_left = None
+            storage.sent = 0
+            uploaded = list(uploader.upload([(self.filename, '/clip.h264')]))
+            self.assertEqual([self.filename], [filename for (filename, _, _) in uploaded])
+            self.assertEqual(os.path.getsize(self.filename) - 4 * CHUNK, storage.sent)
+            self.assertTrue(filecmp.cmp(self.filename, storage._path('/clip.h264'), shallow=False))
+            self.assertEqual({}, uploader.sessions)
+        finally:
+            uploader.close()
+
+    def test_drain_keeps_the_workers_busy(self):
+        files = [self.filename]
+        for name in ('a', 'b', 'c'):
+            files.append(os.path.join(self.local, '{}.h264'.format(name)))
+            with open(files[-1], 'wb') as file:
+                file.write(os.urandom(CHUNK // 2))
+        queue = list(files)
+
+        def claim() -> tuple:
+            return (queue[0], '/' + os.path.basename(queue.pop(0))) if queue else None
+
+        # The long clip takes 11 requests, the short ones are done by the other worker meanwhile.
+        uploader = Uploader(LocalStorage(self.remote, latency=0.05), 2, CHUNK)
+        try:
+            uploaded = [filename for (filename, _, _) in uploader.drain(claim, 0.1)]
+        finally:
+            uploader.close()
+        self.assertEqual(files[1:] + files[:1], uploaded)
+        for filename in files:
+            self.assertTrue(filecmp.cmp(filename, os.path.join(self.remote, os.path.basename(filename)), False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Tests of the upload queue and of the clips uploaded while recording.
+    """
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from motion import MotionCapture, MotionDaemon
+from utils.camera import CameraError
+from utils.database import EventWriter
+from utils.uploader import LocalStorage
+from utils.uploads import DONE, LIVE, PENDING, UPLOADING, ClipWatcher, RemoteManifest, UploadIndex
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+
+class Session:
+    """ Stand-in for CameraSession writing a fixed clip, or failing after the first half of it.
+        """
+
+    def __init__(self, test: 'LiveUploadTest', fail: bool = False):
+        self.test = test
+        self.fail = fail
+        self.data = os.urandom(300 * 1024)
+
+    def record(self, output, duration: int):
+        output.write(self.data[:len(self.data) // 2])
+        # The upload daemon sees the clip while it is recorded.
+        self.test.check_live(output.name)
+        if self.fail:
+            raise CameraError("No frame in 30 seconds")
+        output.write(self.data[len(self.data) // 2:])
+        output.close()
+
+
+class SlowStorage(LocalStorage):
+    """ LocalStorage sending the chunks only when sent is set and committing only when committed is set.
+        """
+
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.sent = threading.Event()
+        self.committed = threading.Event()
+
+    def upload_chunk(self, *args, **kwargs):
+        self.sent.wait(10)
+        return super().upload_chunk(*args, **kwargs)
+
+    def commit_chunked_upload(self, *args, **kwargs) -> dict:
+        self.committed.wait(10)
+        return super().commit_chunked_upload(*args, **kwargs)
+
+
+class Writer:
+    """ Stand-in for EventWriter keeping the statements.
+        """
+
+    def __init__(self):
+        self.statements = []
+
+    def put(self, statement: str, params, key=None):
+        self.statements.append((statement, params, key))
+
+
+class UploadIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = UploadIndex(os.path.join(self.directory, 'uploads.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_opening_keeps_claimed_clips(self):
+        self.index.add('/clips/a.h264', 1000)
+        self.assertEqual(['/clips/a.h264'], self.index.claim())
+        # E.g. the motion daemon opens the index while the upload daemon is uploading.
+        other = UploadIndex(self.index.filename)
+        try:
+            self.assertEqual(UPLOADING, other.state('/clips/a.h264'))
+            self.assertEqual([], other.claim())
+        finally:
+            other.close()
+
+    def test_recover_interrupted_uploads(self):
+        for name in ('a', 'b', 'c'):
+            self.index.add('/clips/{}.h264'.format(name), 1000)
+        self.index.claim(2)
+        self.index.done('/clips/a.h264')
+        self.index.close()
+        # The upload daemon was stopped while uploading b.
+        self.index = UploadIndex(self.index.filename)
+        self.assertEqual(1, self.index.recover())
+        self.assertEqual(['/clips/b.h264', '/clips/c.h264'], self.index.claim())
+
+    def test_live_clips_are_not_claimed(self):
+        self.assertTrue(self.index.live('/clips/live.h264'))
+        self.assertFalse(self.index.add('/clips/live.h264', 1000))
+        self.assertTrue(self.index.add('/clips/queued.h264', 1000))
+        self.assertEqual(['/clips/queued.h264'], self.index.claim())
+        self.assertEqual(LIVE, self.index.state('/clips/live.h264'))
+
+    def test_live_clip_done(self):
+        self.index.live('/clips/live.h264')
+        self.index.done('/clips/live.h264', 'https://db.tt/live')
+        self.assertEqual(DONE, self.index.state('/clips/live.h264'))
+        self.assertEqual([], self.index.claim())
+
+    def test_live_clip_released(self):
+        self.index.live('/clips/live.h264')
+        self.index.release('/clips/live.h264')
+        self.assertEqual(['/clips/live.h264'], self.index.claim())
+        self.assertEqual(UPLOADING, self.index.state('/clips/live.h264'))
+
+    def test_abandoned_live_clip_is_queued(self):
+        self.index.live('/clips/live.h264')
+        self.index.live_timeout = 0
+        time.sleep(0.01)
+        self.assertEqual(['/clips/live.h264'], self.index.claim())
+
+
+class RemoteManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.storage = LocalStorage(self.remote)
+        self.filename = os.path.join(self.local, 'uploads.db')
+        self.manifest = RemoteManifest(self.filename)
+        # Ten clips of 100 bytes a minute apart, stored in random order.
+        for number in (3, 7, 0, 9, 1, 5, 8, 2, 6, 4):
+            self._store('/{:02d}.h264'.format(number), 100, 1462100000 + 60 * number)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def _store(self, remote_name: str, size: int, modified: float):
+        filename = os.path.join(self.remote, remote_name.lstrip('/'))
+        with open(filename, 'wb') as file:
+            file.write(bytes(size))
+        os.utime(filename, (modified, modified))
+
+    def _upload(self, remote_name: str, size: int) -> dict:
+        (_, upload_id) = self.storage.upload_chunk(bytes(size))
+        return self.storage.commit_chunked_upload(remote_name, upload_id)
+
+    def test_sync_and_oldest(self):
+        self.manifest.sync(self.storage)
+        self.assertEqual((10, 1000), (len(self.manifest.files), self.manifest.total))
+        self.assertEqual([], self.manifest.oldest(1001))
+        # Fitting into 750 bytes takes deleting the three oldest ones.
+        self.assertEqual(['/00.h264', '/01.h264', '/02.h264'], self.manifest.oldest(751))
+        # They stay until they are really deleted.
+        self.assertEqual(['/00.h264', '/01.h264', '/02.h264'], self.manifest.oldest(751))
+        self.assertEqual(['/00.h264'], self.manifest.oldest(1000))
+
+    def test_added_and_removed(self):
+        self.manifest.sync(self.storage)
+        metadata = self._upload('/10.h264', 500)
+        self.manifest.added(metadata)
+        self.assertEqual(1500, self.manifest.total)
+        self.manifest.removed(['/00.h264', '/01.H264'])
+        self.assertEqual(1300, self.manifest.total)
+        self.assertEqual(['/02.h264', '/03.h264'], self.manifest.oldest(1200))
+        # The changes of the daemon itself come back in the delta, applying them again changes nothing.
+        for remote_name in ('/00.h264', '/01.h264'):
+            self.storage.file_delete(remote_name)
+        self.manifest.sync(self.storage)
+        self.assertEqual((9, 1300), (len(self.manifest.files), self.manifest.total))
+
+    def test_delta_of_other_clients(self):
+        self.manifest.sync(self.storage)
+        cursor = self.manifest.cursor
+        # Someone else deleted the oldest clip and replaced the second oldest with a new version.
+        self.storage.file_delete('/00.h264')
+        self._upload('/01.h264', 300)
+        self.manifest.sync(self.storage)
+        self.assertNotEqual(cursor, self.manifest.cursor)
+        self.assertEqual(1100, self.manifest.total)
+        # The replaced clip is the newest now, its old heap entry is skipped.
+        self.assertEqual(['/02.h264', '/03.h264'], self.manifest.oldest(951))
+        self.assertEqual('/01.h264', self.manifest.oldest(0)[-1])
+
+    def test_kept_in_database(self):
+        self.manifest.sync(self.storage)
+        self.manifest.removed(['/00.h264'])
+        self.manifest.close()
+        self.manifest = RemoteManifest(self.filename)
+        self.assertEqual((9, 900), (len(self.manifest.files), self.manifest.total))
+        self.assertEqual(['/01.h264'], self.manifest.oldest(900))
+        # Only the changes since the stored cursor are downloaded.
+        self._upload('/10.h264', 100)
+        self.manifest.sync(self.storage)
+        self.assertEqual(1000, self.manifest.total)
+
+
+class LiveUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.index = UploadIndex(os.path.join(self.local, 'uploads.db'))
+        self.watcher = ClipWatcher(self.local, self.index)
+        self.checked = []
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def check_live(self, file: str):
+        # What the watcher does on IN_CLOSE_WRITE, e.g. when the clip is reopened.
+        self.watcher._add(file)
+        self.checked.append(self.index.state(file))
+
+    def _capture(self, session: Session) -> MotionCapture:
+        return MotionCapture(
+            self.local, session, detector=object(), client=LocalStorage(self.remote), index=self.index)
+
+    def test_uploaded_once(self):
+        capture = self._capture(Session(self))
+        file = capture.capture()
+        self.assertEqual([LIVE], self.checked)
+        self.assertEqual(LIVE, self.index.state(file))
+        self.watcher.scan()
+        self.assertEqual([], self.index.claim())
+        writer = Writer()
+        pending = []
+        MotionDaemon._uploaded(capture, file, writer, self.index, pending)
+        pending[0].future.result(10)
+        self.assertEqual(DONE, self.index.state(file))
+        self.assertEqual(1, len(writer.statements))
+        self.assertEqual(os.path.getsize(file), os.path.getsize(os.path.join(self.remote, os.path.basename(file))))
+
+    def test_failed_recording_is_released(self):
+        capture = self._capture(Session(self, True))
+        self.assertIsNone(capture.capture())
+        self.assertEqual([LIVE], self.checked)
+        (file,) = [entry.path for entry in os.scandir(self.local) if entry.name.endswith('.h264')]
+        self.assertEqual(PENDING, self.index.state(file))
+        self.assertEqual([file], self.index.claim())
+
+    def test_unfinished_upload_is_released_at_shutdown(self):
+        storage = SlowStorage(self.remote)
+        capture = MotionCapture(self.local, Session(self), detector=object(), client=storage, index=self.index)
+        file = capture.capture()
+        pending = []
+        MotionDaemon._uploaded(capture, file, Writer(), self.index, pending)
+        (upload,) = pending
+        try:
+            with mock.patch.object(EventWriter, 'shutdown_timeout', 0.1):
+                MotionDaemon._abandon(pending)
+            self.assertTrue(upload.future.cancelled())
+            self.assertEqual(PENDING, self.index.state(file))
+        finally:
+            storage.sent.set()
+            storage.committed.set()
+        # The rest of the clip is still sent, but it is not committed, the upload daemon uploads it.
+        upload.thread.join(10)
+        self.assertFalse(upload.thread.is_alive())
+        self.assertFalse(os.path.exists(os.path.join(self.remote, os.path.basename(file))))
+        self.assertEqual(PENDING, self.index.state(file))
+
+    def test_committing_upload_is_waited_for_at_shutdown(self):
+        storage = SlowStorage(self.remote)
+        storage.sent.set()
+        capture = MotionCapture(self.local, Session(self), detector=object(), client=storage, index=self.index)
+        file = capture.capture()
+        pending = []
+        writer = Writer()
+        MotionDaemon._uploaded(capture, file, writer, self.index, pending)
+        (upload,) = pending
+        while not upload.committing:
+            time.sleep(0.01)
+        # The commit does not finish in the first timeout, but it is not given up.
+        timer = threading.Timer(0.7, storage.committed.set)
+        timer.start()
+        try:
+            with mock.patch.object(EventWriter, 'shutdown_timeout', 0.5):
+                MotionDaemon._abandon(pending)
+        finally:
+            timer.cancel()
+            storage.committed.set()
+        self.assertFalse(upload.future.cancelled())
+        self.assertEqual(DONE, self.index.state(file))
+        self.assertEqual(1, len(writer.statements))
+        self.assertTrue(os.path.exists(os.path.join(self.remote, os.path.basename(file))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,16 +4,19 @@
 """ Dropbox upload daemon.
     """
 
-from fnmatch import fnmatch
-from operator import itemgetter
-from os import listdir, path, mknod, stat
-from time import strptime, sleep, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import path
+from time import time
 from dropbox.client import DropboxClient, DropboxOAuth2FlowNoRedirect
 from dropbox.rest import ErrorResponse
 from urllib3.exceptions import MaxRetryError
 from utils import settings
 from utils.daemons import DaemonBase, init
-from utils.database import DatabaseConnection
+from utils.database import EventWriter
+from utils.scheduler import BandwidthProfile, Scheduler
+from utils.uploader import Uploader
+from utils.uploads import ClipWatcher, RemoteManifest, UploadIndex
 
 __author__ = "wavezone"
 __copyright__ = "Copyright 2016, MRG-Infó Bt."
@@ -31,6 +34,9 @@ class UploadDaemon(DaemonBase):
 
     first_time = False
     max_size = 10 * (1024 ** 3)
+    rotate_interval = 2 * 60  # seconds between the rotations of Dropbox
+    delete_workers = 4  # files deleted at the same time, the API has no batch delete
+    rotated = 0  # time of the last rotation
     access_token = settings.config.access_token
 
     def __init__(self, directory: str):
@@ -51,69 +57,74 @@ class UploadDaemon(DaemonBase):
             settings.config.access_token = self.access_token
             self.first_time = True
 
-    @staticmethod
-    def _get(client: DropboxClient) -> list:
-        """ Get files from Dropbox.
+    def _upload(self, uploader: Uploader, index: UploadIndex, manifest: RemoteManifest, scheduler: Scheduler,
+                writer: EventWriter) -> int:
+        """ Upload the queued clips, the most important one is claimed whenever a worker is free.
+
+            Dropbox is rotated in between if it is due. The clips failing are put back into the queue when nothing
+            else is left, so they are retried in the next cycle.
+
+            :return: Number of clips uploaded.
             """
-        try:
-            metadata = client.metadata('/')
-        except (MaxRetryError, ErrorResponse):
-            return None
-        return [
-            {
-                'file': m['path'],
-                'modified': strptime(m['modified'], '%a, %d %b %Y %H:%M:%S %z'),
-                'size': m['bytes']
-            }
-            for m in metadata['contents']
-            if not m['is_dir']
-        ]
-
-    def _upload(self, client: DropboxClient):
-        """ Upload new files from directory.
+        claimed = []
+
+        def claim() -> tuple:
+            files = index.claim(1, scheduler.rank)
+            if not files:
+                return None
+            claimed.append(files[0])
+            return files[0], '/' + path.basename(files[0])
+
+        uploaded = set()
+        for (full_name, url, metadata) in uploader.drain(claim, scheduler.poll):
+            update = """
+            UPDATE events
+               SET url = %s,
+                   uploaded = %s
+             WHERE file = %s
             """
-        now = time()
-        for filename in listdir(self.directory):
-            if fnmatch(filename, '*.upl'):
-                continue
-            local_name = '/' + filename
-            full_name = path.join(self.directory, filename)
-            upl_name = "{}.upl".format(full_name)
-            if not path.isfile(upl_name) and stat(full_name).st_mtime < now - 60:
-                with open(full_name, 'rb') as file_stream:
-                    try:
-                        client.put_file(local_name, file_stream)
-                        share = client.share(local_name)
-                    except (MaxRetryError, ErrorResponse):
-                        continue
-                with DatabaseConnection() as db:
-                    update = """
-                    UPDATE events
-                       SET url = '{}',
-                           uploaded = current_timestamp
-                     WHERE file = '{}'
-                    """.format(share['url'], full_name)
-                    db.dml(update)
-                try:
-                    mknod(upl_name)
-                except FileExistsError:
-                    pass
-                print("{} was uploaded to Dropbox.".format(filename))
-
-    def _rotate(self, client: DropboxClient, files: list):
-        """  Rotate Dropbox in order to save storage.
+            writer.put(update, (url, datetime.now(), full_name), full_name)
+            index.done(full_name, url)
+            manifest.added(metadata)
+            uploaded.add(full_name)
+            print("{} was uploaded to Dropbox after {:.0f} s in the queue.".format(
+                path.basename(full_name), scheduler.done(full_name) or 0))
+            self._rotate(uploader.client, manifest)
+        for file in claimed:
+            if file not in uploaded:
+                if path.exists(file):
+                    index.release(file)
+                else:
+                    index.forget(file)
+        return len(uploaded)
+
+    def _rotate(self, client: DropboxClient, manifest: RemoteManifest):
+        """  Rotate Dropbox in order to save storage, at most every rotate_interval seconds.
             """
-        total_size = sum(item['size'] for item in files)
-        files_history = sorted(files, key=itemgetter('modified'))
-        for file in files_history:
-            if total_size < self.max_size:
-                break
+        if time() - self.rotated < self.rotate_interval:
+            return
+        self.rotated = time()
+        try:
+            manifest.sync(client)
+        except (MaxRetryError, ErrorResponse):
+            return
+        files = manifest.oldest(self.max_size)
+        if not files:
+            return
+
+        def delete(file: str) -> bool:
             try:
-                client.file_delete(file['file'])
-                print("{} was deleted from Dropbox.".format(file['file']))
-                total_size -= file['size']
-            except (MaxRetryError, ErrorResponse):
-                pass
+                client.file_delete(file)
+                print("{} was deleted from Dropbox.".format(file))
+                return True
+            except ErrorResponse as error:
+                return error.status == 404
+            except MaxRetryError:
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.delete_workers) as executor:
+            deleted = [file for (file, ok) in zip(files, executor.map(delete, files)) if ok]
+        manifest.removed(deleted)
 
     def run(self):
         """ Upload logic.
@@ -121,21 +132,43 @@ class UploadDaemon(DaemonBase):
         if self.first_time:
             return
         print("Uploading from {} to Dropbox.".format(self.directory), flush=True)
+        writer = EventWriter()
+        index = UploadIndex()
+        recovered = index.recover()
+        if recovered:
+            print("{} interrupted uploads are queued again.".format(recovered), flush=True)
+        manifest = RemoteManifest()
+        watcher = ClipWatcher(self.directory, index)
+        uploader = None
         try:
             client = DropboxClient(self.access_token)
+            scheduler = Scheduler(
+                writer.journal, BandwidthProfile(settings.config.bandwidth), settings.config.stream_bandwidth,
+                settings.config.stream_stats, settings.config.bitrate)
+            uploader = Uploader(
+                client, settings.config.upload_workers, settings.config.chunk_size, scheduler.throttle)
+            watcher.start()
             while True:
-                self._upload(client)
-                files = self._get(client)
-                if files is not None:
-                    self._rotate(client, files)
+                busy = self._upload(uploader, index, manifest, scheduler, writer)
+                self._rotate(client, manifest)
+                if busy:
+                    continue
+                print("Uploaded {throughput} B/s at a limit of {rate} B/s, {files} clips waited {latency} s on "
+                      "average.".format(**scheduler.stats()), flush=True)
                 print("Going idle...", end='', flush=True)
-                sleep(2 * 60)
+                watcher.wait(self.rotate_interval)
                 print("DONE", flush=True)
         except KeyboardInterrupt:
             print()
         except SystemExit:
             pass
         finally:
+            watcher.stop()
+            if uploader is not None:
+                uploader.close()
+            manifest.close()
+            index.close()
+            writer.close()
             print("No longer uploading from {} to Dropbox.".format(self.directory), flush=True)
 
 
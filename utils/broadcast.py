@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Fan out frames of one producer to any number of clients.
+    """
+
+from contextlib import contextmanager
+import sys
+import threading
+import time
+import traceback
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['Client', 'FrameHub']
+
+
+class Client:
+    """ Mailbox of one viewer holding only the newest frame.
+
+        The producer replaces an unsent frame instead of waiting for the viewer, the replaced frame is counted as
+        dropped. Frames are handed out no faster than the requested frame rate.
+        """
+
+    def __init__(self, hub: 'FrameHub', fps: float = None, name: str = '', channel: str = None):
+        """ Constructor.
+
+            :param hub: Source of the frames.
+            :param fps: Frames per second, the hub's default if None.
+            :param name: Shown in the statistics, e.g. the peer address.
+            :param channel: Stream of the hub to watch.
+            """
+        self.hub = hub
+        self.channel = channel
+        self.fps = fps if fps is not None else hub.fps
+        self.name = name
+        self.condition = threading.Condition()
+        self.pending = None
+        self.sent = 0
+        self.dropped = 0
+        self.started = None
+        self.due = 0
+
+    def put(self, frame: bytes):
+        """ Called by the producer, never blocks.
+            """
+        with self.condition:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = frame
+            self.condition.notify()
+
+    def delay(self) -> float:
+        """ Seconds until the next frame may be sent.
+            """
+        return max(0.0, self.due - time.monotonic())
+
+    def take(self) -> bytes:
+        """ Newest frame without waiting, None if there is none or it is too early.
+            """
+        with self.condition:
+            if self.pending is None or self.delay() > 0:
+                return None
+            frame, self.pending = self.pending, None
+            self.sent += 1
+            self.due = time.monotonic() + 1 / self.fps
+            return frame
+
+    def get(self, timeout: float = None) -> bytes:
+        """ Wait for the newest frame at the requested frame rate.
+
+            :param timeout: Seconds to wait for a frame.
+            :return: None on timeout.
+            """
+        time.sleep(self.delay())
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending is not None, timeout):
+                return None
+            return self.take()
+
+    def stats(self) -> dict:
+        """ Frames sent, frames dropped and effective frame rate.
+            """
+        elapsed = time.monotonic() - self.started if self.started is not None else 0
+        return {
+            'name': self.name,
+            'channel': self.channel,
+            'fps': self.fps,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'effective_fps': round(self.sent / elapsed, 2) if elapsed > 0 else 0.0
+        }
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.hub.subscribe(self)
+        return self
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.hub.unsubscribe(self)
+
+
+class FrameHub:
+    """ Latest frame slots shared by every client, one for each channel, e.g. resolution, of the producer.
+
+        The producer runs in its own thread only while there are clients. It should publish frames as long as
+        active() returns True. Every frame is put into the mailbox of each client watching its channel, so a frame
+        is captured once no matter how many clients are watching and a slow client never holds up the producer
+        or the others.
+        """
+
+    idle_timeout = 10  # seconds to keep producing after the last client left
+    max_fps = 30
+
+    def __init__(self, producer, fps: float = 5):
+        """ Constructor.
+
+            :param producer: Callable receiving the hub.
+            :param fps: Default frames per second of the clients.
+            """
+        self.producer = producer
+        self.fps = fps
+        self.condition = threading.Condition()
+        self.frame = {}
+        self.seq = {}
+        self.timestamp = {}
+        self.clients = set()
+        self.idle_since = None
+        self.thread = None
+        self.listeners = []
+        self.paused = 0
+        self.started = int(time.time())
+        self._previous = None
+
+    def _run(self, previous: threading.Thread):
+        # The camera is released only when the previous producer has finished.
+        if previous is not None:
+            previous.join()
+        # noinspection PyBroadException
+        try:
+            self.producer(self)
+        except:
+            print(traceback.format_exc(), file=sys.stderr)
+        finally:
+            with self.condition:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def subscribe(self, client: Client):
+        """ Register client and start the producer if needed.
+            """
+        with self.condition:
+            self.clients.add(client)
+            self.idle_since = None
+            self._start()
+
+    def _start(self):
+        if self.thread is None and not self.paused:
+            self.thread = threading.Thread(target=self._run, args=(self._previous,), daemon=True)
+            self._previous = self.thread
+            self.thread.start()
+
+    def unsubscribe(self, client: Client):
+        """ Unregister client.
+            """
+        with self.condition:
+            self.clients.discard(client)
+            if not self.clients:
+                self.idle_since = time.monotonic()
+
+    def active(self) -> bool:
+        """ Whether the producer should go on.
+            """
+        with self.condition:
+            if not self.paused and (self.clients or time.monotonic() - self.idle_since < self.idle_timeout):
+                return True
+            # Forget the thread while holding the lock, so the next client starts a new one.
+            self.thread = None
+            return False
+
+    @contextmanager
+    def exclusive(self):
+        """ Stop the producer while the block runs, e.g. to use the camera for something else.
+            """
+        with self.condition:
+            self.paused += 1
+            previous = self._previous
+        try:
+            if previous is not None:
+                previous.join()
+            yield
+        finally:
+            with self.condition:
+                self.paused -= 1
+                if self.clients:
+                    self._start()
+
+    def add_listener(self, listener):
+        """ Call listener from the producer thread after every frame, e.g. to wake up an event loop.
+
+            :param listener: Callable without parameters.
+            """
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Stop calling listener.
+
+            :param listener: Callable registered with add_listener().
+            """
+        with self.condition:
+            self.listeners.remove(listener)
+
+    def publish(self, frame: bytes, channel: str = None):
+        """ Replace the latest frame of the channel and wake up its clients.
+
+            :param frame: Encoded frame.
+            :param channel: Stream of the frame.
+            """
+        with self.condition:
+            self.frame[channel] = frame
+            self.seq[channel] = self.seq.get(channel, 0) + 1
+            self.timestamp[channel] = time.time()
+            self.condition.notify_all()
+            clients = [client for client in self.clients if client.channel == channel]
+            listeners = list(self.listeners)
+        for client in clients:
+            client.put(frame)
+        for listener in listeners:
+            listener()
+
+    def framerate(self) -> float:
+        """ Frames per second fast enough for the most demanding client.
+            """
+        with self.condition:
+            fps = max([client.fps for client in self.clients] + [self.fps])
+        return min(fps, self.max_fps)
+
+    def stats(self) -> list:
+        """ Statistics of the connected clients.
+            """
+        with self.condition:
+            clients = list(self.clients)
+        return [client.stats() for client in clients]
+
+    def latest(self, channel: str = None) -> tuple:
+        """ Sequence number, latest frame and its time stamp without waiting.
+
+            :param channel: Stream of the hub.
+            """
+        with self.condition:
+            return self.seq.get(channel, 0), self.frame.get(channel), self.timestamp.get(channel)
+
+    def fresh(self, max_age: float, timeout: float = None, channel: str = None) -> tuple:
+        """ Latest frame if it is not older than max_age, otherwise wait for the next one.
+
+            :param max_age: Seconds.
+            :param timeout: Seconds to wait for a new frame.
+            :param channel: Stream of the hub.
+            :return: Sequence number, frame and time stamp, the frame is None on timeout.
+            """
+        (seq, frame, timestamp) = self.latest(channel)
+        if frame is not None and time.time() - timestamp <= max_age:
+            return seq, frame, timestamp
+        with Client(self, self.max_fps, channel=channel):
+            (seq, frame) = self.wait(seq, timeout, channel)
+        if frame is None:
+            return seq, None, None
+        return self.latest(channel)
+
+    def wait(self, seq: int, timeout: float = None, channel: str = None) -> tuple:
+        """ Wait for a frame newer than seq.
+
+            :param seq: Sequence number of the last frame seen.
+            :param timeout: Seconds to wait.
+            :param channel: Stream of the hub.
+            :return: Sequence number and frame, the frame is None on timeout.
+            """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq.get(channel, 0) > seq, timeout):
+                return seq, None
+            return self.seq[channel], self.frame[channel]
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" In-process cache of query results.
+    """
+
+from collections import OrderedDict
+import threading
+import time
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['QueryCache']
+
+
+class QueryCache:
+    """ Least recently used results with a time to live, valid only for the data version they were loaded at.
+
+        The version is anything cheap to query that changes with the data, e.g. the time of the newest row, so
+        the expensive query runs only when something changed or the result expired.
+        """
+
+    def __init__(self, size: int = 64, ttl: float = 300):
+        """ Constructor.
+
+            :param size: Maximum number of results.
+            :param ttl: Seconds a result is used at most, catches the changes the version does not show.
+            """
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key: (value, version, expires)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.checks = 0
+        self.check_time = 0.0
+        self.hit_time = 0.0
+        self.miss_time = 0.0
+
+    def get(self, key, version, load):
+        """ Cached result, loaded again if missing, expired or of another version.
+
+            :param key: Hashable identity of the query, e.g. page and filter.
+            :param version: Callable without parameters returning the current data version.
+            :param load: Callable without parameters running the query.
+            """
+        started = time.perf_counter()
+        version = version()
+        with self.lock:
+            self.checks += 1
+            self.check_time += time.perf_counter() - started
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == version and entry[2] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.hit_time += time.perf_counter() - started
+                return entry[0]
+            if entry is not None:
+                self.stale += 1
+        value = load()
+        with self.lock:
+            self.entries[key] = (value, version, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.misses += 1
+            self.miss_time += time.perf_counter() - started
+        return value
+
+    def clear(self):
+        """ Forget every result.
+            """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """ Hits, misses, i.e. queries run, stale results, evictions and average times in milliseconds.
+
+            The times of the hits and misses include the version check.
+            """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'version_checks': self.checks,
+                'version_ms': round(1000 * self.check_time / self.checks, 3) if self.checks else 0.0,
+                'hit_ratio': round(self.hits / (self.hits + self.misses), 3) if self.hits + self.misses else 0.0,
+                'hit_ms': round(1000 * self.hit_time / self.hits, 3) if self.hits else 0.0,
+                'miss_ms': round(1000 * self.miss_time / self.misses, 3) if self.misses else 0.0
+            }
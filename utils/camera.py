@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Long-lived camera session shared by the motion detector and the recorder.
+    """
+
+from collections import deque
+from fractions import Fraction
+import sys
+import threading
+import time
+
+import numpy
+
+try:
+    import picamera
+    from picamera.exc import PiCameraError as CameraError
+except ImportError:
+    # Allow running with the fake backend on machines without camera.
+    picamera = None
+
+    class CameraError(Exception):
+        """ Camera failure.
+            """
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['CameraError', 'ArrayOutput', 'FrameOutput', 'VectorOutput', 'CircularOutput', 'CameraSession', 'FakeCamera']
+
+SECONDS2MICRO = 1000000  # Constant for converting Shutter Speed in Seconds to Microseconds
+
+# Motion vector of a 16x16 macroblock produced by the H.264 encoder.
+VECTOR_TYPE = numpy.dtype([('x', 'i1'), ('y', 'i1'), ('sad', 'u2')])
+
+
+def raw_resolution(resolution: tuple) -> tuple:
+    """ Size of the unencoded frame buffers: width is padded to 32, height to 16.
+
+        :param resolution: Width and height.
+        """
+    (width, height) = resolution
+    return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+class ArrayOutput:
+    """ Receives one array per frame from the camera and keeps the latest.
+        """
+
+    def __init__(self, resolution: tuple):
+        self.width, self.height = resolution
+        self.condition = threading.Condition()
+        self.frame = None
+        self.index = 0
+
+    def _decode(self, buf) -> numpy.ndarray:
+        """ Array in the buffer, None if incomplete.
+            """
+        raise NotImplementedError()
+
+    def write(self, buf) -> int:
+        """ Called by the encoder for every frame.
+            """
+        frame = self._decode(buf)
+        if frame is not None:
+            with self.condition:
+                self.frame = frame
+                self.index += 1
+                self.condition.notify_all()
+        return len(buf)
+
+    def flush(self):
+        """ Nothing is buffered.
+            """
+
+    def wait(self, index: int, timeout: float = None) -> tuple:
+        """ Wait for a frame newer than index.
+
+            :param index: Index of the last frame seen.
+            :param timeout: Seconds to wait.
+            :return: Index and frame, the frame is None on timeout.
+            """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.index > index, timeout):
+                return index, None
+            return self.index, self.frame
+
+
+class FrameOutput(ArrayOutput):
+    """ Receives unencoded YUV frames from a resized splitter port and keeps only their luma plane.
+
+        The planes are copied into a small pool of preallocated buffers. The last two frames handed out by wait()
+        are the previous and the current frame of the detector, they are never overwritten until the next call.
+        """
+
+    pool_size = 4  # previous, current, latest and the one being written
+
+    def __init__(self, resolution: tuple):
+        super().__init__(resolution)
+        self.raw_width, self.raw_height = raw_resolution(resolution)
+        self.pool = [numpy.empty((self.height, self.width), dtype=numpy.uint8) for _ in range(self.pool_size)]
+        self.slot = None
+        self.held = (None, None)
+
+    def write(self, buf) -> int:
+        """ Called by the encoder for every frame.
+            """
+        if len(buf) >= self.raw_width * self.raw_height:
+            with self.condition:
+                slot = next(i for i in range(self.pool_size) if i not in self.held and i != self.slot)
+            # The Y plane comes first, followed by the quarter size U and V planes.
+            luma = numpy.frombuffer(buf, dtype=numpy.uint8, count=self.raw_width * self.raw_height)
+            numpy.copyto(self.pool[slot], luma.reshape((self.raw_height, self.raw_width))[:self.height, :self.width])
+            with self.condition:
+                self.slot = slot
+                self.frame = self.pool[slot]
+                self.index += 1
+                self.condition.notify_all()
+        return len(buf)
+
+    def wait(self, index: int, timeout: float = None) -> tuple:
+        with self.condition:
+            (index, frame) = super().wait(index, timeout)
+            if frame is not None:
+                self.held = (self.held[1], self.slot)
+            return index, frame
+
+
+def vector_shape(resolution: tuple) -> tuple:
+    """ Rows and columns of the motion vector array, there is an extra column.
+
+        :param resolution: Width and height of the recording.
+        """
+    (width, height) = resolution
+    return (height + 15) // 16, (width + 15) // 16 + 1
+
+
+class VectorOutput(ArrayOutput):
+    """ Receives the macroblock motion vectors of the H.264 encoder and keeps the latest array.
+        """
+
+    def __init__(self, resolution: tuple):
+        super().__init__(resolution)
+        self.shape = vector_shape(resolution)
+
+    def _decode(self, buf) -> numpy.ndarray:
+        (rows, cols) = self.shape
+        if len(buf) < rows * cols * VECTOR_TYPE.itemsize:
+            return None
+        return numpy.frombuffer(buf, dtype=VECTOR_TYPE, count=rows * cols).reshape(self.shape)
+
+
+def _is_header(buf: bytes) -> bool:
+    """ The buffer starts with an H.264 sequence parameter set, so the stream is decodable from here.
+        """
+    return buf[:4] == b'\x00\x00\x00\x01' and len(buf) > 4 and buf[4] & 0x1f == 7
+
+
+class CircularOutput:
+    """ H.264 output keeping the last few seconds in memory.
+
+        When a recording is started the buffered stream is flushed to the file and the encoder keeps writing
+        there without interruption. The buffer is trimmed to whole groups of pictures, so it always starts with
+        a header and never exceeds size bytes. If the buffer is empty at the start, the data before the next
+        header is dropped, so the file is decodable from its first byte.
+        """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.chunks = deque()
+        self.nbytes = 0
+        self.peak = 0
+        self.file = None
+        self.synced = False
+
+    def _trim(self):
+        while self.chunks and (self.nbytes > self.size or not _is_header(self.chunks[0])):
+            self.nbytes -= len(self.chunks.popleft())
+
+    def write(self, buf) -> int:
+        """ Called by the encoder.
+            """
+        with self.lock:
+            if self.file is not None:
+                if not self.synced and _is_header(buf):
+                    self.synced = True
+                if self.synced:
+                    self.file.write(buf)
+            else:
+                chunk = bytes(buf)
+                if self.chunks or _is_header(chunk):
+                    self.chunks.append(chunk)
+                    self.nbytes += len(chunk)
+                    self._trim()
+                    self.peak = max(self.peak, self.nbytes)
+        return len(buf)
+
+    def flush(self):
+        """ Flush the file if recording.
+            """
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def footprint(self) -> int:
+        """ Measured memory used by the buffered chunks including the Python object overhead.
+            """
+        with self.lock:
+            return sys.getsizeof(self.chunks) + sum(sys.getsizeof(chunk) for chunk in self.chunks)
+
+    def start(self, filename):
+        """ Write the buffered seconds to the file and continue recording into it.
+
+            :param filename: Output file name or writable file object, the latter is closed by stop().
+            """
+        file = open(filename, 'wb') if isinstance(filename, str) else filename
+        with self.lock:
+            # The buffer is never left starting in the middle of a group of pictures.
+            self.synced = bool(self.chunks)
+            while self.chunks:
+                file.write(self.chunks.popleft())
+            self.nbytes = 0
+            self.file = file
+
+    def stop(self):
+        """ Close the file and return to buffering.
+            """
+        with self.lock:
+            file, self.file = self.file, None
+        if file is not None:
+            file.close()
+
+
+class CameraSession:
+    """ Keeps the camera open: low resolution frames flow to the detector on one splitter port
+        while the full resolution port stays ready to record.
+
+        With vectors the detector gets the motion vectors of the recording encoder instead of frames.
+        """
+
+    record_port = 1
+    detect_port = 2
+    bitrate = 17000000  # H.264 bits per second, picamera's default
+    nightISO = 800
+    nightShutSpeed = 6 * SECONDS2MICRO  # seconds times conversion to microseconds constant
+
+    def __init__(self,
+                 resolution: tuple = (1920, 1080),
+                 test_resolution: tuple = (100, 75),
+                 framerate: int = 10,
+                 is_day: bool = True,
+                 buffer_seconds: int = 5,
+                 bitrate: int = None,
+                 vectors: bool = False,
+                 camera_factory=None):
+        self.resolution = resolution
+        self.test_resolution = test_resolution
+        self.framerate = framerate
+        self.is_day = is_day
+        self.imageVFlip = False  # Flip image Vertically
+        self.imageHFlip = False  # Flip image Horizontally
+        self.camera_factory = camera_factory if camera_factory is not None else picamera.PiCamera
+        self.buffer_seconds = buffer_seconds
+        self.vectors = vectors
+        if bitrate is not None:
+            self.bitrate = bitrate
+        self.camera = None
+        self.output = None
+        self.recorder = None
+        self.index = 0
+
+    def open(self):
+        """ Start the camera, the pre-motion buffer and the detector port.
+            """
+        self.camera = self.camera_factory()
+        try:
+            self.camera.resolution = self.resolution
+            # noinspection SpellCheckingInspection
+            self.camera.vflip = self.imageVFlip
+            # noinspection SpellCheckingInspection
+            self.camera.hflip = self.imageHFlip
+            if self.is_day:
+                self.camera.framerate = self.framerate
+                self.camera.exposure_mode = 'auto'
+                self.camera.awb_mode = 'auto'
+                time.sleep(2)
+            else:
+                # Night time low light settings have long exposure times
+                # Settings for Low Light Conditions
+                # Set a frame rate of 1/6 fps, then set shutter
+                # speed to 6s and ISO to approx 800 per nightISO variable
+                self.camera.framerate = Fraction(1, 6)
+                self.camera.shutter_speed = self.nightShutSpeed
+                self.camera.exposure_mode = 'off'
+                self.camera.iso = self.nightISO
+                # Give the camera a good long time to measure AWB
+                # (you may wish to use fixed AWB instead)
+                time.sleep(12)
+            self.recorder = CircularOutput(self.buffer_seconds * self.bitrate // 8)
+            self.index = 0
+            if self.vectors:
+                self.output = VectorOutput(self.resolution)
+            self.camera.start_recording(
+                self.recorder,
+                format='h264',
+                splitter_port=self.record_port,
+                bitrate=self.bitrate,
+                intra_period=max(1, int(self.camera.framerate)),
+                motion_output=self.output if self.vectors else None)
+            if not self.vectors:
+                self.output = FrameOutput(self.test_resolution)
+                self.camera.start_recording(
+                    self.output,
+                    format='yuv',
+                    splitter_port=self.detect_port,
+                    resize=self.test_resolution)
+        except:
+            self.camera.close()
+            self.camera = None
+            raise
+
+    def close(self):
+        """ Release the camera.
+            """
+        if self.camera is not None:
+            try:
+                for port in (self.detect_port, self.record_port):
+                    try:
+                        self.camera.stop_recording(splitter_port=port)
+                    except CameraError:
+                        pass
+            finally:
+                self.recorder.stop()
+                self.camera.close()
+                self.camera = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def frame(self, timeout: float = None) -> numpy.ndarray:
+        """ Next low resolution frame or motion vector array.
+
+            :param timeout: Seconds to wait.
+            :return: None on timeout.
+            """
+        self.index, frame = self.output.wait(self.index, timeout)
+        return frame
+
+    def record(self, filename, duration: int):
+        """ Record full resolution H.264 video starting with the buffered seconds before the call.
+
+            :param filename: Output file name or writable file object.
+            :param duration: Seconds after the call.
+            """
+        buffered = self.recorder.nbytes
+        footprint = self.recorder.footprint()
+        self.recorder.start(filename)
+        if not self.recorder.synced:
+            # Nothing decodable was buffered, do not wait for the next intra frame.
+            self.camera.request_key_frame(splitter_port=self.record_port)
+        try:
+            self.camera.wait_recording(duration, splitter_port=self.record_port)
+        finally:
+            self.recorder.stop()
+            print("Pre-motion buffer flushed {} bytes using {} bytes of memory, peak {} of {} bytes.".format(
+                buffered, footprint, self.recorder.peak, self.recorder.size))
+
+
+class FakeCamera:
+    """ Stand-in for picamera.PiCamera implementing the part of its interface used by CameraSession.
+
+        YUV ports cycle through the given frames, H.264 ports produce dummy bytes and cycle through the given
+        motion vector arrays.
+        """
+
+    def __init__(self, frames: list = None, vectors: list = None):
+        self.frames = frames if frames is not None else []
+        self.vectors = vectors if vectors is not None else []
+        self.resolution = (1920, 1080)
+        self.framerate = 30
+        self.vflip = False
+        self.hflip = False
+        self.exposure_mode = 'auto'
+        self.awb_mode = 'auto'
+        self.shutter_speed = 0
+        self.iso = 0
+        self.annotate_text = ''
+        self.closed = False
+        self._ports = {}
+        self._key_frames = set()
+
+    def _frame(self, index: int, resolution: tuple) -> bytes:
+        (raw_width, raw_height) = raw_resolution(resolution)
+        luma = numpy.zeros((raw_height, raw_width), dtype=numpy.uint8)
+        if self.frames:
+            frame = self.frames[index % len(self.frames)]
+            luma[:frame.shape[0], :frame.shape[1]] = frame[:, :, 1] if frame.ndim == 3 else frame
+        return luma.tobytes() + bytes([128]) * (raw_width * raw_height // 2)
+
+    def _vectors(self, index: int) -> bytes:
+        if self.vectors:
+            return self.vectors[index % len(self.vectors)].tobytes()
+        return numpy.zeros(vector_shape(self.resolution), dtype=VECTOR_TYPE).tobytes()
+
+    def _run(self, output, fmt: str, resize: tuple, stop: threading.Event, intra_period: int, motion_output):
+        index = 0
+        while not stop.wait(1 / float(self.framerate)):
+            if fmt == 'h264':
+                if index % intra_period == 0 or self._key_frames:
+                    self._key_frames.clear()
+                    output.write(b'\x00\x00\x00\x01\x27' + bytes(27))
+                output.write(b'\x00\x00\x00\x01\x25' + bytes(1019))
+                if motion_output is not None:
+                    motion_output.write(self._vectors(index))
+            else:
+                output.write(self._frame(index, resize or self.resolution))
+            index += 1
+
+    def start_recording(self, output, format: str = None, splitter_port: int = 1, resize: tuple = None, **options):
+        """ Start producing data on the port.
+            """
+        if splitter_port in self._ports:
+            raise CameraError("The camera is already using port {}".format(splitter_port))
+        stream = open(output, 'wb') if isinstance(output, str) else output
+        stop = threading.Event()
+        intra_period = options.get('intra_period') or 30
+        worker = threading.Thread(
+            target=self._run,
+            args=(stream, format or 'h264', resize, stop, intra_period, options.get('motion_output')),
+            daemon=True)
+        self._ports[splitter_port] = (worker, stop, stream, stream is not output)
+        worker.start()
+
+    def request_key_frame(self, splitter_port: int = 1):
+        """ Emit a header and an intra frame next on the port.
+            """
+        if splitter_port not in self._ports:
+            raise CameraError("There is no recording in progress on port {}".format(splitter_port))
+        self._key_frames.add(splitter_port)
+
+    def wait_recording(self, timeout: float = 0, splitter_port: int = 1):
+        """ Sleep while recording.
+            """
+        if splitter_port not in self._ports:
+            raise CameraError("There is no recording in progress on port {}".format(splitter_port))
+        time.sleep(timeout)
+
+    def stop_recording(self, splitter_port: int = 1):
+        """ Stop producing data on the port.
+            """
+        try:
+            (worker, stop, stream, owned) = self._ports.pop(splitter_port)
+        except KeyError:
+            raise CameraError("There is no recording in progress on port {}".format(splitter_port))
+        stop.set()
+        worker.join()
+        if owned:
+            stream.close()
+
+    def close(self):
+        """ Stop every port.
+            """
+        for port in list(self._ports):
+            self.stop_recording(splitter_port=port)
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
@@ -4,14 +4,23 @@
 """ Manage database 'motion'.
     """
 
+from collections import deque
+import os
+import sys
+import threading
+import time
+
 from pymysql.err import OperationalError, MySQLError
 import pymysql
 
 try:
     from utils import settings
+    from utils.journal import Journal
 except ImportError:
     # noinspection PyUnresolvedReferences
     import settings
+    # noinspection PyUnresolvedReferences
+    from journal import Journal
 
 __author__ = "wavezone"
 __copyright__ = "Copyright 2015, MRG-Infó Bt."
@@ -22,75 +31,463 @@ __version__ = "1.0.1"
 __maintainer__ = "Groma István"
 __email__ = "wavezone@mrginfo.com"
 
-__all__ = ['DatabaseConnection']
+__all__ = ['ConnectionPool', 'DatabaseConnection', 'EventWriter', 'pool']
+
+
+def _connect():
+    return pymysql.connect(
+        host=settings.config.host,
+        user=settings.config.user,
+        password=settings.config.password,
+        db='motion')
+
+
+class ConnectionPool:
+    """ Thread safe pool of connections to database 'motion'.
+
+        Idle connections are pinged when borrowed and those idle for longer than idle_timeout are closed, except
+        for the last min_size ones. After a failed connect attempt no new one is made until the backoff delay,
+        doubled after each failure, has passed. A process forked from the one owning the pool starts over with
+        an empty pool instead of sharing the sockets of its parent.
+        """
+
+    backoff = 1  # seconds to wait after the first failed connect attempt
+    max_backoff = 60
+
+    def __init__(self, min_size: int = 1, max_size: int = 4, idle_timeout: float = 300, connect=None):
+        """ Constructor, connections are only opened on demand.
+
+            :param min_size: Connections kept open even when idle.
+            :param max_size: Maximum number of open connections, borrowers wait for one beyond this.
+            :param idle_timeout: Seconds after an idle connection is closed.
+            :param connect: Callable returning a new connection.
+            """
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.connect = connect if connect is not None else _connect
+        self.condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = deque()  # (connection, time it was returned), the most recently used on the right
+        self.size = 0  # open connections, both idle and borrowed
+        self.failures = 0
+        self.retry_at = 0
+        self.created = 0
+        self.reused = 0
+
+    def _check_process(self):
+        if self.pid != os.getpid():
+            # Forget the connections of the parent without closing them, the sockets are shared with it.
+            self.condition = threading.Condition()
+            self._reset()
+
+    def _expire(self) -> list:
+        expired = []
+        now = time.monotonic()
+        while self.idle and len(self.idle) > self.min_size and now - self.idle[0][1] > self.idle_timeout:
+            expired.append(self.idle.popleft()[0])
+            self.size -= 1
+        return expired
+
+    @staticmethod
+    def _close(connections: list):
+        for connection in connections:
+            try:
+                connection.close()
+            except MySQLError:
+                pass
+
+    @staticmethod
+    def _healthy(connection) -> bool:
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except MySQLError:
+            return False
+
+    def _open(self):
+        now = time.monotonic()
+        with self.condition:
+            if now < self.retry_at:
+                raise OperationalError("Database is unavailable, next attempt in {:.1f} seconds".format(
+                    self.retry_at - now))
+        try:
+            connection = self.connect()
+        except MySQLError:
+            with self.condition:
+                self.failures += 1
+                self.retry_at = time.monotonic() + min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+            raise
+        with self.condition:
+            self.failures = 0
+            self.retry_at = 0
+            self.created += 1
+        return connection
+
+    def acquire(self, timeout: float = None):
+        """ Borrow a healthy connection.
+
+            :param timeout: Seconds to wait while all connections are borrowed.
+            :return: Connection to be given back with release().
+            :raise OperationalError: The database can not be reached or no connection was released in time.
+            """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self.condition:
+                self._check_process()
+                expired = self._expire()
+                connection = None
+                if self.idle:
+                    connection = self.idle.pop()[0]
+                elif self.size < self.max_size:
+                    self.size += 1
+                else:
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise OperationalError("All {} database connections are in use".format(self.max_size))
+                    self.condition.wait(remaining)
+                    continue
+            self._close(expired)
+            if connection is None:
+                try:
+                    return self._open()
+                except MySQLError:
+                    self._discard()
+                    raise
+            if self._healthy(connection):
+                with self.condition:
+                    self.reused += 1
+                return connection
+            self._close([connection])
+            self._discard()
+
+    def _discard(self):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def release(self, connection, broken: bool = False):
+        """ Give back a borrowed connection.
+
+            :param connection: Connection returned by acquire().
+            :param broken: Close the connection instead of reusing it.
+            """
+        with self.condition:
+            if self.pid != os.getpid():
+                return
+            if not broken:
+                self.idle.append((connection, time.monotonic()))
+                self.condition.notify()
+                return
+        self._close([connection])
+        self._discard()
+
+    def close(self):
+        """ Close the idle connections.
+            """
+        with self.condition:
+            idle = [connection for (connection, _) in self.idle]
+            self.idle.clear()
+            self.size -= len(idle)
+        self._close(idle)
+
+    def stats(self) -> dict:
+        """ Open, idle and created connections, borrows served by an idle connection.
+            """
+        with self.condition:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'created': self.created,
+                'reused': self.reused,
+                'failures': self.failures
+            }
+
+
+pool = ConnectionPool(settings.config.pool_min, settings.config.pool_max, settings.config.pool_idle)
 
 
 # noinspection PyPep8Naming
 class DatabaseConnection:
-    """ Wrapper class for database.
+    """ Wrapper class for database, borrows a connection from the pool.
+
+        Connection failures are reported on stderr and the methods do nothing, as if the database was empty.
         """
 
-    def __init__(self):
+    timeout = 30  # seconds to wait for a free connection
+
+    def __init__(self, connection_pool: ConnectionPool = None):
+        self.pool = connection_pool if connection_pool is not None else pool
+        self.broken = False
         try:
-            self.connection = pymysql.connect(
-                host=settings.config.host,
-                user=settings.config.user,
-                password=settings.config.password,
-                db='motion')
+            self.connection = self.pool.acquire(self.timeout)
             self.cursor = self.connection.cursor()
-        except MySQLError:
+        except MySQLError as error:
+            print("No database connection: {}".format(error), file=sys.stderr)
             self.connection = None
             self.cursor = None
 
-    def __del__(self):
-        if hasattr(self, 'connection') and (self.connection is not None):
+    def _release(self):
+        connection, self.connection = getattr(self, 'connection', None), None
+        if connection is not None:
             try:
-                self.connection.close()
+                # End the transaction, so the next borrower does not see an old snapshot.
+                connection.rollback()
             except MySQLError:
-                pass
+                self.broken = True
+            self.pool.release(connection, self.broken)
+
+    def __del__(self):
+        self._release()
 
     def __enter__(self):
         return self
 
     # noinspection PyUnusedLocal
     def __exit__(self, exception_type, exception_value, traceback):
-        if hasattr(self, 'connection') and (self.connection is not None):
-            try:
-                self.connection.close()
-            except MySQLError:
-                pass
+        self._release()
 
-    def dml(self, query: str):
+    def dml(self, query: str, params=None):
         """ Run data manipulation.
 
             :param query: SQL
+            :param params: Values bound to the %s placeholders of the query.
             """
         if hasattr(self, 'cursor') and (self.cursor is not None)\
                 and hasattr(self, 'connection') and (self.connection is not None):
             try:
-                self.cursor.execute(query)
+                self.cursor.execute(query, params)
                 self.connection.commit()
             except OperationalError:
-                pass
+                self.broken = True
             except MySQLError:
                 self.connection.rollback()
 
-    def query(self, query: str):
+    def query(self, query: str, params=None):
         """ Query database.
 
             :param query: SQL
+            :param params: Values bound to the %s placeholders of the query.
             """
         if hasattr(self, 'cursor') and (self.cursor is not None):
             try:
-                cnt = self.cursor.execute(query)
+                cnt = self.cursor.execute(query, params)
                 if cnt == 0:
                     return None
                 else:
                     return self.cursor.fetchall()
+            except OperationalError:
+                self.broken = True
             except MySQLError:
                 pass
 
 
+class EventWriter:
+    """ Write-behind queue of data manipulation statements, kept in the local journal until MySQL has them.
+
+        Statements are executed in the order they were put, consecutive ones with the same SQL by a single
+        executemany() and each batch in one transaction. A batch is flushed when batch_size statements are queued
+        or the oldest one waited for interval seconds. While the database can not be reached the batch is retried,
+        a row rejected by the database is reported on stderr and skipped. Statements left in the journal when the
+        process stops are replayed by the next writer of the same source. Statements put with a key wait for the
+        earlier statements of the other sources with the same key, see Journal.pending().
+        """
+
+    retry = 5  # seconds between attempts while the database is unreachable
+    timeout = 30  # seconds to wait for a free connection
+    shutdown_timeout = 10  # seconds close() keeps retrying
+
+    def __init__(self, source: str = None, connection_pool: ConnectionPool = None, journal: Journal = None,
+                 batch_size: int = None, interval: float = None):
+        """ Constructor, starts the writer thread.
+
+            :param source: Name of the writer in the journal, the name of the script if None.
+            :param connection_pool: Source of the connections.
+            :param journal: Durable queue.
+            :param batch_size: Queued statements triggering a flush.
+            :param interval: Seconds the oldest statement may wait.
+            """
+        self.source = source if source is not None else os.path.basename(sys.argv[0])
+        self.pool = connection_pool if connection_pool is not None else pool
+        self.journal = journal if journal is not None else Journal()
+        self.batch_size = batch_size if batch_size is not None else settings.config.batch_size
+        self.interval = interval if interval is not None else settings.config.flush_interval
+        self.condition = threading.Condition()
+        self.queued = self.journal.count(self.source)
+        # Statements of an earlier run are due now.
+        self.since = time.monotonic() - self.interval if self.queued else None
+        self.closing = False
+        self.deadline = None
+        self.flushing = 0
+        self.written = 0
+        self.rejected = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, statement: str, params, key: str = None):
+        """ Queue a statement without waiting for the database.
+
+            :param statement: SQL with %s placeholders.
+            :param params: Values of the placeholders.
+            :param key: Row changed by the statement, e.g. the file of the event.
+            """
+        with self.condition:
+            if self.closing:
+                raise RuntimeError("The event writer is closed")
+        self.journal.append(self.source, statement, params, key)
+        with self.condition:
+            self.queued += 1
+            if self.since is None:
+                self.since = time.monotonic()
+            if self.queued == 1 or self.queued >= self.batch_size:
+                # The writer sleeps without a timeout while the queue is empty.
+                self.condition.notify_all()
+
+    def _due(self) -> float:
+        """ Seconds until the next flush, zero if it is due now, None if the queue is empty.
+            """
+        if not self.queued:
+            return None
+        if self.closing or self.flushing or self.queued >= self.batch_size:
+            return 0
+        return max(0.0, self.since + self.interval - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self._due() != 0:
+                    if self.closing and not self.queued:
+                        return
+                    self.condition.wait(self._due())
+            batch = self.journal.pending(self.source, self.batch_size)
+            failure = None
+            try:
+                if batch:
+                    self._write(batch)
+            except MySQLError as error:
+                failure = error
+            queued = self.journal.count(self.source)
+            with self.condition:
+                self.queued = queued
+                if not batch and queued and failure is None:
+                    # Waiting for the statements of another source.
+                    if self.closing and time.monotonic() >= self.deadline:
+                        return
+                    self.condition.wait(self.retry)
+                    continue
+                if failure is not None:
+                    print("Database write of {} statements postponed: {}".format(len(batch), failure),
+                          file=sys.stderr)
+                    if self.closing and time.monotonic() >= self.deadline:
+                        return
+                    self.condition.wait(self.retry)
+                    continue
+                self.since = time.monotonic() if queued else None
+                self.batches += 1
+                self.condition.notify_all()
+
+    @staticmethod
+    def _groups(batch: list) -> list:
+        groups = []
+        for (_, statement, params) in batch:
+            if groups and groups[-1][0] == statement:
+                groups[-1][1].append(params)
+            else:
+                groups.append((statement, [params]))
+        return groups
+
+    def _write(self, batch: list):
+        """ Execute the batch in one transaction and remove the written statements from the journal.
+
+            :raise OperationalError: The database can not be reached.
+            """
+        connection = self.pool.acquire(self.timeout)
+        broken = False
+        done = []
+        try:
+            cursor = connection.cursor()
+            try:
+                for (statement, rows) in self._groups(batch):
+                    cursor.executemany(statement, rows)
+                connection.commit()
+                done = [row_id for (row_id, _, _) in batch]
+                return
+            except OperationalError:
+                broken = True
+                raise
+            except MySQLError:
+                connection.rollback()
+            # Something was rejected, find it by writing the statements one by one.
+            for (row_id, statement, params) in batch:
+                try:
+                    cursor.execute(statement, params)
+                    connection.commit()
+                except OperationalError:
+                    broken = True
+                    raise
+                except MySQLError as error:
+                    connection.rollback()
+                    print("Database rejected {} {}: {}".format(statement.split()[0], params, error),
+                          file=sys.stderr)
+                    with self.condition:
+                        self.rejected += 1
+                done.append(row_id)
+        finally:
+            self.pool.release(connection, broken)
+            self.journal.done(done)
+            with self.condition:
+                self.written += len(done)
+
+    def flush(self, timeout: float = None) -> bool:
+        """ Write the queued statements now and wait for them.
+
+            :param timeout: Seconds to wait.
+            :return: Whether the queue became empty in time.
+            """
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                return self.condition.wait_for(lambda: not self.queued, timeout)
+            finally:
+                self.flushing -= 1
+
+    def close(self):
+        """ Try to write the queued statements and stop the writer thread.
+            """
+        with self.condition:
+            self.closing = True
+            self.deadline = time.monotonic() + self.shutdown_timeout
+            self.condition.notify_all()
+        self.thread.join(self.shutdown_timeout + self.timeout)
+        with self.condition:
+            if self.queued:
+                print("{} database writes are kept in the journal for the next run.".format(self.queued),
+                      file=sys.stderr)
+
+    def stats(self) -> dict:
+        """ Queued, written and rejected statements, batches written.
+            """
+        with self.condition:
+            return {
+                'pending': self.queued,
+                'written': self.written,
+                'rejected': self.rejected,
+                'batches': self.batches
+            }
+
+    def __enter__(self):
+        return self
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
 if __name__ == '__main__':
     database = DatabaseConnection()
     events = """
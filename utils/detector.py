@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Pluggable motion detector engines.
+    """
+
+from collections import namedtuple
+import glob
+import os
+import sys
+import time
+
+import numpy
+
+try:
+    from utils import settings
+    from utils.camera import VECTOR_TYPE, vector_shape
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import settings
+    # noinspection PyUnresolvedReferences
+    from camera import VECTOR_TYPE, vector_shape
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['Motion', 'Detector', 'LoopDetector', 'NumpyDetector', 'GridDetector', 'BackgroundDetector',
+           'VectorDetector', 'DETECTORS', 'create', 'configured', 'bitmap', 'replay']
+
+Motion = namedtuple('Motion', ['detected', 'diff_cnt', 'cells'])
+Motion.__new__.__defaults__ = (None,)
+
+
+def _plane(frame: numpy.ndarray) -> numpy.ndarray:
+    """ Green channel of an RGB frame or the frame itself if it is already a luma plane.
+        """
+    if frame.ndim == 3:
+        return frame[:, :, 1]
+    return frame
+
+
+class Detector:
+    """ Base class of the motion detectors.
+
+        Detectors are fed with consecutive frames and keep whatever state they need between them.
+        """
+
+    threshold = 10  # How Much pixel changes
+    sensitivity = 100  # How many pixels change
+
+    def __init__(self, threshold: int = None, sensitivity: int = None):
+        if threshold is not None:
+            self.threshold = threshold
+        if sensitivity is not None:
+            self.sensitivity = sensitivity
+        self.previous = None
+
+    def reset(self):
+        """ Forget the previous frame.
+            """
+        self.previous = None
+
+    def compare(self, previous: numpy.ndarray, current: numpy.ndarray) -> int:
+        """ Count the changed pixels between two frames.
+
+            :param previous: Older frame.
+            :param current: Newer frame.
+            """
+        raise NotImplementedError()
+
+    def feed(self, frame: numpy.ndarray) -> Motion:
+        """ Compare the frame to the previous one.
+
+            :param frame: RGB or luma frame.
+            :return: None for the very first frame.
+            """
+        if frame is None:
+            return None
+        previous, self.previous = self.previous, frame
+        if previous is None:
+            return None
+        return self.motion(previous, frame)
+
+    def motion(self, previous: numpy.ndarray, current: numpy.ndarray) -> Motion:
+        """ Decide whether there is motion between two frames.
+
+            :param previous: Older frame.
+            :param current: Newer frame.
+            """
+        diff_cnt = self.compare(previous, current)
+        return Motion(diff_cnt > self.sensitivity, diff_cnt)
+
+
+class LoopDetector(Detector):
+    """ The original per pixel Python loop, kept for reference.
+        """
+
+    def compare(self, previous: numpy.ndarray, current: numpy.ndarray) -> int:
+        height, width = previous.shape[:2]
+        data1 = _plane(previous)
+        data2 = _plane(current)
+        diff_count = 0
+        for w in range(0, width):
+            for h in range(0, height):
+                # Conversion to int is required to avoid unsigned short overflow.
+                diff = abs(int(data1[h][w]) - int(data2[h][w]))
+                if diff > self.threshold:
+                    diff_count += 1
+            if diff_count > self.sensitivity:
+                break
+        return diff_count
+
+
+class NumpyDetector(Detector):
+    """ Difference, threshold and count in one vectorized pass.
+
+        The scratch buffers are allocated once per resolution and reused for every comparison.
+        """
+
+    def __init__(self, threshold: int = None, sensitivity: int = None):
+        super().__init__(threshold, sensitivity)
+        self._diff = None
+        self._mask = None
+
+    def _scratch(self, shape: tuple):
+        if self._diff is None or self._diff.shape != shape:
+            self._diff = numpy.empty(shape, dtype=numpy.int16)
+            self._mask = numpy.empty(shape, dtype=numpy.bool_)
+
+    def compare(self, previous: numpy.ndarray, current: numpy.ndarray) -> int:
+        data1 = _plane(previous)
+        data2 = _plane(current)
+        self._scratch(data1.shape)
+        # Widening to int16 is required to avoid unsigned byte overflow.
+        numpy.subtract(data1, data2, out=self._diff, dtype=numpy.int16)
+        numpy.abs(self._diff, out=self._diff)
+        numpy.greater(self._diff, self.threshold, out=self._mask)
+        return int(numpy.count_nonzero(self._mask))
+
+
+class GridDetector(NumpyDetector):
+    """ Motion map of a grid of cells.
+
+        The changed pixels are counted per cell in the same vectorized pass. A cell is active if its ratio of
+        changed pixels exceeds its own threshold and it is not masked out. There is motion if at least min_cells
+        cells are active.
+        """
+
+    def __init__(self,
+                 threshold: int = None,
+                 grid: tuple = (16, 16),
+                 cell_threshold=0.2,
+                 mask: numpy.ndarray = None,
+                 min_cells: int = 1):
+        """ Constructor.
+
+            :param threshold: How much a pixel has to change.
+            :param grid: Rows and columns.
+            :param cell_threshold: Ratio of changed pixels, scalar or one value per cell.
+            :param mask: Boolean array of enabled cells, all of them if None.
+            :param min_cells: Active cells needed for motion.
+            """
+        super().__init__(threshold)
+        self.grid = grid
+        self.cell_threshold = numpy.broadcast_to(numpy.asarray(cell_threshold, dtype=numpy.float32), grid)
+        self.mask = numpy.ones(grid, dtype=numpy.bool_) if mask is None else numpy.asarray(mask, dtype=numpy.bool_)
+        self.min_cells = min_cells
+
+    def motion(self, previous: numpy.ndarray, current: numpy.ndarray) -> Motion:
+        self.compare(previous, current)
+        (rows, cols) = self.grid
+        (height, width) = self._mask.shape
+        (cell_height, cell_width) = (height // rows, width // cols)
+        changed = self._mask[:rows * cell_height, :cols * cell_width]\
+            .reshape(rows, cell_height, cols, cell_width)\
+            .sum(axis=(1, 3))
+        changed *= self.mask
+        cells = (changed > self.cell_threshold * (cell_height * cell_width)) & self.mask
+        return Motion(int(numpy.count_nonzero(cells)) >= self.min_cells, int(changed.sum()), cells)
+
+
+class BackgroundDetector(Detector):
+    """ Compare frames to an exponentially weighted running average of the scene instead of the previous frame.
+
+        The model keeps the mean and the variance of every pixel, a pixel changed if it deviates more than
+        deviations times its standard deviation, but at least deviations times the noise floor. A global
+        brightness shift, e.g. auto exposure, is subtracted first. Every buffer is allocated once per resolution
+        and updated in place.
+        """
+
+    deviations = 3  # how many standard deviations make a change
+
+    def __init__(self,
+                 sensitivity: int = None,
+                 learning_rate: float = 0.05,
+                 noise_floor: float = 3.0,
+                 compensate: bool = True):
+        """ Constructor.
+
+            :param sensitivity: How many pixels change.
+            :param learning_rate: Weight of the new frame in the model, between 0 and 1.
+            :param noise_floor: Minimum standard deviation of a pixel.
+            :param compensate: Subtract global brightness changes.
+            """
+        super().__init__(sensitivity=sensitivity)
+        self.learning_rate = learning_rate
+        self.noise_floor = noise_floor
+        self.compensate = compensate
+        self.background = None
+        self._variance = None
+        self._delta = None
+        self._square = None
+        self._limit = None
+        self._mask = None
+
+    def reset(self):
+        """ Relearn the scene from the next frame.
+            """
+        self.background = None
+
+    def _allocate(self, plane: numpy.ndarray):
+        if self._delta is None or self._delta.shape != plane.shape:
+            self._delta = numpy.empty(plane.shape, dtype=numpy.float32)
+            self._square = numpy.empty(plane.shape, dtype=numpy.float32)
+            self._limit = numpy.empty(plane.shape, dtype=numpy.float32)
+            self._mask = numpy.empty(plane.shape, dtype=numpy.bool_)
+            self._variance = numpy.empty(plane.shape, dtype=numpy.float32)
+        # reset() drops the model, it is allocated again only then.
+        self.background = plane.astype(numpy.float32)
+        self._variance.fill(self.noise_floor ** 2)
+
+    def feed(self, frame: numpy.ndarray) -> Motion:
+        """ Compare the frame to the model and learn it.
+
+            :param frame: RGB or luma frame.
+            :return: None for the very first frame.
+            """
+        if frame is None:
+            return None
+        plane = _plane(frame)
+        if self.background is None or self.background.shape != plane.shape:
+            self._allocate(plane)
+            return None
+        (delta, square, limit) = (self._delta, self._square, self._limit)
+        numpy.subtract(plane, self.background, out=delta)
+        shift = delta.mean() if self.compensate else 0
+        delta -= shift
+        # Changed if delta ** 2 > deviations ** 2 * max(variance, noise_floor ** 2)
+        numpy.square(delta, out=square)
+        numpy.maximum(self._variance, self.noise_floor ** 2, out=limit)
+        limit *= self.deviations ** 2
+        numpy.greater(square, limit, out=self._mask)
+        diff_cnt = int(numpy.count_nonzero(self._mask))
+        # variance += learning_rate * (delta ** 2 - variance)
+        numpy.subtract(square, self._variance, out=limit)
+        limit *= self.learning_rate
+        self._variance += limit
+        # background += learning_rate * delta, including the global shift
+        delta += shift
+        delta *= self.learning_rate
+        self.background += delta
+        return Motion(diff_cnt > self.sensitivity, diff_cnt)
+
+
+class VectorDetector(Detector):
+    """ Trigger on the macroblock motion vectors of the H.264 encoder instead of decoded frames.
+
+        A vector is moving if it is longer than magnitude. Isolated moving vectors are noise, only those having
+        at least cluster moving vectors in their 3x3 neighbourhood, themselves included, are counted.
+        """
+
+    sensitivity = 10  # How many clustered vectors move
+    magnitude = 10  # How long a moving vector is
+    cluster = 4  # How many neighbours move together
+
+    def __init__(self, sensitivity: int = None, magnitude: int = None, cluster: int = None):
+        super().__init__(sensitivity=sensitivity)
+        if magnitude is not None:
+            self.magnitude = magnitude
+        if cluster is not None:
+            self.cluster = cluster
+        self._length = None
+        self._square = None
+        self._moving = None
+        self._padded = None
+        self._neighbours = None
+
+    def _allocate(self, shape: tuple):
+        if self._length is None or self._length.shape != shape:
+            (rows, cols) = shape
+            self._length = numpy.empty(shape, dtype=numpy.int32)
+            self._square = numpy.empty(shape, dtype=numpy.int32)
+            self._moving = numpy.empty(shape, dtype=numpy.bool_)
+            self._padded = numpy.zeros((rows + 2, cols + 2), dtype=numpy.uint8)
+            self._neighbours = numpy.empty(shape, dtype=numpy.uint8)
+
+    def feed(self, vectors: numpy.ndarray) -> Motion:
+        """ Count the clustered moving vectors.
+
+            :param vectors: Motion vectors of one frame, including the extra column of the encoder.
+            """
+        if vectors is None:
+            return None
+        vectors = vectors[:, :-1]
+        self._allocate(vectors.shape)
+        (rows, cols) = vectors.shape
+        numpy.multiply(vectors['x'], vectors['x'], out=self._length, dtype=numpy.int32)
+        numpy.multiply(vectors['y'], vectors['y'], out=self._square, dtype=numpy.int32)
+        self._length += self._square
+        numpy.greater(self._length, self.magnitude ** 2, out=self._moving)
+        self._padded[1:-1, 1:-1] = self._moving
+        self._neighbours.fill(0)
+        for dy in range(3):
+            for dx in range(3):
+                self._neighbours += self._padded[dy:dy + rows, dx:dx + cols]
+        numpy.greater_equal(self._neighbours, self.cluster, out=self._moving, where=self._moving)
+        diff_cnt = int(numpy.count_nonzero(self._moving))
+        return Motion(diff_cnt > self.sensitivity, diff_cnt)
+
+
+DETECTORS = {
+    'loop': LoopDetector,
+    'numpy': NumpyDetector,
+    'grid': GridDetector,
+    'background': BackgroundDetector,
+    'vectors': VectorDetector,
+}
+
+
+def create(name: str, **kwargs) -> Detector:
+    """ Instantiate detector by name.
+
+        :param name: Key of DETECTORS.
+        :param kwargs: Constructor parameters.
+        """
+    try:
+        return DETECTORS[name.lower()](**kwargs)
+    except KeyError:
+        raise ValueError("Unknown detector: {}".format(name))
+
+
+def bitmap(cells: numpy.ndarray) -> str:
+    """ Active cells as hexadecimal string, row by row, most significant bit first.
+
+        :param cells: Boolean array.
+        """
+    return bytes(numpy.packbits(cells.ravel())).hex()
+
+
+def read_pgm(filename: str) -> numpy.ndarray:
+    """ Read binary grayscale (P5) portable graymap image, e.g. exported by GIMP.
+
+        :param filename: Image file.
+        """
+    with open(filename, 'rb') as file:
+        data = file.read()
+    fields = []
+    position = 0
+    while len(fields) < 4:
+        while data[position:position + 1].isspace():
+            position += 1
+        if data[position:position + 1] == b'#':
+            position = data.index(b'\n', position)
+            continue
+        start = position
+        while not data[position:position + 1].isspace():
+            position += 1
+        fields.append(data[start:position])
+    if fields[0] != b'P5':
+        raise ValueError("Not a binary PGM image: {}".format(filename))
+    (width, height, maxval) = (int(field) for field in fields[1:])
+    dtype = numpy.uint8 if maxval < 256 else numpy.dtype('>u2')
+    return numpy.frombuffer(data, dtype=dtype, count=width * height, offset=position + 1).reshape(height, width)
+
+
+def image_mask(image: numpy.ndarray, grid: tuple) -> numpy.ndarray:
+    """ Enabled cells of a mask image: white areas are watched, black ones ignored.
+
+        :param image: Grayscale image of any size.
+        :param grid: Rows and columns.
+        """
+    (rows, cols) = grid
+    (cell_height, cell_width) = (image.shape[0] // rows, image.shape[1] // cols)
+    cells = image[:rows * cell_height, :cols * cell_width]\
+        .reshape(rows, cell_height, cols, cell_width)\
+        .mean(axis=(1, 3))
+    return cells > image.max() / 2
+
+
+def polygon_mask(polygons: list, grid: tuple) -> numpy.ndarray:
+    """ Cells whose center lies inside any of the polygons.
+
+        :param polygons: Lists of (x, y) vertices relative to the frame size, between 0 and 1.
+        :param grid: Rows and columns.
+        """
+    (rows, cols) = grid
+    (y, x) = numpy.mgrid[0:rows, 0:cols]
+    (x, y) = ((x + 0.5) / cols, (y + 0.5) / rows)
+    inside = numpy.zeros(grid, dtype=numpy.bool_)
+    for polygon in polygons:
+        crossing = numpy.zeros(grid, dtype=numpy.bool_)
+        for ((x1, y1), (x2, y2)) in zip(polygon, polygon[1:] + polygon[:1]):
+            if y1 == y2:
+                continue
+            # Ray casting to the right.
+            crossing ^= ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        inside |= crossing
+    return inside
+
+
+def configured() -> Detector:
+    """ Detector set up according to the settings.
+        """
+    name = settings.config.detector
+    if name == 'vectors':
+        return create(name, magnitude=settings.config.vector_magnitude, cluster=settings.config.vector_cluster)
+    if name == 'background':
+        return create(name, learning_rate=settings.config.learning_rate, noise_floor=settings.config.noise_floor)
+    if name != 'grid':
+        return create(name)
+    grid = settings.config.grid
+    mask = numpy.ones(grid, dtype=numpy.bool_)
+    if settings.config.mask:
+        mask &= image_mask(read_pgm(settings.config.mask), grid)
+    if settings.config.include:
+        mask &= polygon_mask(settings.config.include, grid)
+    if settings.config.exclude:
+        mask &= ~polygon_mask(settings.config.exclude, grid)
+    if settings.config.cell_thresholds:
+        cell_threshold = numpy.loadtxt(settings.config.cell_thresholds, ndmin=2)
+    else:
+        cell_threshold = settings.config.cell_threshold
+    return create(name, grid=grid, cell_threshold=cell_threshold, mask=mask, min_cells=settings.config.min_cells)
+
+
+def replay(filename: str, resolution: tuple):
+    """ Motion vector arrays recorded by picamera with motion_output set to a file.
+
+        :param filename: Raw motion data file.
+        :param resolution: Width and height of the recording.
+        """
+    shape = vector_shape(resolution)
+    size = shape[0] * shape[1] * VECTOR_TYPE.itemsize
+    with open(filename, 'rb') as file:
+        while True:
+            buf = file.read(size)
+            if len(buf) < size:
+                return
+            yield numpy.frombuffer(buf, dtype=VECTOR_TYPE).reshape(shape)
+
+
+def _load_frames(directory: str) -> list:
+    """ Load frames recorded with numpy.save().
+        """
+    return [numpy.load(file) for file in sorted(glob.glob(os.path.join(directory, '*.npy')))]
+
+
+def _random_frames(width: int, height: int, count: int = 10) -> list:
+    """ Noisy frames when there are no recorded ones.
+        """
+    generator = numpy.random.RandomState(0)
+    base = generator.randint(0, 256, (height, width, 3)).astype(numpy.uint8)
+    noise = generator.randint(-15, 16, (count, height, width, 3))
+    return [numpy.clip(base + n, 0, 255).astype(numpy.uint8) for n in noise]
+
+
+def benchmark(frames: list, detector: Detector, repeat: int = 3) -> float:
+    """ Average seconds of one frame.
+
+        :param frames: Consecutive frames or motion vector arrays.
+        :param detector: Detector under test.
+        :param repeat: Passes over the frames.
+        """
+    detector.feed(frames[0])
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for frame in frames[1:]:
+            detector.feed(frame)
+    return (time.perf_counter() - start) / (repeat * (len(frames) - 1))
+
+
+if __name__ == '__main__':
+    # Usage: detector.py [directory of recorded *.npy frames | recorded motion vector file [WIDTHxHEIGHT]]
+    if len(sys.argv) > 1 and os.path.isfile(sys.argv[1]):
+        size = tuple(int(n) for n in (sys.argv[2] if len(sys.argv) > 2 else '1920x1080').split('x'))
+        vector_frames = list(replay(sys.argv[1], size))
+        engine = VectorDetector()
+        for (number, vector_frame) in enumerate(vector_frames):
+            motion = engine.feed(vector_frame)
+            if motion.detected:
+                print("Frame {}: {} clustered vectors".format(number, motion.diff_cnt))
+        print("{:>10} {:>10}: {:10.3f} ms/frame".format('recorded', 'vectors', benchmark(vector_frames, engine) * 1000))
+        sys.exit()
+    if len(sys.argv) > 1:
+        samples = [('recorded', _load_frames(sys.argv[1]))]
+    else:
+        samples = [('{}x{}'.format(w, h), _random_frames(w, h)) for (w, h) in [(100, 75), (320, 240), (640, 480)]]
+    for (name, frames) in samples:
+        # The loop stops counting early, so measure it with a sensitivity it never reaches.
+        engines = [
+            ('loop', LoopDetector(sensitivity=sys.maxsize)),
+            ('numpy', NumpyDetector()),
+            ('grid', GridDetector()),
+            ('background', BackgroundDetector())]
+        for (key, engine) in engines:
+            elapsed = benchmark(frames, engine, repeat=1 if key == 'loop' else 10)
+            print("{:>10} {:>10}: {:10.3f} ms/frame".format(name, key, elapsed * 1000))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Paginated listing of the events.
+    """
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+import datetime
+import json
+import random
+import sys
+import time
+
+try:
+    from utils.database import DatabaseConnection, pool
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from database import DatabaseConnection, pool
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['PAGE_SIZE', 'Filter', 'page', 'locations', 'version', 'encode_cursor', 'decode_cursor']
+
+PAGE_SIZE = 50
+
+
+class Filter:
+    """ Conditions of the listing, newest events first.
+        """
+
+    def __init__(self, location: str = None, since: datetime.date = None, until: datetime.date = None):
+        """ Constructor.
+
+            :param location: Camera, all if None.
+            :param since: First day, inclusive.
+            :param until: Last day, inclusive.
+            """
+        self.location = location or None
+        self.since = since
+        self.until = until
+
+    @staticmethod
+    def _date(value: str) -> datetime.date:
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date() if value else None
+        except ValueError:
+            return None
+
+    @classmethod
+    def parse(cls, query) -> 'Filter':
+        """ Filter from the query string, invalid dates are ignored.
+
+            :param query: Mapping of the parameters, e.g. bottle.request.query.
+            """
+        return cls(query.get('location'), cls._date(query.get('since')), cls._date(query.get('until')))
+
+    def where(self, cursor: tuple = None) -> tuple:
+        """ WHERE clause and its parameters.
+
+            :param cursor: Time and file of the last event of the previous page.
+            """
+        conditions = []
+        params = []
+        if self.location is not None:
+            conditions.append("location = %s")
+            params.append(self.location)
+        if self.since is not None:
+            conditions.append("time >= %s")
+            params.append(str(self.since))
+        if self.until is not None:
+            conditions.append("time < %s")
+            params.append(str(self.until + datetime.timedelta(days=1)))
+        if cursor is not None:
+            # Spelled out instead of a row comparison, so MySQL uses the (time, file) index for the range.
+            conditions.append("(time < %s OR (time = %s AND file < %s))")
+            params.extend([cursor[0], cursor[0], cursor[1]])
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def key(self) -> tuple:
+        """ Hashable identity of the filter.
+            """
+        return self.location, self.since, self.until
+
+    def query(self) -> dict:
+        """ Query string parameters of the filter.
+            """
+        params = {}
+        if self.location is not None:
+            params['location'] = self.location
+        if self.since is not None:
+            params['since'] = str(self.since)
+        if self.until is not None:
+            params['until'] = str(self.until)
+        return params
+
+
+def encode_cursor(row_time, file: str) -> str:
+    """ Opaque URL parameter pointing after an event.
+
+        :param row_time: Time of the event.
+        :param file: File of the event.
+        """
+    return urlsafe_b64encode(json.dumps([str(row_time), file]).encode()).decode()
+
+
+def decode_cursor(value: str) -> tuple:
+    """ Time and file encoded by encode_cursor(), None if value is empty or invalid.
+        """
+    if not value:
+        return None
+    try:
+        (row_time, file) = json.loads(urlsafe_b64decode(value.encode()).decode())
+        return str(row_time), str(file)
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
+def page(database, condition: Filter, cursor: tuple = None, limit: int = PAGE_SIZE) -> tuple:
+    """ One page of events, newest first.
+
+        :param database: DatabaseConnection or Journal.
+        :param condition: Filter of the events.
+        :param cursor: Time and file of the last event of the previous page, the first page if None.
+        :param limit: Events on the page.
+        :return: Rows of file, location, time, size and url, and the cursor of the next page or None.
+        """
+    (where, params) = condition.where(cursor)
+    rows = database.query("""
+        SELECT file,
+               location,
+               time,
+               size,
+               url
+          FROM events{}
+         ORDER BY time DESC, file DESC
+         LIMIT %s
+        """.format(where), params + [limit + 1]) or []
+    if len(rows) > limit:
+        rows = rows[:limit]
+        (file, _, row_time, _, _) = rows[-1]
+        return rows, (str(row_time), file)
+    return rows, None
+
+
+def locations(database) -> list:
+    """ Cameras having events.
+
+        :param database: DatabaseConnection or Journal.
+        """
+    rows = database.query("SELECT DISTINCT location FROM events ORDER BY location")
+    return [location for (location,) in rows] if rows else []
+
+
+def version(database) -> tuple:
+    """ Time of the newest event and of the latest upload, both read from an index.
+
+        :param database: DatabaseConnection or Journal.
+        """
+    rows = database.query("SELECT MAX(time), MAX(uploaded) FROM events")
+    return tuple(str(value) for value in rows[0]) if rows else None
+
+
+def _seed(count: int, cameras: int = 4, batch: int = 5000):
+    """ Insert count events a minute apart at benchmark locations, one transaction per batch.
+        """
+    connection = pool.acquire()
+    try:
+        cursor = connection.cursor()
+        start = datetime.datetime.now() - datetime.timedelta(minutes=count)
+        for offset in range(0, count, batch):
+            rows = []
+            for index in range(offset, min(count, offset + batch)):
+                event_time = start + datetime.timedelta(minutes=index)
+                rows.append((
+                    '/benchmark/{:08d}.h264'.format(index),
+                    'benchmark-{}'.format(index % cameras),
+                    random.randint(1000000, 30000000),
+                    random.randint(100, 5000),
+                    event_time.replace(microsecond=0)))
+            cursor.executemany(
+                "INSERT INTO events(file, location, size, diff_cnt, time) VALUES (%s, %s, %s, %s, %s)", rows)
+            connection.commit()
+    finally:
+        pool.release(connection)
+
+
+def _clean():
+    with DatabaseConnection() as database:
+        database.dml("DELETE FROM events WHERE location LIKE 'benchmark-%'")
+
+
+def _measure(name: str, action, repeat: int = 5):
+    elapsed = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = action()
+        elapsed.append(time.perf_counter() - started)
+    print("{:<32} {:9.2f} ms".format(name, 1000 * min(elapsed)))
+    return result
+
+
+def benchmark(count: int):
+    """ Seed count events into MySQL and compare the full listing with the pages.
+
+        Needs the indexes of migration 02_events_time.sql, the seeded rows are deleted at the end.
+        """
+    print("Seeding {} events...".format(count), flush=True)
+    started = time.perf_counter()
+    _seed(count)
+    print("Seeded in {:.1f} s.".format(time.perf_counter() - started))
+    try:
+        with DatabaseConnection() as database:
+            _measure("full listing (old home page)", lambda: database.query(
+                "SELECT file, location, time, size, url FROM events"), repeat=1)
+            everything = Filter()
+            (_, cursor) = _measure("first page", lambda: page(database, everything))
+            deep = cursor
+            for _ in range(100):
+                (_, deep) = page(database, everything, deep)
+            _measure("page 100", lambda: page(database, everything, deep))
+            camera = Filter('benchmark-1')
+            _measure("first page of one camera", lambda: page(database, camera))
+            today = datetime.date.today()
+            week = Filter(since=today - datetime.timedelta(days=7), until=today)
+            _measure("first page of last week", lambda: page(database, week))
+            _measure("cameras", lambda: locations(database))
+    finally:
+        _clean()
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 300000)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Local SQLite journal of the database writes.
+    """
+
+import json
+from os import path
+import sqlite3
+import threading
+import time
+
+try:
+    from utils import settings
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import settings
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['Journal']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  source TEXT NOT NULL,
+  statement TEXT NOT NULL,
+  params TEXT NOT NULL,
+  created REAL NOT NULL,
+  key TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_source ON pending (source, id);
+CREATE INDEX IF NOT EXISTS pending_key ON pending (key, id);
+CREATE TABLE IF NOT EXISTS events (
+  file TEXT NOT NULL PRIMARY KEY,
+  location TEXT NOT NULL,
+  size INTEGER DEFAULT NULL,
+  diff_cnt INTEGER DEFAULT NULL,
+  cells TEXT DEFAULT NULL,
+  time TEXT NOT NULL,
+  url TEXT DEFAULT NULL,
+  uploaded TEXT DEFAULT NULL,
+  evicted TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time, file);
+CREATE INDEX IF NOT EXISTS events_location_time ON events (location, time, file);
+CREATE INDEX IF NOT EXISTS events_uploaded ON events (uploaded);
+"""
+
+
+class Journal:
+    """ Durable queue of the statements waiting for MySQL in a SQLite database in WAL mode.
+
+        Every statement is also applied to a local copy of the events table, so recent events can be read without
+        MySQL. Statements use the %s placeholders of PyMySQL, those the local copy does not understand only go
+        to the queue. The daemons share the file, each replays the statements of its own source only.
+        """
+
+    timeout = 30  # seconds to wait for a lock held by another process
+
+    def __init__(self, filename: str = None):
+        """ Constructor, creates the file if needed.
+
+            :param filename: SQLite database, journal.db in the working directory if None.
+            """
+        self.filename = filename if filename is not None else path.join(settings.config.working_dir, 'journal.db')
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.filename, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # Committed transactions survive a crash of the process, a power loss may lose the last ones.
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    @staticmethod
+    def _local(statement: str) -> str:
+        return statement.replace('%s', '?')
+
+    def append(self, source: str, statement: str, params, key: str = None):
+        """ Queue a statement for MySQL and apply it to the local events.
+
+            :param source: Name of the replaying process.
+            :param statement: SQL with %s placeholders.
+            :param params: Values of the placeholders, anything else than numbers and strings is stored as string.
+            :param key: Row changed by the statement, e.g. the file of the event, see pending().
+            """
+        encoded = json.dumps(list(params), default=str)
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    'INSERT INTO pending (source, statement, params, created, key) VALUES (?, ?, ?, ?, ?)',
+                    (source, statement, encoded, time.time(), key))
+                self.connection.execute('SAVEPOINT local')
+                try:
+                    self.connection.execute(self._local(statement), json.loads(encoded))
+                    self.connection.execute('RELEASE local')
+                except sqlite3.Error:
+                    self.connection.execute('ROLLBACK TO local')
+                    self.connection.execute('RELEASE local')
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def pending(self, source: str, limit: int) -> list:
+        """ Oldest statements waiting for MySQL that may be written now.
+
+            The sources replay independently, but a statement is held back while another source still has an earlier
+            statement with the same key. So e.g. the update of an event never reaches MySQL before the insert of the
+            event. Only the statements of that key wait, so a source that never replays again, e.g. the recorder
+            after the pipeline was switched off, holds back nothing else.
+
+            :param source: Name of the replaying process.
+            :param limit: Maximum number of statements.
+            :return: Id, SQL and parameters.
+            """
+        with self.lock:
+            rows = self.connection.execute("""
+                SELECT id, statement, params
+                  FROM pending
+                 WHERE source = ?
+                   AND NOT (key IS NOT NULL AND EXISTS (
+                           SELECT 1
+                             FROM pending AS earlier
+                            WHERE earlier.key = pending.key
+                              AND earlier.id < pending.id
+                              AND earlier.source <> pending.source))
+                 ORDER BY id
+                 LIMIT ?
+                """, (source, limit)).fetchall()
+        return [(row_id, statement, json.loads(params)) for (row_id, statement, params) in rows]
+
+    def count(self, source: str) -> int:
+        """ Number of statements waiting for MySQL.
+
+            :param source: Name of the replaying process.
+            """
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM pending WHERE source = ?', (source,)).fetchone()[0]
+
+    def done(self, ids: list):
+        """ Forget statements written to MySQL.
+
+            :param ids: Ids returned by pending().
+            """
+        if not ids:
+            return
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany('DELETE FROM pending WHERE id = ?', [(row_id,) for row_id in ids])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def query(self, query: str, params=None):
+        """ Query the local events like DatabaseConnection.query().
+
+            :param query: SQL with %s placeholders.
+            :param params: Values of the placeholders.
+            :return: Rows, None if there are none.
+            """
+        with self.lock:
+            rows = self.connection.execute(self._local(query), params or ()).fetchall()
+        return rows if rows else None
+
+    def close(self):
+        """ Close the database.
+            """
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    with Journal() as journal:
+        for (source, count) in journal.connection.execute(
+                'SELECT source, COUNT(*) FROM pending GROUP BY source').fetchall():
+            print("{}: {} statements waiting for MySQL".format(source, count))
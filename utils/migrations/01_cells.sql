@@ -0,0 +1,6 @@
+-- Active cells of the grid motion detector as hexadecimal bitmap, row by row.
+
+USE motion;
+
+ALTER TABLE events
+  ADD COLUMN cells varchar(256) COLLATE utf8_bin DEFAULT NULL AFTER diff_cnt;
@@ -0,0 +1,7 @@
+-- Indexes of the paginated events listing, newest first, optionally filtered by camera.
+
+USE motion;
+
+ALTER TABLE events
+  ADD INDEX events_time (time, file),
+  ADD INDEX events_location_time (location, time, file);
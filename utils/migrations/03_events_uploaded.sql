@@ -0,0 +1,6 @@
+-- Index of the latest upload, part of the version stamp of the cached events pages.
+
+USE motion;
+
+ALTER TABLE events
+  ADD INDEX events_uploaded (uploaded);
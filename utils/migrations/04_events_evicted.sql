@@ -0,0 +1,6 @@
+-- Time the clip was deleted from the working directory by the retention of the motion daemon.
+
+USE motion;
+
+ALTER TABLE events
+  ADD COLUMN evicted timestamp NULL DEFAULT NULL AFTER uploaded;
@@ -7,10 +7,15 @@ CREATE TABLE IF NOT EXISTS events (
   location varchar(50) COLLATE utf8_bin NOT NULL,
   size int(11) DEFAULT NULL,
   diff_cnt int(11) DEFAULT NULL,
+  cells varchar(256) COLLATE utf8_bin DEFAULT NULL,
   time timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
   url varchar(500) COLLATE utf8_bin DEFAULT NULL,
   uploaded timestamp NULL DEFAULT NULL,
-  PRIMARY KEY (file)
+  evicted timestamp NULL DEFAULT NULL,
+  PRIMARY KEY (file),
+  KEY events_time (time, file),
+  KEY events_location_time (location, time, file),
+  KEY events_uploaded (uploaded)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
 
 CREATE USER 'picam'@'localhost';
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Building blocks for running capture, detection and recording in separate processes.
+
+    Needs Python 3.8 or newer for multiprocessing.shared_memory.
+    """
+
+import multiprocessing
+from multiprocessing import shared_memory
+import struct
+import time
+
+import numpy
+
+try:
+    from utils.camera import CameraError
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from camera import CameraError
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['FrameRing', 'PipeFile', 'RemoteSession']
+
+# Every message of a PipeFile starts with the number of the recording.
+RECORDING = struct.Struct('<I')
+
+
+class FrameRing:
+    """ Slots of equally shaped frames in shared memory written by one process and read by another one.
+
+        The reader gets a view of the slot without copying. The last two frames handed out by get() are the
+        previous and the current frame of the detector, the writer never overwrites them until the next call, so
+        there must be at least four slots.
+        """
+
+    def __init__(self, shape: tuple, dtype=numpy.uint8, slots: int = 4):
+        """ Constructor, allocates the shared memory.
+
+            :param shape: Shape of one frame.
+            :param dtype: Type of the frame elements.
+            :param slots: Number of frames.
+            """
+        if slots < 4:
+            raise ValueError("A ring needs at least 4 slots, got {}".format(slots))
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.slots = slots
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=max(1, slots * int(numpy.prod(self.shape)) * self.dtype.itemsize))
+        self.owner = True
+        self.condition = multiprocessing.Condition()
+        self.seq = multiprocessing.RawValue('Q', 0)
+        self.slot = multiprocessing.RawValue('i', -1)
+        self.held = multiprocessing.RawArray('i', [-1, -1])
+        self.frames = self._frames()
+
+    def _frames(self) -> numpy.ndarray:
+        return numpy.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['frames']
+        state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.frames = self._frames()
+
+    def put(self, frame: numpy.ndarray):
+        """ Copy frame into a free slot and wake up the reader.
+
+            :param frame: Array of the ring's shape.
+            """
+        with self.condition:
+            slot = next(i for i in range(self.slots) if i not in self.held and i != self.slot.value)
+        numpy.copyto(self.frames[slot], frame)
+        with self.condition:
+            self.slot.value = slot
+            self.seq.value += 1
+            self.condition.notify_all()
+
+    def get(self, seq: int, timeout: float = None) -> tuple:
+        """ Wait for a frame newer than seq.
+
+            :param seq: Sequence number of the last frame seen.
+            :param timeout: Seconds to wait.
+            :return: Sequence number and a view of the frame, the frame is None on timeout.
+            """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq.value > seq, timeout):
+                return seq, None
+            self.held[0], self.held[1] = self.held[1], self.slot.value
+            return self.seq.value, self.frames[self.slot.value]
+
+    def close(self):
+        """ Detach from the shared memory and free it in the process that allocated it.
+            """
+        self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class PipeFile:
+    """ Write only file sending the chunks to the other end of a pipe, an empty chunk marks the end.
+
+        The chunks are tagged with the number of the recording, so the reader can skip the rest of a recording
+        it gave up on.
+        """
+
+    def __init__(self, connection, recording: int = 0):
+        """ Constructor.
+
+            :param connection: Sending end of the pipe.
+            :param recording: Number of the recording from RemoteSession.
+            """
+        self.connection = connection
+        self.prefix = RECORDING.pack(recording)
+
+    def write(self, buf) -> int:
+        """ Send a chunk, empty ones are skipped not to end the file.
+            """
+        if len(buf):
+            self.connection.send_bytes(self.prefix + bytes(buf))
+        return len(buf)
+
+    def flush(self):
+        """ Nothing is buffered.
+            """
+
+    def close(self):
+        """ Tell the reader that the file is complete.
+            """
+        self.connection.send_bytes(self.prefix)
+
+
+class RemoteSession:
+    """ Stand-in for CameraSession.record() in a process without the camera.
+
+        The camera process records into a PipeFile and this end writes the chunks into the file. Chunks still
+        arriving from a recording given up after a timeout are dropped by the next one.
+        """
+
+    timeout = 30  # seconds to wait for a chunk beyond the recording duration
+
+    def __init__(self, commands, connection):
+        """ Constructor.
+
+            :param commands: Queue of the camera process receiving the durations to record.
+            :param connection: Receiving end of the pipe.
+            """
+        self.commands = commands
+        self.connection = connection
+        self.recording = 0
+
+    def record(self, filename, duration: int):
+        """ Record full resolution H.264 video starting with the buffered seconds before the call.
+
+            :param filename: Output file name or writable file object, the latter is closed at the end.
+            :param duration: Seconds after the call.
+            """
+        self.recording = (self.recording + 1) % (1 << 32)
+        self.commands.put((self.recording, duration))
+        deadline = time.monotonic() + duration + self.timeout
+        file = open(filename, 'wb') if isinstance(filename, str) else filename
+        name = getattr(file, 'name', 'the clip')
+        try:
+            while True:
+                if not self.connection.poll(max(0.0, deadline - time.monotonic())):
+                    raise CameraError("The camera process did not finish recording {}".format(name))
+                try:
+                    message = self.connection.recv_bytes()
+                except EOFError:
+                    raise CameraError("The camera process exited while recording {}".format(name))
+                (recording,) = RECORDING.unpack_from(message)
+                if recording != self.recording:
+                    continue
+                if len(message) == RECORDING.size:
+                    return
+                file.write(memoryview(message)[RECORDING.size:])
+        finally:
+            file.close()
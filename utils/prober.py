@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Background health checks of the camera streams.
+    """
+
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+import time
+
+from urllib3 import PoolManager, Timeout, exceptions
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['Prober']
+
+
+class Prober:
+    """ Checks every URL concurrently at regular intervals and keeps the results.
+
+        The checks share one connection pool, so a live camera is asked over a kept alive connection. The
+        results are read without waiting, only the very first read waits for the first round, at most as long
+        as a check may take.
+        """
+
+    def __init__(self, urls: list, interval: float = 30, timeout: float = 1.0):
+        """ Constructor.
+
+            :param urls: Addresses answering 200 when up.
+            :param interval: Seconds between the rounds.
+            :param timeout: Seconds to connect and again to read the response.
+            """
+        self.urls = list(urls)
+        self.interval = interval
+        self.timeout = timeout
+        self.http = PoolManager(
+            num_pools=max(1, len(self.urls)), maxsize=1, retries=False,
+            timeout=Timeout(connect=timeout, read=timeout))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.urls)))
+        self.lock = threading.Lock()
+        self.results = {}
+        self.rounds = 0
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _check(self, url: str) -> dict:
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.http.request('GET', url)
+            up = response.status == 200
+            status = response.status
+        except exceptions.HTTPError as error:
+            up = False
+            status = type(error).__name__
+        finally:
+            if response is not None:
+                response.release_conn()
+        return {
+            'up': up,
+            'status': status,
+            'latency': round(1000 * (time.perf_counter() - started), 1),
+            'checked': time.time()
+        }
+
+    def probe(self):
+        """ Check every URL once, concurrently.
+            """
+        results = dict(zip(self.urls, self.executor.map(self._check, self.urls)))
+        with self.lock:
+            self.results = results
+            self.rounds += 1
+        self.ready.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            # noinspection PyBroadException
+            try:
+                self.probe()
+            except:
+                print("Probing the streams failed: {}".format(sys.exc_info()[1]), file=sys.stderr)
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        """ Start the background rounds if not yet running.
+            """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """ Stop the background rounds.
+            """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.shutdown()
+        self.http.clear()
+
+    def status(self) -> dict:
+        """ Latest result of each URL: up, HTTP status or error, latency in milliseconds and time of the check.
+
+            Empty if the first round did not finish in time.
+            """
+        self.start()
+        # A check times out after connecting and again after reading.
+        self.ready.wait(2 * self.timeout)
+        with self.lock:
+            return dict(self.results)
+
+    def up(self, url: str) -> bool:
+        """ Whether the URL answered 200 in the latest round.
+            """
+        return self.status().get(url, {}).get('up', False)
+
+
+if __name__ == '__main__':
+    prober = Prober(sys.argv[1:])
+    prober.probe()
+    for (address, result) in prober.results.items():
+        print("{} {}".format(address, result))
+    prober.stop()
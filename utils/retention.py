@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Retention of the clips in the working directory.
+    """
+
+import datetime
+from fnmatch import fnmatch
+import heapq
+import os
+import sys
+import threading
+
+try:
+    from utils import settings
+    from utils.database import EventWriter
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import settings
+    # noinspection PyUnresolvedReferences
+    from database import EventWriter
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['Retention']
+
+
+class Retention:
+    """ Deletes the oldest clips when they exceed the quota or the disk is fuller than the free space floor.
+
+        The clips are listed once, afterwards the index is kept up to date from the clips added. Clips already
+        uploaded, according to the local copy of the events, go before the ones never uploaded. Every deletion
+        is recorded in the evicted column of the event.
+        """
+
+    batch = 50  # oldest clips checked for an upload at once
+
+    def __init__(self, directory: str, writer: EventWriter, quota: int = None, min_free: int = None,
+                 pattern: str = '*.h264'):
+        """ Constructor, lists the clips.
+
+            :param directory: Working directory.
+            :param writer: Writer of the evictions, its journal tells which clips were uploaded.
+            :param quota: Bytes of clips kept, no limit if 0, settings if None.
+            :param min_free: Bytes kept free on the disk, settings if None.
+            :param pattern: Clips, other files are never deleted.
+            """
+        self.directory = directory
+        self.writer = writer
+        self.quota = quota if quota is not None else settings.config.quota
+        self.min_free = min_free if min_free is not None else settings.config.min_free
+        self.pattern = pattern
+        self.lock = threading.Lock()
+        self.files = {}  # file: (modified, size)
+        self.total = 0
+        self.evicted = 0
+        self.freed = 0
+        if os.path.isdir(directory):
+            for entry in os.scandir(directory):
+                if entry.is_file() and fnmatch(entry.name, pattern):
+                    status = entry.stat()
+                    self.files[entry.path] = (status.st_mtime, status.st_size)
+                    self.total += status.st_size
+
+    def add(self, file: str):
+        """ Register a new clip.
+
+            :param file: Full path of the clip.
+            """
+        try:
+            status = os.stat(file)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            (_, size) = self.files.get(file, (0, 0))
+            self.files[file] = (status.st_mtime, status.st_size)
+            self.total += status.st_size - size
+
+    def free(self) -> int:
+        """ Bytes available on the disk of the working directory.
+            """
+        status = os.statvfs(self.directory)
+        return status.f_bavail * status.f_frsize
+
+    def _excess(self, reserve: int) -> int:
+        excess = self.min_free + reserve - self.free()
+        if self.quota:
+            excess = max(excess, self.total + reserve - self.quota)
+        return excess
+
+    def _uploaded(self, files: list) -> set:
+        rows = self.writer.journal.query(
+            "SELECT file FROM events WHERE uploaded IS NOT NULL AND file IN ({})".format(
+                ', '.join(['%s'] * len(files))), files)
+        return {file for (file,) in rows} if rows else set()
+
+    def _candidates(self):
+        """ Clips in the order of eviction: the uploaded ones oldest first, then the rest oldest first.
+            """
+        oldest = [(modified, file) for (file, (modified, _)) in self.files.items()]
+        heapq.heapify(oldest)
+        kept = []
+        while oldest:
+            batch = [heapq.heappop(oldest)[1] for _ in range(min(self.batch, len(oldest)))]
+            uploaded = self._uploaded(batch)
+            for file in batch:
+                if file in uploaded:
+                    yield file
+                else:
+                    kept.append(file)
+        yield from kept
+
+    def _evict(self, file: str) -> int:
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            print("Deleting {} failed: {}".format(file, error), file=sys.stderr)
+            return 0
+        (_, size) = self.files.pop(file)
+        self.total -= size
+        self.evicted += 1
+        self.freed += size
+        self.writer.put("UPDATE events SET evicted = %s WHERE file = %s", (datetime.datetime.now(), file), file)
+        print("{} was deleted to free space.".format(os.path.basename(file)))
+        return size
+
+    def enforce(self, reserve: int = 0) -> int:
+        """ Delete clips until the quota and the free space floor are met with reserve bytes to spare.
+
+            :param reserve: Size of the clip about to be recorded.
+            :return: Bytes freed.
+            """
+        with self.lock:
+            excess = self._excess(reserve)
+            if excess <= 0:
+                return 0
+            freed = 0
+            for file in self._candidates():
+                if freed >= excess:
+                    break
+                freed += self._evict(file)
+            return freed
+
+    def stats(self) -> dict:
+        """ Clips and bytes kept, free bytes of the disk, clips and bytes deleted.
+            """
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'bytes': self.total,
+                'free': self.free(),
+                'evicted': self.evicted,
+                'freed': self.freed
+            }
+
+
+if __name__ == '__main__':
+    with EventWriter() as events:
+        retention = Retention(settings.config.working_dir, events)
+        print(retention.stats())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Rate limited and prioritized scheduling of the uploads.
+    """
+
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from urllib3 import PoolManager, Timeout, exceptions
+
+try:
+    from utils.journal import Journal
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from journal import Journal
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['TokenBucket', 'BandwidthProfile', 'Scheduler']
+
+
+class TokenBucket:
+    """ Rate limit shared by threads, a request larger than the bucket is let through when it is full and paid
+        back by the next ones.
+        """
+
+    def __init__(self, rate: float = None, burst: float = None):
+        """ Constructor.
+
+            :param rate: Bytes per second, unlimited if None, nothing goes through if 0.
+            :param burst: Size of the bucket in bytes, one second at the current rate if None.
+            """
+        self.condition = threading.Condition()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def _capacity(self) -> float:
+        return self.burst if self.burst is not None else self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self._capacity(), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float):
+        """ Change the rate, the tokens collected so far are kept.
+
+            :param rate: Bytes per second, unlimited if None, nothing goes through if 0.
+            """
+        with self.condition:
+            if rate != self.rate:
+                self._refill()
+                self.rate = rate
+                self.condition.notify_all()
+
+    def take(self, size: int, timeout: float = None) -> bool:
+        """ Wait until size bytes may be sent.
+
+            :param size: Bytes.
+            :param timeout: Seconds to wait at most, forever if None.
+            :return: Whether the bytes were taken, nothing is taken after a timeout.
+            """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while True:
+                if self.rate is None:
+                    return True
+                self._refill()
+                needed = min(size, self._capacity()) if self.rate else size
+                if self.rate and self.tokens >= needed:
+                    self.tokens -= size
+                    return True
+                wait = (needed - self.tokens) / self.rate if self.rate else None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining) if wait is not None else remaining
+                self.condition.wait(wait)
+
+
+class BandwidthProfile:
+    """ Upload rate by time of day, e.g. "07:00-23:00=65536, 23:00-07:00=1048576" in bytes per second.
+
+        A period may wrap around midnight, the rate is unlimited outside the periods.
+        """
+
+    def __init__(self, text: str = ''):
+        """ Constructor.
+
+            :param text: Comma separated periods, invalid ones are reported on stderr and ignored.
+            """
+        self.periods = []  # (first minute, minute after the last, rate)
+        for item in (text or '').split(','):
+            if not item.strip():
+                continue
+            try:
+                (span, rate) = item.split('=')
+                (start, end) = (self._minute(value) for value in span.split('-'))
+                self.periods.append((start, end, float(rate)))
+            except ValueError:
+                print("Invalid bandwidth period: {}".format(item.strip()), file=sys.stderr)
+
+    @staticmethod
+    def _minute(value: str) -> int:
+        (hour, minute) = value.strip().split(':')
+        return int(hour) * 60 + int(minute)
+
+    def rate(self, now: datetime.datetime = None) -> float:
+        """ Bytes per second at the time, None if unlimited.
+
+            :param now: Local time, the current time if None.
+            """
+        now = now if now is not None else datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for (start, end, rate) in self.periods:
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return rate
+        return None
+
+
+class Scheduler:
+    """ Orders the pending clips and paces the chunks of the uploads.
+
+        Short clips go first, the ones with more changed pixels before the others, long clips come later. The rate
+        follows the bandwidth profile and drops to the stream rate while the live stream has clients.
+        """
+
+    short_clip = 30  # seconds of video still considered a short clip
+    poll = 5  # seconds between the checks of the rate and of the stream clients
+
+    def __init__(self, journal: Journal, profile: BandwidthProfile = None, stream_rate: float = None,
+                 stats_url: str = None, bitrate: int = 17000000):
+        """ Constructor.
+
+            :param journal: Local copy of the events with the diff_cnt of the clips.
+            :param profile: Rate by time of day, unlimited if None.
+            :param stream_rate: Bytes per second while the stream has clients, 0 pauses the uploads.
+            :param stats_url: Statistics of the stream server, the clients are not checked if None.
+            :param bitrate: H.264 bits per second of the clips, to tell their length from their size.
+            """
+        self.journal = journal
+        self.profile = profile if profile is not None else BandwidthProfile()
+        self.stream_rate = stream_rate
+        self.stats_url = stats_url
+        self.bitrate = bitrate
+        self.http = PoolManager(num_pools=1, maxsize=1, retries=False, timeout=Timeout(connect=1, read=1)) \
+            if stats_url else None
+        self.bucket = TokenBucket(self.profile.rate())
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.clients = 0
+        self.added = {}  # file: time added to the queue
+        self.started = None
+        self.bytes = 0
+        self.files = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def _clients(self) -> int:
+        if self.http is None:
+            return 0
+        response = None
+        try:
+            response = self.http.request('GET', self.stats_url)
+            if response.status != 200:
+                return 0
+            return len(json.loads(response.data.decode('utf-8')).get('clients', []))
+        except (exceptions.HTTPError, ValueError, AttributeError):
+            # The stream server is not running.
+            return 0
+        finally:
+            if response is not None:
+                response.release_conn()
+
+    def update(self, force: bool = False):
+        """ Apply the rate of the time of day, or the stream rate if someone is watching.
+
+            :param force: Check even if the last check is more recent than poll seconds.
+            """
+        with self.lock:
+            if not force and time.monotonic() - self.checked < self.poll:
+                return
+            self.checked = time.monotonic()
+            self.clients = self._clients()
+            rate = self.profile.rate()
+            if self.clients and self.stream_rate is not None:
+                rate = min(rate, self.stream_rate) if rate is not None else self.stream_rate
+        self.bucket.set_rate(rate)
+
+    def throttle(self, size: int):
+        """ Wait until a chunk of size bytes may be sent, called by the upload workers.
+
+            :param size: Bytes.
+            """
+        self.update()
+        while not self.bucket.take(size, self.poll):
+            self.update()
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic()
+            self.bytes += size
+
+    def _diffs(self, files: list) -> dict:
+        diffs = {}
+        for offset in range(0, len(files), 500):
+            batch = files[offset:offset + 500]
+            rows = self.journal.query(
+                "SELECT file, diff_cnt FROM events WHERE file IN ({})".format(', '.join(['%s'] * len(batch))), batch)
+            diffs.update((file, diff or 0) for (file, diff) in rows or [])
+        return diffs
+
+    def rank(self, rows: list) -> list:
+        """ Pending clips in the order of upload, see UploadIndex.claim().
+
+            :param rows: File, size and time added of every pending clip.
+            """
+        diffs = self._diffs([file for (file, _, _) in rows])
+        sized = []
+        for (file, size, added) in rows:
+            if size is None:
+                try:
+                    size = os.path.getsize(file)
+                except OSError:
+                    size = 0
+            sized.append((file, size, added))
+        with self.lock:
+            self.added.update((file, added) for (file, _, added) in sized)
+        short = self.short_clip * self.bitrate / 8
+        return sorted(sized, key=lambda row: (row[1] > short, -diffs.get(row[0], 0), row[2]))
+
+    def done(self, file: str) -> float:
+        """ Register an uploaded clip.
+
+            :param file: Full name of the clip.
+            :return: Seconds the clip waited since it was queued.
+            """
+        with self.lock:
+            added = self.added.pop(file, None)
+            if added is None:
+                return None
+            latency = time.time() - added
+            self.files += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            return latency
+
+    def stats(self) -> dict:
+        """ Current rate limit and stream clients, throughput in bytes per second and queue latency in seconds.
+            """
+        with self.lock:
+            elapsed = time.monotonic() - self.started if self.started is not None else 0
+            return {
+                'rate': self.bucket.rate,
+                'clients': self.clients,
+                'bytes': self.bytes,
+                'throughput': round(self.bytes / elapsed) if elapsed else 0,
+                'files': self.files,
+                'latency': round(self.latency / self.files, 1) if self.files else 0.0,
+                'max_latency': round(self.max_latency, 1)
+            }
+
+
+def benchmark(rate: float = 2e6, workers: int = 3):
+    """ Upload clips of mixed length and importance to a LocalStorage at rate bytes per second.
+        """
+    try:
+        from utils.uploader import LocalStorage, Uploader
+        from utils.uploads import UploadIndex
+    except ImportError:
+        # noinspection PyUnresolvedReferences
+        from uploader import LocalStorage, Uploader
+        # noinspection PyUnresolvedReferences
+        from uploads import UploadIndex
+
+    local = tempfile.mkdtemp()
+    remote = tempfile.mkdtemp()
+    try:
+        journal = Journal(os.path.join(local, 'journal.db'))
+        index = UploadIndex(os.path.join(local, 'uploads.db'))
+        bitrate = 800000  # short clips of 3 MB, long ones of 6 MB
+        for (number, (seconds, diff)) in enumerate([(60, 900), (15, 100), (60, 50), (15, 2000), (15, 500)]):
+            filename = os.path.join(local, '{:02d}.h264'.format(number))
+            with open(filename, 'wb') as file:
+                file.write(os.urandom(seconds * bitrate // 8))
+            journal.append('benchmark', "INSERT INTO events(file, location, diff_cnt, time) VALUES (%s, %s, %s, %s)",
+                           (filename, 'benchmark', diff, str(datetime.datetime.now())))
+            index.add(filename, os.path.getsize(filename))
+        scheduler = Scheduler(journal, BandwidthProfile('00:00-00:00={}'.format(rate)), bitrate=bitrate)
+        uploader = Uploader(LocalStorage(remote), workers, 256 * 1024, scheduler.throttle)
+        order = []
+
+        def claim() -> tuple:
+            files = index.claim(1, scheduler.rank)
+            order.extend(files)
+            return (files[0], '/' + os.path.basename(files[0])) if files else None
+
+        started = time.monotonic()
+        for (filename, url, _) in uploader.drain(claim):
+            index.done(filename, url)
+            scheduler.done(filename)
+        elapsed = time.monotonic() - started
+        uploader.close()
+        print("Order: {}".format(', '.join(os.path.basename(file) for file in order)))
+        print("{:.1f} s, {:.2f} MB/s at a limit of {:.2f} MB/s, {}".format(
+            elapsed, uploader.stats()['bytes'] / elapsed / 1e6, rate / 1e6, scheduler.stats()))
+        index.close()
+        journal.close()
+    finally:
+        shutil.rmtree(local)
+        shutil.rmtree(remote)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -44,6 +44,42 @@ class Settings:
             """
         return self.config.get('Database', 'Password', fallback='')
 
+    @property
+    def pool_min(self) -> int:
+        """ Database connections kept open even when idle.
+            """
+        return self.config.getint('Database', 'PoolMin', fallback=1)
+
+    @property
+    def pool_max(self) -> int:
+        """ Maximum number of open database connections per process.
+            """
+        return self.config.getint('Database', 'PoolMax', fallback=4)
+
+    @property
+    def pool_idle(self) -> float:
+        """ Seconds after an idle database connection above PoolMin is closed.
+            """
+        return self.config.getfloat('Database', 'PoolIdle', fallback=300)
+
+    @property
+    def batch_size(self) -> int:
+        """ Queued database writes triggering a flush.
+            """
+        return self.config.getint('Database', 'BatchSize', fallback=100)
+
+    @property
+    def flush_interval(self) -> float:
+        """ Seconds a queued database write may wait for the batch to fill up.
+            """
+        return self.config.getfloat('Database', 'FlushInterval', fallback=5)
+
+    @property
+    def local_events(self) -> bool:
+        """ The web pages read the events from the local journal instead of MySQL.
+            """
+        return self.config.getboolean('Database', 'LocalEvents', fallback=False)
+
     @property
     def working_dir(self) -> str:
         """ The working directory.
@@ -53,6 +89,18 @@ class Settings:
             mkdir(directory)
         return directory
 
+    @property
+    def quota(self) -> int:
+        """ Bytes of clips kept in the working directory, no limit if 0.
+            """
+        return self.config.getint('Main', 'Quota', fallback=0)
+
+    @property
+    def min_free(self) -> int:
+        """ Bytes kept free on the disk of the working directory, the oldest clips are deleted below it.
+            """
+        return self.config.getint('Main', 'MinFree', fallback=512 * 1024 * 1024)
+
     @property
     def access_token(self) -> str:
         """ Dropbox OAuth 2 authorization token.
@@ -66,17 +114,265 @@ class Settings:
         self.config.set('Dropbox', 'Access', val)
         self.save()
 
+    @property
+    def upload_workers(self) -> int:
+        """ Files uploaded to Dropbox at the same time.
+            """
+        return self.config.getint('Dropbox', 'Workers', fallback=3)
+
+    @property
+    def chunk_size(self) -> int:
+        """ Bytes sent to Dropbox in one request, an interrupted upload resumes from the last whole chunk.
+            """
+        return self.config.getint('Dropbox', 'ChunkSize', fallback=4 * 1024 * 1024)
+
+    @property
+    def live_upload(self) -> bool:
+        """ Send the clips to Dropbox while they are being recorded.
+            """
+        return self.config.getboolean('Dropbox', 'LiveUpload', fallback=False)
+
+    @property
+    def live_chunk_size(self) -> int:
+        """ Bytes of a clip sent to Dropbox in one request while it is being recorded.
+            """
+        return self.config.getint('Dropbox', 'LiveChunkSize', fallback=1024 * 1024)
+
+    @property
+    def bandwidth(self) -> str:
+        """ Upload bytes per second by time of day, e.g. 07:00-23:00=65536, unlimited outside the periods.
+            """
+        return self.config.get('Dropbox', 'Bandwidth', fallback='')
+
+    @property
+    def stream_bandwidth(self) -> float:
+        """ Upload bytes per second while the live stream has clients, 0 pauses the uploads.
+            """
+        return self.config.getfloat('Dropbox', 'StreamBandwidth', fallback=32768)
+
+    @property
+    def stream_stats(self) -> str:
+        """ Statistics of the local stream server, telling whether the live stream has clients.
+            """
+        return self.config.get('Dropbox', 'StreamStats', fallback='http://localhost:8080/stats.json')
+
+    @property
+    def detector(self) -> str:
+        """ Motion detector engine in lower case, see utils.detector.DETECTORS.
+            """
+        return self.config.get('Motion', 'Detector', fallback='numpy').strip().lower()
+
+    @property
+    def test_width(self) -> int:
+        """ Width of the frames compared by the motion detector.
+            """
+        return self.config.getint('Motion', 'TestWidth', fallback=100)
+
+    @property
+    def test_height(self) -> int:
+        """ Height of the frames compared by the motion detector.
+            """
+        return self.config.getint('Motion', 'TestHeight', fallback=75)
+
+    @property
+    def grid(self) -> tuple:
+        """ Rows and columns of the motion map of the grid detector, e.g. 16x16.
+            """
+        (rows, cols) = self.config.get('Motion', 'Grid', fallback='16x16').lower().split('x')
+        return int(rows), int(cols)
+
+    @property
+    def mask(self) -> str:
+        """ Grayscale PGM image of the watched area: white cells are watched, black ones ignored.
+            """
+        return self.config.get('Motion', 'Mask', fallback='')
+
+    @staticmethod
+    def _polygons(value: str) -> list:
+        """ Parse polygons like '0,0 1,0 1,0.5; 0.2,0.6 0.4,0.6 0.3,0.9'.
+            """
+        return [
+            [tuple(float(coordinate) for coordinate in point.split(',')) for point in polygon.split()]
+            for polygon in value.split(';')
+            if polygon.strip()
+        ]
+
+    @property
+    def include(self) -> list:
+        """ Watched polygons in coordinates relative to the frame size, everything if empty.
+            """
+        return self._polygons(self.config.get('Motion', 'Include', fallback=''))
+
+    @property
+    def exclude(self) -> list:
+        """ Ignored polygons in coordinates relative to the frame size, e.g. trees or a timestamp overlay.
+            """
+        return self._polygons(self.config.get('Motion', 'Exclude', fallback=''))
+
+    @property
+    def cell_threshold(self) -> float:
+        """ Ratio of changed pixels making a cell active.
+            """
+        return self.config.getfloat('Motion', 'CellThreshold', fallback=0.2)
+
+    @property
+    def cell_thresholds(self) -> str:
+        """ Text file of per cell ratios, one row of the grid per line, overrides CellThreshold.
+            """
+        return self.config.get('Motion', 'CellThresholds', fallback='')
+
+    @property
+    def min_cells(self) -> int:
+        """ Active cells needed for motion.
+            """
+        return self.config.getint('Motion', 'MinCells', fallback=1)
+
+    @property
+    def learning_rate(self) -> float:
+        """ Weight of a new frame in the model of the background detector, between 0 and 1.
+            """
+        return self.config.getfloat('Motion', 'LearningRate', fallback=0.05)
+
+    @property
+    def noise_floor(self) -> float:
+        """ Minimum standard deviation of a pixel in the model of the background detector.
+            """
+        return self.config.getfloat('Motion', 'NoiseFloor', fallback=3.0)
+
+    @property
+    def vector_magnitude(self) -> int:
+        """ Length of a moving motion vector for the vectors detector.
+            """
+        return self.config.getint('Motion', 'VectorMagnitude', fallback=10)
+
+    @property
+    def vector_cluster(self) -> int:
+        """ Moving vectors needed in the 3x3 neighbourhood of a vector for the vectors detector.
+            """
+        return self.config.getint('Motion', 'VectorCluster', fallback=4)
+
+    @property
+    def framerate(self) -> int:
+        """ Frames per second delivered to the motion detector at day time.
+            """
+        return self.config.getint('Motion', 'Framerate', fallback=10)
+
+    @property
+    def buffer_seconds(self) -> int:
+        """ Seconds of video kept in memory before the motion is detected.
+            """
+        return self.config.getint('Motion', 'BufferSeconds', fallback=5)
+
+    @property
+    def bitrate(self) -> int:
+        """ H.264 bits per second, bounds the memory of the pre-motion buffer together with BufferSeconds.
+            """
+        return self.config.getint('Motion', 'Bitrate', fallback=17000000)
+
+    @property
+    def processes(self) -> bool:
+        """ Run capture, detection and recording in separate processes, so detection goes on while recording.
+
+            Needs Python 3.8 or newer for the shared memory of the frames.
+            """
+        return self.config.getboolean('Motion', 'Processes', fallback=False)
+
+    @property
+    def server(self) -> str:
+        """ Stream server implementation: asyncio or threaded.
+            """
+        return self.config.get('Stream', 'Server', fallback='asyncio')
+
+    @property
+    def stream_fps(self) -> float:
+        """ Default frame rate of the MJPEG stream, clients may ask for another one with ?fps=.
+            """
+        return self.config.getfloat('Stream', 'Framerate', fallback=5)
+
+    @property
+    def snapshot_age(self) -> float:
+        """ Maximum age in seconds of the stream frame served as /cam.jpg.
+            """
+        return self.config.getfloat('Stream', 'SnapshotAge', fallback=2)
+
+    @property
+    def cache_size(self) -> int:
+        """ Events pages kept in the memory of the web application.
+            """
+        return self.config.getint('Web', 'CacheSize', fallback=64)
+
+    @property
+    def cache_ttl(self) -> float:
+        """ Seconds a cached events page is shown at most.
+            """
+        return self.config.getfloat('Web', 'CacheTTL', fallback=300)
+
+    @property
+    def probe_interval(self) -> float:
+        """ Seconds between the health checks of the streams shown on the monitor page.
+            """
+        return self.config.getfloat('Web', 'ProbeInterval', fallback=30)
+
+    @property
+    def probe_timeout(self) -> float:
+        """ Seconds to wait for a stream to connect and again to answer.
+            """
+        return self.config.getfloat('Web', 'ProbeTimeout', fallback=1)
+
     def defaults(self):
         """ Default settings.
             """
         self.config.add_section('Main')
         self.config.set('Main', 'WorkingDir', '/var/local/PiCam')
+        self.config.set('Main', 'Quota', '0')
+        self.config.set('Main', 'MinFree', '536870912')
+        self.config.add_section('Motion')
+        self.config.set('Motion', 'Detector', 'numpy')
+        self.config.set('Motion', 'TestWidth', '100')
+        self.config.set('Motion', 'TestHeight', '75')
+        self.config.set('Motion', 'Framerate', '10')
+        self.config.set('Motion', 'Grid', '16x16')
+        self.config.set('Motion', 'Mask', '')
+        self.config.set('Motion', 'Include', '')
+        self.config.set('Motion', 'Exclude', '')
+        self.config.set('Motion', 'CellThreshold', '0.2')
+        self.config.set('Motion', 'CellThresholds', '')
+        self.config.set('Motion', 'MinCells', '1')
+        self.config.set('Motion', 'LearningRate', '0.05')
+        self.config.set('Motion', 'NoiseFloor', '3.0')
+        self.config.set('Motion', 'VectorMagnitude', '10')
+        self.config.set('Motion', 'VectorCluster', '4')
+        self.config.set('Motion', 'BufferSeconds', '5')
+        self.config.set('Motion', 'Bitrate', '17000000')
+        self.config.set('Motion', 'Processes', 'no')
+        self.config.add_section('Stream')
+        self.config.set('Stream', 'Server', 'asyncio')
+        self.config.set('Stream', 'Framerate', '5')
+        self.config.set('Stream', 'SnapshotAge', '2')
+        self.config.add_section('Web')
+        self.config.set('Web', 'CacheSize', '64')
+        self.config.set('Web', 'CacheTTL', '300')
+        self.config.set('Web', 'ProbeInterval', '30')
+        self.config.set('Web', 'ProbeTimeout', '1')
         self.config.add_section('Database')
         self.config.set('Database', 'Host', 'localhost')
         self.config.set('Database', 'User', 'picam')
         self.config.set('Database', 'Password', '')
+        self.config.set('Database', 'PoolMin', '1')
+        self.config.set('Database', 'PoolMax', '4')
+        self.config.set('Database', 'PoolIdle', '300')
+        self.config.set('Database', 'BatchSize', '100')
+        self.config.set('Database', 'FlushInterval', '5')
+        self.config.set('Database', 'LocalEvents', 'no')
         self.config.add_section('Dropbox')
         self.config.set('Dropbox', 'Access', '')
+        self.config.set('Dropbox', 'Workers', '3')
+        self.config.set('Dropbox', 'ChunkSize', str(4 * 1024 * 1024))
+        self.config.set('Dropbox', 'LiveUpload', 'no')
+        self.config.set('Dropbox', 'LiveChunkSize', str(1024 * 1024))
+        self.config.set('Dropbox', 'Bandwidth', '')
+        self.config.set('Dropbox', 'StreamBandwidth', '32768')
+        self.config.set('Dropbox', 'StreamStats', 'http://localhost:8080/stats.json')
 
     def load(self):
         """ Load settings from file.
@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Parallel chunked uploads to Dropbox.
+    """
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+import filecmp
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from dropbox.rest import ErrorResponse
+from urllib3.exceptions import MaxRetryError
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['UPLOAD_ERRORS', 'ChunkedUpload', 'StreamingUpload', 'Uploader', 'LocalStorage']
+
+# Failures of a request worth trying again later.
+UPLOAD_ERRORS = (ErrorResponse, MaxRetryError, OSError)
+
+
+class _Aborted(Exception):
+    """ The upload was given up before it was committed.
+        """
+
+
+class ChunkedUpload:
+    """ Upload of one file in chunks, resumed from the last offset the server acknowledged after a failure.
+        """
+
+    attempts = 5  # failed requests in a row before giving up for now
+    backoff = 1  # seconds to wait after the first failed request, doubled after each one
+
+    def __init__(self, client, filename: str, remote_name: str, chunk_size: int = 4 * 1024 * 1024, throttle=None):
+        """ Constructor.
+
+            :param client: DropboxClient.
+            :param filename: Local file.
+            :param remote_name: Path in Dropbox.
+            :param chunk_size: Bytes sent in one request.
+            :param throttle: Callable waiting until a chunk of the given size may be sent.
+            """
+        self.client = client
+        self.filename = filename
+        self.remote_name = remote_name
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.offset = 0
+        self.upload_id = None
+        self.metadata = None
+
+    def _send(self, file):
+        file.seek(self.offset)
+        chunk = file.read(self.chunk_size)
+        if self.throttle is not None:
+            self.throttle(len(chunk))
+        try:
+            (self.offset, self.upload_id) = self.client.upload_chunk(chunk, len(chunk), self.offset, self.upload_id)
+        except ErrorResponse as error:
+            if self.upload_id is not None and error.status == 400 and isinstance(error.body, dict) \
+                    and 'offset' in error.body:
+                # The server has a different part, e.g. the response to the previous chunk was lost.
+                self.offset = error.body['offset']
+            elif error.status == 404:
+                # The upload expired, start over.
+                self.offset = 0
+                self.upload_id = None
+                raise
+            else:
+                raise
+
+    def _commit(self) -> dict:
+        return self.client.commit_chunked_upload(self.remote_name, self.upload_id)
+
+    def run(self) -> dict:
+        """ Send the rest of the file and commit it.
+
+            :return: Metadata of the new file.
+            :raise ErrorResponse, MaxRetryError, OSError: After too many failures, run() continues from the
+                last acknowledged offset when called again.
+            """
+        if self.metadata is not None:
+            return self.metadata
+        failures = 0
+        with open(self.filename, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            while True:
+                try:
+                    if self.upload_id is None or self.offset < size:
+                        self._send(file)
+                        failures = 0
+                        continue
+                    self.metadata = self._commit()
+                    return self.metadata
+                except UPLOAD_ERRORS:
+                    failures += 1
+                    if failures >= self.attempts:
+                        raise
+                    time.sleep(self.backoff * 2 ** (failures - 1))
+
+
+class StreamingUpload(ChunkedUpload):
+    """ Writable file sending its bytes to an upload session while they are being written.
+
+        The bytes go to a local file first, the session reads every whole chunk back from it in the background,
+        so memory use does not grow with a slow uplink. The upload is committed and shared after close(), its
+        result is the shared URL and the metadata in future. If it fails, the local file is still complete.
+        """
+
+    def __init__(self, client, filename: str, remote_name: str, chunk_size: int = 1024 * 1024, throttle=None):
+        """ Constructor, creates the local file.
+
+            :param client: DropboxClient.
+            :param filename: Local file.
+            :param remote_name: Path in Dropbox.
+            :param chunk_size: Bytes sent in one request.
+            :param throttle: Callable waiting until a chunk of the given size may be sent.
+            """
+        super().__init__(client, filename, remote_name, chunk_size, throttle)
+        self.name = filename
+        self.file = open(filename, 'wb')
+        self.condition = threading.Condition()
+        self.written = 0
+        self.flushed = 0
+        self.closed = False
+        self.aborted = False
+        self.committing = False
+        self.future = Future()
+        self.thread = threading.Thread(target=self._stream, daemon=True)
+        self.thread.start()
+
+    def _publish(self):
+        with self.condition:
+            self.flushed = self.written
+            self.condition.notify_all()
+
+    def write(self, buf) -> int:
+        """ Called by the encoder.
+            """
+        self.file.write(buf)
+        self.written += len(buf)
+        if self.written - self.flushed >= self.chunk_size:
+            self.file.flush()
+            self._publish()
+        return len(buf)
+
+    def flush(self):
+        """ Flush the local file and let the session send the whole chunks.
+            """
+        self.file.flush()
+        self._publish()
+
+    def close(self):
+        """ Close the local file, the session sends the rest and commits in the background.
+            """
+        if self.closed:
+            return
+        self.file.close()
+        with self.condition:
+            self.flushed = self.written
+            self.closed = True
+            self.condition.notify_all()
+
+    def abort(self) -> bool:
+        """ Close the local file and give up the session, e.g. when the recording failed.
+
+            :return: Whether the upload was given up, False if it is already being committed.
+            """
+        with self.condition:
+            self.aborted = not self.committing
+        self.close()
+        if self.aborted:
+            self.future.cancel()
+        return self.aborted
+
+    def _commit(self) -> dict:
+        with self.condition:
+            if self.aborted:
+                raise _Aborted()
+            self.committing = True
+        return super()._commit()
+
+    def _stream(self):
+        try:
+            failures = 0
+            with open(self.filename, 'rb') as file:
+                while True:
+                    with self.condition:
+                        self.condition.wait_for(lambda: self.closed or self.flushed - self.offset >= self.chunk_size)
+                        if self.closed:
+                            break
+                    try:
+                        self._send(file)
+                        failures = 0
+                    except UPLOAD_ERRORS:
+                        failures += 1
+                        if failures >= self.attempts:
+                            raise
+                        time.sleep(self.backoff * 2 ** (failures - 1))
+            if self.aborted:
+                return
+            metadata = self.run()
+            self.future.set_result((self.client.share(self.remote_name)['url'], metadata))
+        except BaseException as error:
+            # The local file is still written to the end, the upload daemon takes over.
+            if not self.future.cancelled():
+                self.future.set_exception(error)
+
+
+class Uploader:
+    """ Pool of workers uploading files in parallel and sharing them.
+
+        An upload failing too many times is given up for the current call and resumed by the next call for the
+        same file.
+        """
+
+    def __init__(self, client, workers: int = 3, chunk_size: int = 4 * 1024 * 1024, throttle=None):
+        """ Constructor.
+
+            :param client: DropboxClient.
+            :param workers: Files uploaded at the same time.
+            :param chunk_size: Bytes sent in one request.
+            :param throttle: Callable waiting until a chunk of the given size may be sent, shared by the workers.
+            """
+        self.client = client
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.lock = threading.Lock()
+        self.sessions = {}  # local file name: ChunkedUpload
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def _upload(self, filename: str, remote_name: str) -> tuple:
+        with self.lock:
+            upload = self.sessions.get(filename)
+            if upload is None or upload.remote_name != remote_name:
+                upload = self.sessions[filename] = ChunkedUpload(
+                    self.client, filename, remote_name, self.chunk_size, self.throttle)
+        started = time.monotonic()
+        offset = upload.offset
+        metadata = upload.run()
+        share = self.client.share(remote_name)
+        with self.lock:
+            del self.sessions[filename]
+            self.files += 1
+            self.bytes += metadata.get('bytes', upload.offset) - offset
+            self.seconds += time.monotonic() - started
+        return share['url'], metadata
+
+    def upload(self, files: list):
+        """ Upload files in parallel, the finished ones are yielded as soon as they are shared.
+
+            :param files: Local and remote name pairs.
+            :return: Generator of local name, shared URL and metadata, the failed files are reported on stderr.
+            """
+        futures = {self.submit(filename, remote_name): filename for (filename, remote_name) in files}
+        for future in as_completed(futures):
+            try:
+                yield (futures[future],) + future.result()
+            except UPLOAD_ERRORS as error:
+                print("Upload of {} postponed: {}".format(futures[future], error), file=sys.stderr)
+
+    def submit(self, filename: str, remote_name: str) -> Future:
+        """ Queue one file for the workers.
+
+            :param filename: Local name.
+            :param remote_name: Name in Dropbox.
+            :return: Future of the shared URL and the metadata.
+            """
+        return self.executor.submit(self._upload, filename, remote_name)
+
+    def drain(self, claim, poll: float = 5):
+        """ Upload the files handed out by claim, a new one is claimed as soon as a worker is free.
+
+            A failed file is not claimed again by this call, claim should keep it until the caller puts it back.
+
+            :param claim: Callable returning the next local and remote name pair, None if there is none yet.
+            :param poll: Seconds between the claims while a worker is idle and the others are busy.
+            :return: Generator of local name, shared URL and metadata, the failed files are reported on stderr.
+            """
+        running = {}  # future: local name
+        while True:
+            while len(running) < self.workers:
+                file = claim()
+                if file is None:
+                    break
+                running[self.submit(*file)] = file[0]
+            if not running:
+                return
+            (finished, _) = wait(running, poll if len(running) < self.workers else None, FIRST_COMPLETED)
+            for future in finished:
+                filename = running.pop(future)
+                try:
+                    yield (filename,) + future.result()
+                except UPLOAD_ERRORS as error:
+                    print("Upload of {} postponed: {}".format(filename, error), file=sys.stderr)
+
+    def stats(self) -> dict:
+        """ Files and bytes uploaded, average throughput of a worker in bytes per second.
+            """
+        with self.lock:
+            return {
+                'files': self.files,
+                'bytes': self.bytes,
+                'throughput': round(self.bytes / self.seconds) if self.seconds else 0,
+                'resumable': len(self.sessions)
+            }
+
+    def close(self):
+        """ Wait for the running uploads and stop the workers.
+            """
+        self.executor.shutdown()
+
+
+class _Reply:
+    """ The part of an HTTP response ErrorResponse needs.
+        """
+
+    reason = 'Bad Request'
+
+    def __init__(self, status: int):
+        self.status = status
+
+    @staticmethod
+    def getheaders() -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class LocalStorage:
+    """ Stand-in for DropboxClient keeping the files in a local directory, for tests and benchmarks.
+
+        Every request waits latency seconds plus the transfer time at bandwidth bytes per second. With
+        failure_rate probability a chunk fails after it was stored, as if the response was lost, so the client
+        has to resume from the offset reported by the server.
+        """
+
+    def __init__(self, directory: str, latency: float = 0.0, bandwidth: float = None, failure_rate: float = 0.0):
+        self.directory = directory
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.uploads = {}  # upload id: bytearray
+        self.changes = []  # lower case path and metadata or None, the cursor is the position in the list
+        self.requests = 0
+
+    def _path(self, remote_name: str) -> str:
+        return os.path.join(self.directory, remote_name.lstrip('/'))
+
+    def _transfer(self, size: int = 0):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency + (size / self.bandwidth if self.bandwidth else 0))
+
+    def upload_chunk(self, file_obj, length=None, offset=0, upload_id=None) -> tuple:
+        """ Append a chunk to an upload, a new one if upload_id is None.
+
+            :return: Offset of the next chunk and upload id.
+            """
+        chunk = file_obj if isinstance(file_obj, bytes) else file_obj.read()
+        self._transfer(len(chunk))
+        with self.lock:
+            if upload_id is None:
+                upload_id = '{:016x}'.format(random.getrandbits(64))
+                self.uploads[upload_id] = bytearray()
+            if upload_id not in self.uploads:
+                raise ErrorResponse(_Reply(404), b'{"error": "Upload not found"}')
+            data = self.uploads[upload_id]
+            if offset != len(data):
+                raise ErrorResponse(_Reply(400), json.dumps({'upload_id': upload_id, 'offset': len(data)}).encode())
+            data.extend(chunk)
+            if random.random() < self.failure_rate:
+                raise OSError("Simulated lost response")
+            return len(data), upload_id
+
+    def commit_chunked_upload(self, full_path: str, upload_id: str, overwrite=False, parent_rev=None) -> dict:
+        """ Store the upload as a file.
+
+            :return: Metadata of the file.
+            """
+        self._transfer()
+        with self.lock:
+            data = self.uploads.pop(upload_id)
+        with open(self._path(full_path), 'wb') as file:
+            file.write(data)
+        metadata = self._metadata(full_path)
+        with self.lock:
+            self.changes.append((full_path.lower(), metadata))
+        return metadata
+
+    def _metadata(self, remote_name: str) -> dict:
+        status = os.stat(self._path(remote_name))
+        return {
+            'path': remote_name,
+            'bytes': status.st_size,
+            'modified': time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(status.st_mtime)),
+            'is_dir': False
+        }
+
+    def share(self, path: str, short_url=True) -> dict:
+        """ Link of the file.
+            """
+        self._transfer()
+        return {'url': 'file://' + self._path(path)}
+
+    def metadata(self, path: str, **options) -> dict:
+        """ Files of the root folder.
+            """
+        self._transfer()
+        return {'contents': [self._metadata('/' + name) for name in sorted(os.listdir(self.directory))]}
+
+    def file_delete(self, path: str) -> dict:
+        """ Delete a file.
+            """
+        self._transfer()
+        try:
+            os.remove(self._path(path))
+        except FileNotFoundError:
+            raise ErrorResponse(_Reply(404), b'{"error": "Path not found"}')
+        with self.lock:
+            self.changes.append((path.lower(), None))
+        return {'path': path, 'is_deleted': True}
+
+    def delta(self, cursor=None, path_prefix=None, **options) -> dict:
+        """ Changes since the cursor, the full listing with reset if cursor is None.
+            """
+        self._transfer()
+        with self.lock:
+            position = len(self.changes)
+            if cursor is not None:
+                return {'entries': [list(entry) for entry in self.changes[int(cursor):]], 'reset': False,
+                        'cursor': str(position), 'has_more': False}
+        entries = [[metadata['path'].lower(), metadata] for metadata in self.metadata('/')['contents']]
+        return {'entries': entries, 'reset': True, 'cursor': str(position), 'has_more': False}
+
+
+def benchmark(count: int = 8, size: int = 8 * 1024 * 1024, latency: float = 0.05, bandwidth: float = 4e6,
+              failure_rate: float = 0.05):
+    """ Upload count files of size bytes to a LocalStorage with 1, 2 and 4 workers.
+        """
+    local = tempfile.mkdtemp()
+    try:
+        files = []
+        for index in range(count):
+            filename = os.path.join(local, '{:02d}.h264'.format(index))
+            with open(filename, 'wb') as file:
+                file.write(os.urandom(size))
+            files.append((filename, '/{:02d}.h264'.format(index)))
+        for workers in (1, 2, 4):
+            remote = tempfile.mkdtemp()
+            try:
+                storage = LocalStorage(remote, latency, bandwidth, failure_rate)
+                uploader = Uploader(storage, workers, 1024 * 1024)
+                started = time.monotonic()
+                uploaded = list(uploader.upload(files))
+                elapsed = time.monotonic() - started
+                uploader.close()
+                intact = all(filecmp.cmp(filename, storage._path(name), shallow=False) for (filename, name) in files)
+                print("{} workers: {} of {} files in {:.2f} s, {:.1f} MB/s, {} requests, {}".format(
+                    workers, len(uploaded), count, elapsed, count * size / elapsed / 1e6, storage.requests,
+                    'intact' if intact else 'CORRUPT'))
+            finally:
+                shutil.rmtree(remote)
+    finally:
+        shutil.rmtree(local)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Persistent queue of the clips to upload, fed by inotify.
+    """
+
+from datetime import datetime
+from fnmatch import fnmatch
+import heapq
+import os
+from os import path
+import sqlite3
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    # Poll the directory on systems without inotify.
+    pyinotify = None
+
+try:
+    from utils import settings
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import settings
+
+__author__ = "wavezone"
+__copyright__ = "Copyright 2016, MRG-Infó Bt."
+__credits__ = ["Groma István (wavezone)"]
+
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Groma István"
+__email__ = "wavezone@mrginfo.com"
+
+__all__ = ['PENDING', 'UPLOADING', 'LIVE', 'DONE', 'UploadIndex', 'ClipWatcher', 'RemoteManifest']
+
+PENDING = 'pending'
+UPLOADING = 'uploading'
+LIVE = 'live'
+DONE = 'done'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+  file TEXT NOT NULL PRIMARY KEY,
+  state TEXT NOT NULL,
+  size INTEGER DEFAULT NULL,
+  added REAL NOT NULL,
+  updated REAL NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  url TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_state ON uploads (state, added);
+CREATE TABLE IF NOT EXISTS remote (
+  key TEXT NOT NULL PRIMARY KEY,
+  path TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  modified REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cursor (
+  id INTEGER NOT NULL PRIMARY KEY CHECK (id = 0),
+  value TEXT
+);
+"""
+
+
+class UploadIndex:
+    """ State of every clip seen: pending, uploading, live or done, in a SQLite database in WAL mode.
+
+        Clips left uploading by a stopped upload daemon are pending again after recover(). Live clips are
+        uploaded by the motion daemon while they are recorded, they are pending again if they are still live
+        after live_timeout seconds.
+        """
+
+    timeout = 30  # seconds to wait for a lock held by another process
+    live_timeout = 60 * 60  # seconds after which a live upload is taken for abandoned
+
+    def __init__(self, filename: str = None):
+        """ Constructor, creates the file if needed.
+
+            :param filename: SQLite database, uploads.db in the working directory if None.
+            """
+        self.filename = filename if filename is not None else path.join(settings.config.working_dir, 'uploads.db')
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.filename, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def _execute(self, statement: str, params=()) -> sqlite3.Cursor:
+        with self.lock:
+            return self.connection.execute(statement, params)
+
+    def add(self, file: str, size: int = None) -> bool:
+        """ Queue a clip unless it is already known.
+
+            :param file: Full name of the clip.
+            :param size: Bytes.
+            :return: Whether the clip is new.
+            """
+        now = time.time()
+        return self._execute(
+            'INSERT OR IGNORE INTO uploads (file, state, size, added, updated) VALUES (?, ?, ?, ?, ?)',
+            (file, PENDING, size, now, now)).rowcount > 0
+
+    def recover(self) -> int:
+        """ Put the clips left uploading by a stopped upload daemon back into the queue.
+
+            Only the upload daemon may call it at its start, the other processes opening the index would take
+            away the clips it is uploading.
+
+            :return: Number of clips queued again.
+            """
+        return self._execute('UPDATE uploads SET state = ?, updated = ? WHERE state = ?',
+                             (PENDING, time.time(), UPLOADING)).rowcount
+
+    def live(self, file: str) -> bool:
+        """ Register a clip about to be uploaded while it is recorded, so it is not queued when it is closed.
+
+            :param file: Full name of the clip.
+            :return: Whether the clip is new.
+            """
+        now = time.time()
+        return self._execute(
+            'INSERT OR IGNORE INTO uploads (file, state, added, updated) VALUES (?, ?, ?, ?)',
+            (file, LIVE, now, now)).rowcount > 0
+
+    def claim(self, limit: int = None, rank=None) -> list:
+        """ Mark the oldest pending clips uploading, or the first ones in the order of rank.
+
+            :param limit: Maximum number of clips, all if None.
+            :param rank: Callable sorting a list of file, size and time added tuples of every pending clip.
+            :return: Full names of the clips.
+            """
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute('UPDATE uploads SET state = ? WHERE state = ? AND updated < ?',
+                                        (PENDING, LIVE, time.time() - self.live_timeout))
+                if rank is None:
+                    files = [file for (file,) in self.connection.execute(
+                        'SELECT file FROM uploads WHERE state = ? ORDER BY added LIMIT ?',
+                        (PENDING, limit if limit is not None else -1))]
+                else:
+                    rows = rank(self.connection.execute(
+                        'SELECT file, size, added FROM uploads WHERE state = ? ORDER BY added', (PENDING,)).fetchall())
+                    files = [file for (file, _, _) in rows[:limit]]
+                self.connection.executemany(
+                    'UPDATE uploads SET state = ?, updated = ?, attempts = attempts + 1 WHERE file = ?',
+                    [(UPLOADING, time.time(), file) for file in files])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return files
+
+    def done(self, file: str, url: str = None):
+        """ Mark a clip uploaded, it is added if not yet known.
+
+            :param file: Full name of the clip.
+            :param url: Shared link.
+            """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    'UPDATE uploads SET state = ?, updated = ?, url = COALESCE(?, url) WHERE file = ?',
+                    (DONE, now, url, file))
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO uploads (file, state, added, updated, url) VALUES (?, ?, ?, ?, ?)',
+                    (file, DONE, now, now, url))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def release(self, file: str):
+        """ Put a clip back into the queue after a failed or aborted upload.
+            """
+        self._execute('UPDATE uploads SET state = ?, updated = ? WHERE file = ? AND state IN (?, ?)',
+                      (PENDING, time.time(), file, UPLOADING, LIVE))
+
+    def forget(self, file: str):
+        """ Remove a clip, e.g. after it was deleted.
+            """
+        self._execute('DELETE FROM uploads WHERE file = ?', (file,))
+
+    def state(self, file: str) -> str:
+        """ State of a clip, None if unknown.
+            """
+        row = self._execute('SELECT state FROM uploads WHERE file = ?', (file,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self) -> dict:
+        """ Number of clips in each state.
+            """
+        return dict(self._execute('SELECT state, COUNT(*) FROM uploads GROUP BY state').fetchall())
+
+    def close(self):
+        """ Close the database.
+            """
+        with self.lock:
+            self.connection.close()
+
+
+class ClipWatcher:
+    """ Adds the clips of a directory to the index as soon as they are closed after writing.
+
+        The directory is listed only once at the start for the clips written while nobody was watching. Clips
+        modified in the last settle seconds are left to their close event then. Without pyinotify the listing is
+        repeated every time wait() times out. Clips already in the index, e.g. the live ones, are left alone.
+        """
+
+    settle = 60  # seconds after a clip found by listing may still be written
+
+    def __init__(self, directory: str, index: UploadIndex, pattern: str = '*.h264'):
+        """ Constructor.
+
+            :param directory: Directory of the clips.
+            :param index: Queue of the uploads.
+            :param pattern: Names of the clips.
+            """
+        self.directory = directory
+        self.index = index
+        self.pattern = pattern
+        self.condition = threading.Condition()
+        self.added = 0
+        self.notifier = None
+
+    def _add(self, file: str):
+        try:
+            size = os.stat(file).st_size
+        except FileNotFoundError:
+            return
+        if self.index.add(file, size):
+            with self.condition:
+                self.added += 1
+                self.condition.notify_all()
+
+    def scan(self):
+        """ Add the clips not yet known and not written recently.
+            """
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            if not fnmatch(filename, self.pattern):
+                continue
+            file = path.join(self.directory, filename)
+            marker = "{}.upl".format(file)
+            try:
+                if path.exists(marker):
+                    # Uploaded before the index existed.
+                    self.index.done(file)
+                    os.remove(marker)
+                elif path.getmtime(file) < now - self.settle:
+                    self._add(file)
+            except FileNotFoundError:
+                pass
+
+    def start(self):
+        """ Start watching, then list the directory.
+            """
+        if pyinotify is not None:
+            watcher = self
+
+            class Handler(pyinotify.ProcessEvent):
+                """ Clip closed after writing or moved into the directory.
+                    """
+
+                # noinspection PyPep8Naming
+                def process_IN_CLOSE_WRITE(self, event):
+                    if fnmatch(event.name, watcher.pattern):
+                        watcher._add(event.pathname)
+
+                # noinspection PyPep8Naming
+                def process_IN_MOVED_TO(self, event):
+                    self.process_IN_CLOSE_WRITE(event)
+
+            manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.ThreadedNotifier(manager, Handler())
+            self.notifier.daemon = True
+            self.notifier.start()
+            manager.add_watch(self.directory, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+        self.scan()
+
+    def wait(self, timeout: float) -> bool:
+        """ Wait for a new clip.
+
+            :param timeout: Seconds.
+            :return: Whether a clip was added.
+            """
+        with self.condition:
+            added = self.added
+            if self.condition.wait_for(lambda: self.added > added, timeout):
+                return True
+        if self.notifier is None:
+            self.scan()
+            with self.condition:
+                return self.added > added
+        return False
+
+    def stop(self):
+        """ Stop watching.
+            """
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+
+class RemoteManifest:
+    """ Local copy of the list of files in Dropbox, kept in the uploads database.
+
+        It is updated from the uploads and deletions of the daemon and from the changes Dropbox reports since the
+        last delta cursor, so the full listing is downloaded only once. The files are kept in a heap ordered by
+        modification time, finding the k oldest files to delete takes O(k log n).
+        """
+
+    timeout = 30  # seconds to wait for a lock held by another process
+
+    def __init__(self, filename: str = None):
+        """ Constructor, loads the manifest.
+
+            :param filename: SQLite database, uploads.db in the working directory if None.
+            """
+        self.filename = filename if filename is not None else path.join(settings.config.working_dir, 'uploads.db')
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.filename, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        row = self.connection.execute('SELECT value FROM cursor WHERE id = 0').fetchone()
+        self.cursor = row[0] if row else None
+        self.files = {}  # key: (path, size, modified)
+        self.heap = []  # (modified, key), entries not matching files are stale
+        self.total = 0
+        for (key, remote_path, size, modified) in self.connection.execute('SELECT * FROM remote'):
+            self.files[key] = (remote_path, size, modified)
+            self.total += size
+        self._heapify()
+
+    def _heapify(self):
+        self.heap = [(modified, key) for (key, (_, _, modified)) in self.files.items()]
+        heapq.heapify(self.heap)
+
+    @staticmethod
+    def _modified(metadata: dict) -> float:
+        return datetime.strptime(metadata['modified'], '%a, %d %b %Y %H:%M:%S %z').timestamp()
+
+    def _put(self, metadata: dict):
+        """ Add or replace a file in memory and in the open transaction.
+            """
+        key = metadata['path'].lower()
+        self._remove(key)
+        entry = (metadata['path'], metadata['bytes'], self._modified(metadata))
+        self.files[key] = entry
+        self.total += entry[1]
+        heapq.heappush(self.heap, (entry[2], key))
+        self.connection.execute('INSERT OR REPLACE INTO remote VALUES (?, ?, ?, ?)', (key,) + entry)
+
+    def _remove(self, key: str):
+        """ Remove a file, or a folder with its files, in memory and in the open transaction.
+            """
+        if key in self.files:
+            children = [key]
+        else:
+            # A folder, or a file not known.
+            children = [child for child in self.files if child.startswith(key.rstrip('/') + '/')]
+        for child in children:
+            self.total -= self.files.pop(child)[1]
+        self.connection.executemany('DELETE FROM remote WHERE key = ?', [(child,) for child in children])
+
+    def _transaction(self, action):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                action()
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def added(self, metadata: dict):
+        """ Register a file uploaded by us.
+
+            :param metadata: Metadata returned by Dropbox.
+            """
+        self._transaction(lambda: self._put(metadata))
+
+    def removed(self, paths: list):
+        """ Register files deleted by us, all in one transaction.
+
+            :param paths: Paths in Dropbox.
+            """
+        self._transaction(lambda: [self._remove(remote_path.lower()) for remote_path in paths])
+
+    def sync(self, client):
+        """ Apply the changes since the last cursor, the first call downloads the full listing.
+
+            :param client: DropboxClient.
+            """
+        while True:
+            delta = client.delta(self.cursor)
+
+            def apply():
+                if delta['reset']:
+                    self.connection.execute('DELETE FROM remote')
+                    self.files.clear()
+                    self.total = 0
+                for (key, metadata) in delta['entries']:
+                    if metadata is None:
+                        self._remove(key)
+                    elif not metadata['is_dir']:
+                        self._put(metadata)
+                self.connection.execute('INSERT OR REPLACE INTO cursor VALUES (0, ?)', (delta['cursor'],))
+
+            self._transaction(apply)
+            self.cursor = delta['cursor']
+            if delta['reset']:
+                self._heapify()
+            if not delta['has_more']:
+                return
+
+    def oldest(self, max_size: int) -> list:
+        """ Oldest files to delete to fit into max_size, removed from the heap only by removed().
+
+            :param max_size: Bytes.
+            :return: Paths in Dropbox.
+            """
+        with self.lock:
+            if len(self.heap) > 2 * len(self.files) + 64:
+                # Drop the stale entries left by replaced and deleted files.
+                self._heapify()
+            selected = []
+            popped = []
+            seen = set()
+            size = self.total
+            while size >= max_size and self.heap:
+                (modified, key) = entry = heapq.heappop(self.heap)
+                current = self.files.get(key)
+                if current is None or current[2] != modified or key in seen:
+                    continue
+                seen.add(key)
+                popped.append(entry)
+                selected.append(current[0])
+                size -= current[1]
+            # Put them back, they stay in the heap until they are really deleted.
+            for entry in popped:
+                heapq.heappush(self.heap, entry)
+            return selected
+
+    def close(self):
+        """ Close the database.
+            """
+        with self.lock:
+            self.connection.close()
+
+
+if __name__ == '__main__':
+    uploads = UploadIndex()
+    for (state, count) in sorted(uploads.counts().items()):
+        print("{}: {}".format(state, count))
+    uploads.close()
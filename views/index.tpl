@@ -1,6 +1,17 @@
 % rebase('layout.tpl', title='Események')
 <div class="jumbotron">
     <h1>Események</h1>
+    <form class="form-inline" method="get" action="/home">
+        <select class="form-control" name="location">
+            <option value="">Minden kamera</option>
+        % for camera in cameras:
+            <option value="{{camera}}"{{!' selected' if filter.get('location') == camera else ''}}>{{camera}}</option>
+        % end
+        </select>
+        <input class="form-control" type="date" name="since" value="{{filter.get('since', '')}}" />
+        <input class="form-control" type="date" name="until" value="{{filter.get('until', '')}}" />
+        <button class="btn btn-default" type="submit">Szűrés</button>
+    </form>
     <table class="table table-striped">
         <thead>
             <tr>
@@ -25,5 +36,12 @@
         % end
         </tbody>
     </table>
+    <ul class="pager">
+    % if first is not None:
+        <li class="previous"><a href="/home?{{first}}">Legújabbak</a></li>
+    % end
+    % if next is not None:
+        <li class="next"><a href="/home?{{next}}">Régebbiek</a></li>
+    % end
+    </ul>
 </div>
-
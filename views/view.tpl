@@ -3,7 +3,9 @@
 % for item in streams:
     <h1>{{item['name']}}</h1>
     <p>
-        <img src="{{item['url']}}/cam.mjpg" style="width:1024px; height:768px" />
+        <a href="{{item['url']}}/cam.mjpg">
+            <img src="{{item['url']}}/thumb.mjpg" style="width:320px; height:240px" />
+        </a>
     </p>
 % end
 </div>